@@ -0,0 +1,217 @@
+from marvinbot.utils.lru import LRUCache
+from argparse import (
+    Namespace, SUPPRESS, OPTIONAL, ZERO_OR_MORE, ONE_OR_MORE,
+    _StoreAction, _StoreConstAction, _StoreTrueAction, _StoreFalseAction
+)
+
+
+__all__ = ['FastPathParser']
+
+
+SIMPLE_ACTIONS = (_StoreAction, _StoreConstAction, _StoreTrueAction, _StoreFalseAction)
+VARIADIC = (OPTIONAL, ZERO_OR_MORE, ONE_OR_MORE)
+
+# Conversions that always give the same result for the same input, safe to memoize
+PURE_TYPES = (None, str, int, float)
+
+
+class Fallback(Exception):
+    """Raised when the fast path can't parse something exactly like argparse would."""
+    pass
+
+
+def _nargs_supported(nargs):
+    return nargs is None or nargs in VARIADIC or (isinstance(nargs, int) and nargs > 0)
+
+
+def _is_simple(parser):
+    if parser._mutually_exclusive_groups or parser.fromfile_prefix_chars or parser.prefix_chars != '-':
+        return False
+    if parser.argument_default is not None:
+        return False
+    positionals = [a for a in parser._actions if not a.option_strings]
+    for action in parser._actions:
+        if type(action) not in SIMPLE_ACTIONS or action.default is SUPPRESS or action.dest is SUPPRESS:
+            return False
+        if action.type is not None and not callable(action.type):
+            return False
+        if isinstance(action, _StoreAction) and not _nargs_supported(action.nargs):
+            return False
+    # Only the last positional can take a variable amount of arguments
+    for action in positionals[:-1]:
+        if action.nargs in VARIADIC:
+            return False
+    return True
+
+
+class FastPathParser(object):
+    def __init__(self, parser, cache_size=256):
+        """Speeds up `parser.parse_known_args` for simple argument specs.
+
+        Specs that only use plain store/store_true/store_false/store_const arguments and
+        plain positionals get parsed without going through argparse. Anything the fast path
+        isn't sure about (abbreviations, --opt=value, errors, help...) is left to argparse.
+
+        Results are memoized by the exact argument list, unless a custom `type` is used."""
+        self.parser = parser
+        self.cache_size = cache_size
+        self.reset()
+
+    def reset(self):
+        """Recompile and forget memoized results."""
+        self._compiled_actions = None
+        self.cache = LRUCache(max_size=self.cache_size)
+
+    def _compile(self):
+        actions = self.parser._actions
+        self.simple = _is_simple(self.parser)
+        self.cacheable = all(action.type in PURE_TYPES for action in actions)
+        self.optionals = {option: action for action in actions for option in action.option_strings}
+        self.positionals = [action for action in actions if not action.option_strings]
+        self._compiled_actions = len(actions)
+
+    def parse_known_args(self, args):
+        """Same as ArgumentParser.parse_known_args(args)"""
+        if self._compiled_actions != len(self.parser._actions):
+            # Arguments were added since we last looked (possibly through a group)
+            self.reset()
+            self._compile()
+        key = tuple(args)
+        if self.cacheable:
+            cached = self.cache.get(key)
+            if cached is not None:
+                values, extras = cached
+                # Hand out copies, callers are free to modify what they get
+                return Namespace(**{k: list(v) if isinstance(v, list) else v
+                                    for k, v in values.items()}), list(extras)
+
+        namespace = extras = None
+        if self.simple:
+            try:
+                namespace, extras = self._parse(list(args))
+            except Fallback:
+                pass
+        if namespace is None:
+            namespace, extras = self.parser.parse_known_args(list(args))
+
+        if self.cacheable:
+            self.cache.set(key, ({k: list(v) if isinstance(v, list) else v
+                                  for k, v in vars(namespace).items()}, tuple(extras)))
+        return namespace, extras
+
+    @staticmethod
+    def _convert(action, value):
+        if action.type is None:
+            return value
+        try:
+            return action.type(value)
+        except Exception:
+            raise Fallback
+
+    @staticmethod
+    def _check(action, value):
+        if action.choices is not None and value not in action.choices:
+            raise Fallback
+
+    def _values(self, action, strings):
+        # Mirrors ArgumentParser._get_values for the supported subset
+        if not strings and action.nargs == OPTIONAL:
+            value = action.const if action.option_strings else action.default
+            if isinstance(value, str):
+                value = self._convert(action, value)
+                self._check(action, value)
+            return value
+        if not strings and action.nargs == ZERO_OR_MORE and not action.option_strings:
+            if action.choices is not None:
+                raise Fallback
+            return action.default if action.default is not None else []
+        if len(strings) == 1 and action.nargs in (None, OPTIONAL):
+            value = self._convert(action, strings[0])
+            self._check(action, value)
+            return value
+        value = [self._convert(action, s) for s in strings]
+        for v in value:
+            self._check(action, v)
+        return value
+
+    def _parse(self, args):
+        namespace = Namespace(**{action.dest: action.default for action in self.parser._actions})
+        seen = set()
+        extras = []
+        positional_strings = []
+
+        if self.positionals and any(arg.startswith('-') for arg in args):
+            # Interleaving optionals and positionals is argparse's job
+            raise Fallback
+
+        i = 0
+        while i < len(args):
+            arg = args[i]
+            i += 1
+            if not arg.startswith('-'):
+                if self.positionals:
+                    positional_strings.append(arg)
+                else:
+                    extras.append(arg)
+                continue
+            action = self.optionals.get(arg)
+            if action is None:
+                raise Fallback
+
+            following = []
+            while i + len(following) < len(args) and not args[i + len(following)].startswith('-'):
+                following.append(args[i + len(following)])
+            nargs = action.nargs
+            if nargs == 0:
+                strings = []
+            elif nargs is None:
+                strings = following[:1]
+            elif nargs == OPTIONAL:
+                strings = following[:1]
+            elif nargs in (ZERO_OR_MORE, ONE_OR_MORE):
+                strings = following
+            else:
+                strings = following[:nargs]
+            if (nargs is None and not strings) or (nargs == ONE_OR_MORE and not strings) or \
+                    (isinstance(nargs, int) and nargs > 0 and len(strings) < nargs):
+                raise Fallback
+            i += len(strings)
+
+            if nargs == 0:
+                setattr(namespace, action.dest, action.const)
+            else:
+                setattr(namespace, action.dest, self._values(action, strings))
+            seen.add(action)
+
+        if self.positionals:
+            extras = self._assign_positionals(namespace, positional_strings)
+            seen.update(self.positionals)
+
+        for action in self.parser._actions:
+            if action in seen:
+                continue
+            if action.required:
+                raise Fallback
+            if isinstance(action.default, str) and getattr(namespace, action.dest) is action.default:
+                setattr(namespace, action.dest, self._convert(action, action.default))
+        return namespace, extras
+
+    def _assign_positionals(self, namespace, strings):
+        position = 0
+        for action in self.positionals:
+            nargs = action.nargs
+            remaining = len(strings) - position
+            if nargs is None:
+                count = 1
+            elif nargs == OPTIONAL:
+                count = min(1, remaining)
+            elif nargs in (ZERO_OR_MORE, ONE_OR_MORE):
+                count = remaining
+            else:
+                count = nargs
+            if count > remaining or (nargs == ONE_OR_MORE and not count):
+                # Missing a required argument
+                raise Fallback
+            setattr(namespace, action.dest, self._values(action, strings[position:position + count]))
+            position += count
+        return strings[position:]
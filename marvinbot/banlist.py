@@ -0,0 +1,177 @@
+from marvinbot.models import User
+from marvinbot.utils import localized_date
+from datetime import timedelta
+import threading
+import logging
+import time
+
+
+log = logging.getLogger(__name__)
+
+
+__all__ = ['BannedUserSet', 'configure_banlist', 'get_banlist']
+
+
+BANLIST_DEFAULTS = {
+    # One of: none, delta, change_stream
+    'sync': 'delta',
+    'sync_interval': 60,
+    # Seconds between delta syncs that reload the whole list, to drop users deleted elsewhere
+    'full_sync_interval': 3600,
+}
+
+BANLIST = None
+
+
+class BannedUserSet(object):
+    def __init__(self, sync='none', sync_interval=60, full_sync_interval=3600):
+        """In-memory set of banned user ids.
+
+        The whole list is read from MongoDB once, on first use. After that the set is kept
+        current with `ban`/`unban`, and optionally synced with changes made by other processes:
+
+        - `delta`: every `sync_interval` seconds, fetch users whose `ban_updated` changed.
+          Deleted users don't show up there, so every `full_sync_interval` seconds the whole
+          list is reloaded instead.
+        - `change_stream`: follow a MongoDB change stream on the users collection (needs a replica set).
+        """
+        if sync not in ('none', 'delta', 'change_stream'):
+            raise ValueError('sync should be one of: none, delta, change_stream')
+        self.sync_mode = sync
+        self.sync_interval = sync_interval
+        self.full_sync_interval = full_sync_interval
+        self.ids = None
+        self.last_sync = None
+        self.lock = threading.Lock()
+        self.running = False
+        self._thread = None
+
+    def load(self):
+        with self.lock:
+            if self.ids is not None:
+                return
+            since = localized_date()
+            self.ids = set(User.objects(banned=True).scalar('id'))
+            self.last_sync = since
+            log.info("Loaded %d banned user ids", len(self.ids))
+
+    def __contains__(self, user_id):
+        if self.ids is None:
+            self.load()
+        return user_id in self.ids
+
+    def __len__(self):
+        if self.ids is None:
+            self.load()
+        return len(self.ids)
+
+    def ban(self, user_id):
+        if self.ids is None:
+            self.load()
+        with self.lock:
+            self.ids.add(user_id)
+
+    def unban(self, user_id):
+        if self.ids is None:
+            self.load()
+        with self.lock:
+            self.ids.discard(user_id)
+
+    def sync(self, full=False):
+        """Apply ban changes made since the last sync, returns how many users changed.
+
+        :param full: reload the whole list, the only way to notice banned users that were
+            deleted (e.g. by `manage_users --forget` in another process)."""
+        if self.ids is None:
+            self.load()
+            return 0
+        with self.lock:
+            since = localized_date()
+            if full:
+                ids = set(User.objects(banned=True).scalar('id'))
+                changed = len(ids ^ self.ids)
+                self.ids = ids
+                self.last_sync = since
+                return changed
+            # Overlap a bit, in case clocks between hosts aren't perfectly aligned
+            changes = list(User.objects(ban_updated__gte=self.last_sync - timedelta(seconds=5))
+                           .scalar('id', 'banned'))
+            for user_id, banned in changes:
+                if banned:
+                    self.ids.add(user_id)
+                else:
+                    self.ids.discard(user_id)
+            self.last_sync = since
+            return len(changes)
+
+    def start(self):
+        if self.sync_mode == 'none' or self._thread:
+            return
+        self.running = True
+        target = self._poll_deltas if self.sync_mode == 'delta' else self._watch
+        self._thread = threading.Thread(target=target, name='banlist-sync', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self.running = False
+
+    def _poll_deltas(self):
+        stopped = threading.Event()
+        last_full = time.monotonic()
+        while self.running and not stopped.wait(self.sync_interval):
+            try:
+                full = self.full_sync_interval and time.monotonic() - last_full >= self.full_sync_interval
+                changed = self.sync(full=bool(full))
+                if full:
+                    last_full = time.monotonic()
+                if changed:
+                    log.info("Synced %d ban changes", changed)
+            except Exception as e:
+                log.exception(e)
+
+    def _watch(self):
+        pipeline = [{'$match': {'$or': [
+            {'operationType': 'delete'},
+            {'operationType': {'$in': ['insert', 'replace']}, 'fullDocument.banned': True},
+            {'updateDescription.updatedFields.banned': {'$exists': True}},
+        ]}}]
+        self.load()
+        try:
+            with User._get_collection().watch(pipeline, full_document='updateLookup') as stream:
+                for change in stream:
+                    if not self.running:
+                        return
+                    user_id = change['documentKey']['_id']
+                    document = change.get('fullDocument')
+                    if change['operationType'] != 'delete' and document and document.get('banned'):
+                        self.ids.add(user_id)
+                    else:
+                        self.ids.discard(user_id)
+        except Exception as e:
+            # Most likely not a replica set, fall back to deltas
+            log.warning("Change stream unavailable, syncing bans every %s seconds instead",
+                        self.sync_interval)
+            log.exception(e)
+            self._poll_deltas()
+
+
+def configure_banlist(config):
+    global BANLIST
+
+    bconfig = {}
+    bconfig.update(BANLIST_DEFAULTS)
+    bconfig.update(config.get('banlist', {}))
+
+    if BANLIST:
+        BANLIST.stop()
+    BANLIST = BannedUserSet(sync=bconfig.get('sync'), sync_interval=bconfig.get('sync_interval'),
+                            full_sync_interval=bconfig.get('full_sync_interval'))
+    BANLIST.start()
+    return BANLIST
+
+
+def get_banlist():
+    global BANLIST
+    if BANLIST is None:
+        BANLIST = BannedUserSet()
+    return BANLIST
@@ -1,5 +1,4 @@
-from marvinbot.cache_impl import configure_cache
-from marvinbot.utils import get_config
+from marvinbot.cache_impl import cache, configure_cache, cache_stats
 
 
-cache = configure_cache(get_config())
+__all__ = ['cache', 'configure_cache', 'cache_stats']
@@ -0,0 +1,262 @@
+"""Cache backends for `marvinbot.cache_impl`.
+
+`marvinbot.tiered` keeps a bounded LRU in every process, in front of an optional second
+tier shared between processes. Configure it in the `cache` settings:
+
+    "cache": {
+        "backend": "marvinbot.tiered",
+        "expiration_time": 3600,
+        "arguments.max_size": 10000,
+        "arguments.second_tier": "file",
+        "arguments.path": "/var/cache/marvinbot"
+    }
+
+Second tiers: `none`, `file` (a directory, safe to share between processes on the same
+host), `mongo` (a collection in the bot's database) and `redis` (needs the `redis`
+package). They all expose the subset of the Redis client interface the backend uses,
+`get`/`set`/`delete`, so anything with it can be passed as `arguments.store`."""
+from dogpile.cache.api import CacheBackend, NO_VALUE
+from dogpile.cache.region import register_backend
+from marvinbot.utils.lru import LRUCache
+from collections import defaultdict
+from datetime import datetime, timedelta
+import threading
+import tempfile
+import hashlib
+import logging
+import pickle
+import time
+import os
+
+
+log = logging.getLogger(__name__)
+
+
+__all__ = ['TieredBackend', 'FileStore', 'MongoStore', 'make_store', 'key_namespace', 'register_namespace']
+
+
+TIERED_DEFAULTS = {
+    'max_size': 10000,
+    # Seconds an entry stays in the front tier before being read again from the second,
+    # so changes made by other processes show up. Only used with a second tier.
+    'front_ttl': 60,
+    # One of: none, file, mongo, redis
+    'second_tier': 'none',
+    # Seconds the second tier keeps entries, None keeps them until replaced
+    'expiration_time': None,
+    'path': os.path.join(tempfile.gettempdir(), 'marvinbot-cache'),
+    'collection': 'cache',
+    'url': 'redis://localhost:6379/0',
+}
+
+
+# Namespaces with an explicit part (module:function|namespace), see `register_namespace`
+NAMESPACES = set()
+
+
+def register_namespace(namespace):
+    """Count keys starting with namespace separately, `cache_key_generator` registers the
+    ones given explicitly to `cache_on_arguments(namespace=...)`."""
+    NAMESPACES.add(namespace)
+
+
+def key_namespace(key):
+    """What a key from `cache_key_generator` is counted under: module:function, or
+    module:function|namespace if it was given one."""
+    parts = key.split('|', 2)
+    if len(parts) == 1:
+        # Set directly on the region, don't keep a counter per key
+        return '-'
+    if len(parts) == 3:
+        explicit = parts[0] + '|' + parts[1]
+        if explicit in NAMESPACES:
+            return explicit
+    return parts[0]
+
+
+class FileStore(object):
+    def __init__(self, path):
+        """One file per key in a directory. Writes are atomic, so several processes can
+        share it. Expiry is kept as the file's modification time."""
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+
+    def _filename(self, key):
+        digest = hashlib.sha1(key.encode('utf-8')).hexdigest()
+        return os.path.join(self.path, digest[:2], digest)
+
+    def get(self, key):
+        filename = self._filename(key)
+        try:
+            if os.stat(filename).st_mtime < time.time():
+                self.delete(key)
+                return None
+            with open(filename, 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def set(self, key, value, ex=None):
+        filename = self._filename(key)
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        fd, temp = tempfile.mkstemp(dir=os.path.dirname(filename))
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(value)
+            # Far in the future when it doesn't expire
+            expires = time.time() + (ex if ex else 10 * 365 * 86400)
+            os.utime(temp, (expires, expires))
+            os.replace(temp, filename)
+        except Exception:
+            os.unlink(temp)
+            raise
+
+    def delete(self, key):
+        try:
+            os.unlink(self._filename(key))
+        except FileNotFoundError:
+            pass
+
+
+class MongoStore(object):
+    def __init__(self, collection='cache'):
+        """A collection in the bot's MongoDB database, expired entries are removed by a TTL index."""
+        self.collection_name = collection
+        self._collection = None
+
+    @property
+    def collection(self):
+        if self._collection is None:
+            from mongoengine.connection import get_db
+
+            collection = get_db()[self.collection_name]
+            collection.create_index('expires', expireAfterSeconds=0)
+            self._collection = collection
+        return self._collection
+
+    def get(self, key):
+        document = self.collection.find_one({'_id': key})
+        if document is None:
+            return None
+        # The TTL monitor only runs every minute
+        if document.get('expires') and document['expires'] < datetime.utcnow():
+            return None
+        return document['value']
+
+    def set(self, key, value, ex=None):
+        document = {'value': value, 'expires': datetime.utcnow() + timedelta(seconds=ex) if ex else None}
+        self.collection.replace_one({'_id': key}, document, upsert=True)
+
+    def delete(self, key):
+        self.collection.delete_one({'_id': key})
+
+
+def make_store(arguments):
+    """The second tier described by the backend arguments, None if there's none."""
+    if arguments.get('store') is not None:
+        return arguments['store']
+    kind = arguments.get('second_tier') or 'none'
+    if kind == 'none':
+        return None
+    if kind == 'file':
+        return FileStore(arguments['path'])
+    if kind == 'mongo':
+        return MongoStore(arguments['collection'])
+    if kind == 'redis':
+        try:
+            import redis
+        except ImportError:
+            raise ImportError('The redis second tier needs the redis package installed')
+        return redis.StrictRedis.from_url(arguments['url'])
+    raise ValueError('second_tier should be one of: none, file, mongo, redis')
+
+
+class TieredBackend(CacheBackend):
+    def __init__(self, arguments):
+        """Bounded in-process LRU, in front of an optional shared second tier.
+
+        Keeps hit/miss/eviction counters for the region, and per namespace (the function
+        the key was generated for, see `cache_key_generator`). Dogpile looks a key up again
+        once it holds the creation lock, so a value that had to be created counts two misses,
+        `sets` is the amount of values created."""
+        args = {}
+        args.update(TIERED_DEFAULTS)
+        args.update(arguments)
+        self.store = make_store(args)
+        self.expiration_time = args['expiration_time']
+        self.front_ttl = args['front_ttl'] if self.store is not None else None
+        # key -> (value, time to read it again from the second tier or None)
+        self.front = LRUCache(max_size=args['max_size'], on_evict=self._evicted)
+        self.counters = defaultdict(int)
+        self.namespaces = defaultdict(lambda: defaultdict(int))
+        self._counters_lock = threading.Lock()
+
+    def _count(self, key, counter):
+        with self._counters_lock:
+            self.counters[counter] += 1
+            self.namespaces[key_namespace(key)][counter] += 1
+
+    def _evicted(self, key, value):
+        self._count(key, 'evictions')
+
+    def get(self, key):
+        entry = self.front.get(key)
+        if entry is not None and (entry[1] is None or entry[1] > time.monotonic()):
+            self._count(key, 'hits')
+            return entry[0]
+        if self.store is not None:
+            try:
+                raw = self.store.get(key)
+            except Exception as e:
+                log.exception(e)
+                raw = None
+            if raw is not None:
+                value = pickle.loads(raw)
+                self._set_front(key, value)
+                self._count(key, 'second_tier_hits')
+                return value
+        self._count(key, 'misses')
+        return NO_VALUE
+
+    def get_multi(self, keys):
+        return [self.get(key) for key in keys]
+
+    def _set_front(self, key, value):
+        refresh = time.monotonic() + self.front_ttl if self.front_ttl else None
+        self.front.set(key, (value, refresh))
+
+    def set(self, key, value):
+        self._set_front(key, value)
+        self._count(key, 'sets')
+        if self.store is not None:
+            try:
+                self.store.set(key, pickle.dumps(value, pickle.HIGHEST_PROTOCOL), ex=self.expiration_time)
+            except Exception as e:
+                # The front tier still has it
+                log.exception(e)
+
+    def set_multi(self, mapping):
+        for key, value in mapping.items():
+            self.set(key, value)
+
+    def delete(self, key):
+        self.front.pop(key)
+        if self.store is not None:
+            try:
+                self.store.delete(key)
+            except Exception as e:
+                log.exception(e)
+
+    def delete_multi(self, keys):
+        for key in keys:
+            self.delete(key)
+
+    def stats(self):
+        with self._counters_lock:
+            stats = dict(self.counters)
+            stats['size'] = len(self.front)
+            stats['namespaces'] = {namespace: dict(counters) for namespace, counters in self.namespaces.items()}
+        return stats
+
+
+register_backend('marvinbot.tiered', 'marvinbot.cache_backends', 'TieredBackend')
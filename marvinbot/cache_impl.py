@@ -1,10 +1,13 @@
-from dogpile.cache.region import make_region
+from dogpile.cache.region import CacheRegion
+# Registers the marvinbot.* backends
+from marvinbot.cache_backends import register_namespace
+import threading
 import inspect
 import unicodedata
 
 
 __all__ = ['to_ascii', 'to_str', 'cache_key_generator', 'cache', 'configure_cache',
-           'includeme', 'create_cache']
+           'includeme', 'create_cache', 'cache_stats']
 
 
 def to_ascii(ze_text):
@@ -21,6 +24,7 @@ def cache_key_generator(namespace, fn, to_str=to_str):
         namespace = '%s:%s' % (fn.__module__, fn.__name__)
     else:
         namespace = '%s:%s|%s' % (fn.__module__, fn.__name__, namespace)
+        register_namespace(namespace)
 
     args = inspect.getargspec(fn)
     has_self = args[0] and args[0][0] in ('self', 'cls')
@@ -48,37 +52,68 @@ DEFAULT_PREFIX = 'marvinbot.caching.'
 
 
 DEFAULTS = {
-    'backend': 'dogpile.cache.memory',
+    'backend': 'marvinbot.tiered',
     'expiration_time': 3600,
 }
 
 
-cache = make_region(function_key_generator=cache_key_generator).configure_from_config(
-    {DEFAULT_PREFIX + k: v for k, v in DEFAULTS.items()}, DEFAULT_PREFIX)
+class LazyCacheRegion(CacheRegion):
+    """Cache region that configures itself from the bot config the first time it's used.
+
+    Importing modules that decorate functions with it doesn't need the config around."""
+    _configure_lock = threading.Lock()
+    # Attributes only set by `configure`
+    _configured_attributes = ('backend', 'expiration_time', '_lock_registry')
+
+    def __getattr__(self, name):
+        # Only reached for missing attributes, i.e. while not configured yet
+        if name not in self._configured_attributes:
+            raise AttributeError(name)
+        with self._configure_lock:
+            if 'backend' not in self.__dict__:
+                from marvinbot.utils import get_config
+                configure_cache(get_config(), self)
+        return self.__dict__[name]
 
 
 def create_cache():
-    cache_inst = make_region(function_key_generator=cache_key_generator)
+    cache_inst = LazyCacheRegion(function_key_generator=cache_key_generator)
     return cache_inst
 
 
+cache = create_cache()
+
+
 def configure_cache(settings, cache_inst=None):
-    global cache
+    """Configure cache_inst (the shared region by default) from the settings.
+
+    A region can only be configured once, the shared one is left alone if it already was."""
     conf = {}
     conf.update({k: v for k, v in DEFAULTS.items()})
     conf.update(settings.get('cache', {}))
 
-    if cache_inst:
-        cache = cache_inst
-    else:
-        cache = create_cache()
-    cache.configure_from_config(conf, '')
-    return cache
+    if cache_inst is None:
+        cache_inst = cache
+    if cache_inst.is_configured:
+        return cache_inst
+    if conf['backend'] == 'marvinbot.tiered':
+        # Have the shared tier drop entries once the region would consider them expired
+        conf.setdefault('arguments.expiration_time', conf.get('expiration_time'))
+    cache_inst.configure_from_config(conf, '')
+    return cache_inst
+
+
+def cache_stats(cache_inst=None):
+    """Hit/miss/eviction counters for a region (the shared one by default), overall and
+    per namespace. Empty if its backend doesn't keep any."""
+    if cache_inst is None:
+        cache_inst = cache
+    backend = cache_inst.actual_backend if hasattr(cache_inst, 'actual_backend') else cache_inst.backend
+    if hasattr(backend, 'stats'):
+        return backend.stats()
+    return {}
 
 
 def includeme(config):
-    global cache
     # See: http://dogpilecache.readthedocs.org/en/latest/usage.html
-
-    cache = create_cache()
     configure_cache(config)
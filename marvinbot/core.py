@@ -1,16 +1,22 @@
 import abc
-import time
+import asyncio
+import inspect
 import logging
-from functools import partial
+import threading
 from collections import defaultdict, OrderedDict
 
 from marvinbot.errors import HandlerException
 from marvinbot.defaults import DEFAULT_PRIORITY
-from marvinbot.models import User
+from marvinbot.models import User, configure_user_cache
 from marvinbot.cache import cache
 from marvinbot.plugins import Plugin
+from marvinbot.ratelimit import configure_rate_limiter, get_rate_limiter
+from marvinbot.outbound import configure_outbound
+from marvinbot.banlist import configure_banlist, get_banlist
+from marvinbot.state import configure_state
+from marvinbot.userupserts import configure_user_upserts
+from marvinbot.filters import evaluation_context
 import telegram
-from ratelimiter import RateLimiter
 
 
 log = logging.getLogger(__name__)
@@ -19,12 +25,12 @@ PERIODIC_TASKS = OrderedDict()
 
 _ADAPTER = None
 ADAPTER_REGISTRY = {}
-BANNED_IDS_CACHE_KEY = "marvinbot-banned-user-ids"
 
 
 def configure_adapter(config):
     global _ADAPTER
     adapter_name = config.get("adapter_name", "telegram")
+    configure_user_cache(config)
     adapter = ADAPTER_REGISTRY.get(adapter_name)
     _ADAPTER = adapter(config)
     return _ADAPTER
@@ -37,17 +43,7 @@ def get_adapter():
 
 
 def is_user_banned(user):
-    user_id = user.id
-
-    def get_banned_user_ids():
-        return list(User.objects.filter(banned=True).scalar("id"))
-
-    banned_ids = cache.get_or_create(
-        BANNED_IDS_CACHE_KEY,
-        get_banned_user_ids,
-        should_cache_fn=lambda value: value is not None,
-    )
-    return user_id in banned_ids
+    return user.id in get_banlist()
 
 
 class AdapterMeta(abc.ABCMeta):
@@ -69,21 +65,182 @@ class Adapter(object, metaclass=AdapterMeta):
         self.config = config
         self.handlers = defaultdict(list)
         self.plugin_registry = {}
-
-    def add_handler(self, handler, priority=DEFAULT_PRIORITY, plugin=None):
+        self._dispatch_index = None
+        self._handlers_lock = threading.RLock()
+        self._process_pool = None
+        self._process_keys = set()
+        # Plugin modspec -> ids of the jobs it scheduled
+        self._plugin_jobs = defaultdict(list)
+        # Plugin modspec -> [(priority, handler)], handlers held back while it's reloaded
+        self._staged_handlers = {}
+        # Set in the worker processes, that handle updates published by another process
+        self.is_worker = False
+
+    def add_handler(self, handler, priority=DEFAULT_PRIORITY, plugin=None, executor=None):
+        """Register a handler.
+
+        :param executor: "process" runs the handler on the process pool (for CPU heavy work),
+            None/"thread" runs it on the updater's threads."""
+        if executor not in (None, "thread", "process"):
+            raise ValueError("executor should be one of: thread, process")
         if not plugin:
             plugin = self.plugin_for_handler(handler)
         handler.plugin = plugin
+        handler.executor = executor
+        if executor == "process":
+            from marvinbot.procpool import handler_key
+
+            with self._handlers_lock:
+                handler.process_key = handler_key(handler, self._process_keys)
+                self._process_keys.add(handler.process_key)
 
         log.info(
             "Adding handler: {}, priority: {}, plugin: {}".format(
                 handler, priority, plugin
             )
         )
-        self.handlers[priority].append(handler)
+        with self._handlers_lock:
+            staged = self._staging_for(handler)
+            if staged is not None:
+                staged.append((priority, handler))
+                return
+            self.handlers[priority].append(handler)
+            self.invalidate_dispatch_index()
+
+    def _staging_for(self, handler):
+        """The list handler is held back in if its plugin is being reloaded, else None."""
+        if not self._staged_handlers:
+            return None
+        from marvinbot.plugins import in_package
+
+        modspec = getattr(handler.plugin, 'modspec', None)
+        if modspec in self._staged_handlers:
+            return self._staged_handlers[modspec]
+        if handler.plugin is None:
+            # Added while the plugin is imported again
+            module = getattr(handler.callback, '__module__', None)
+            for modspec, staged in self._staged_handlers.items():
+                if in_package(module, modspec):
+                    return staged
+        return None
+
+    def remove_handler(self, handler):
+        """Unregister a handler, returns False if it wasn't registered."""
+        with self._handlers_lock:
+            for handlers in self.handlers.values():
+                if handler in handlers:
+                    handlers.remove(handler)
+                    self.invalidate_dispatch_index()
+                    return True
+        return False
+
+    def adopt_handlers(self, plugin):
+        """Attribute to plugin the handlers its modules added before it was registered (e.g.
+        while being imported), so they're treated as its own, on reload too."""
+        from marvinbot.plugins import in_package
+
+        with self._handlers_lock:
+            for handler in self.iter_handlers():
+                if handler.plugin is plugin:
+                    continue
+                if handler.plugin is None or getattr(handler.plugin, 'modspec', None) == plugin.modspec:
+                    if in_package(getattr(handler.callback, '__module__', None), plugin.modspec):
+                        handler.plugin = plugin
+
+    def handlers_for_plugin(self, plugin):
+        """The handlers registered by plugin, in dispatch order."""
+        with self._handlers_lock:
+            return [handler for priority in sorted(self.handlers)
+                    for handler in self.handlers[priority] if handler.plugin is plugin]
+
+    def invalidate_dispatch_index(self):
+        """Forces the dispatch index to be rebuilt on the next update."""
+        self._dispatch_index = None
+
+    @property
+    def dispatch_index(self):
+        index = self._dispatch_index
+        if index is None:
+            from marvinbot.dispatch import DispatchIndex
+
+            with self._handlers_lock:
+                index = self._dispatch_index
+                if index is None:
+                    index = DispatchIndex(self.handlers)
+                    self._dispatch_index = index
+                    log.debug("Rebuilt dispatch index with %d handlers", len(index))
+        return index
+
+    @property
+    def process_pool(self):
+        """Pool of processes for the handlers added with executor="process", created on first use"""
+        if self._process_pool is None:
+            from marvinbot.procpool import configure_process_pool
+
+            with self._handlers_lock:
+                if self._process_pool is None:
+                    self._process_pool = configure_process_pool(self.config)
+        return self._process_pool
+
+    @property
+    def has_process_handlers(self):
+        return bool(self._process_keys)
+
+    def run_handler(self, handler, update):
+        """Run a handler that accepted update, on the process pool if it asked for it."""
+        if handler.executor == "process":
+            # Block this thread only, the work happens in another process
+            return self.process_pool.submit(handler, update).result()
+        return handler.process_update(update)
+
+    def shutdown_process_pool(self):
+        if self._process_pool is not None:
+            self._process_pool.shutdown()
+            self._process_pool = None
+
+    def dispatch(self, update):
+        self.dispatch_to(update, self.dispatch_index.candidates(update))
+
+    def dispatch_to(self, update, candidates):
+        """Run every handler in candidates that accepts update, in order.
+
+        `is_final` doesn't stop the loop, every handler that accepts the update gets it. The
+        async adapter walks the candidates with `next_handler` too, and lazily loaded
+        plugins hand their first update to their real handlers through here."""
+        position = 0
+        while True:
+            try:
+                position = self.next_handler(update, candidates, position)
+                if position is None:
+                    return
+                handler = candidates[position]
+                position += 1
+                log.debug("Using handler: %s", str(handler))
+                result = self.run_handler(handler, update)
+                if inspect.isawaitable(result):
+                    # Coroutine callback outside of an event loop, run it to completion
+                    run_coroutine(result)
+            except Exception as e:
+                log.exception(e)
+                # self.notify_owners(r"⚠ Handler Error: ```{}```".format(traceback.format_exc()))
+                raise HandlerException from e
+
+    def next_handler(self, update, candidates, start=0):
+        """Position of the first handler in candidates[start:] that accepts update, None if none does."""
+        for position in range(start, len(candidates)):
+            handler = candidates[position]
+            log.debug("Trying handler: %s", str(handler))
+            if handler.plugin and not handler.plugin.enabled:
+                continue
+            if handler.can_handle(update):
+                return position
+        return None
 
     def plugin_for_handler(self, handler):
-        mod = handler.callback.__module__.split(".", 1)[0]
+        return self.plugin_for_callable(handler.callback)
+
+    def plugin_for_callable(self, func):
+        mod = func.__module__.split(".", 1)[0]
         plugins = self.plugins_by_modspec()
         if mod in plugins:
             return plugins[mod]
@@ -99,10 +256,127 @@ class Adapter(object, metaclass=AdapterMeta):
     def enable_plugin(self, plugin_name, enable=True):
         if plugin_name in self.plugin_registry:
             self.plugin_registry[plugin_name].enabled = enable
+            self.invalidate_dispatch_index()
 
     def plugin_definition(self, plugin_name):
         return self.plugin_registry.get(plugin_name)
 
+    def reload_plugin(self, plugin_name):
+        """Re-import a plugin and swap its handlers and jobs for the new ones, returns the new Plugin.
+
+        The new modules are imported and set up while the old handlers keep serving
+        updates, the handlers they add (on import too) are held back. They are then swapped
+        in at once: updates already being handled finish on the old code, the following ones
+        go to the new. If the plugin fails to import, configure or set up, the old one stays
+        in place, with its modules, handlers and jobs, and the error is raised."""
+        from marvinbot.plugins import timed, in_package
+        import importlib
+        import sys
+
+        old = self.plugin_registry.get(plugin_name)
+        if old is None or not old.modspec:
+            raise ValueError("No plugin named [{}]".format(plugin_name))
+        modspec = old.modspec
+        log.info("Reloading plugin [%s]", plugin_name)
+
+        timings = OrderedDict()
+        old_modules = {name: module for name, module in sys.modules.items() if in_package(name, modspec)}
+        with self._handlers_lock:
+            old_handlers = [handler for handler in self.iter_handlers() if handler.plugin is old]
+            # Free their keys, so the new handlers get the ones fresh worker processes compute
+            old_keys = {handler.process_key for handler in old_handlers if handler.process_key}
+            self._process_keys -= old_keys
+            self._staged_handlers[modspec] = []
+        # The new plugin schedules its own, these are put back if it fails
+        old_jobs = self._remove_plugin_jobs(modspec)
+
+        for name in old_modules:
+            sys.modules.pop(name)
+        # Pick up files added since the first import
+        importlib.invalidate_caches()
+        try:
+            with timed(timings, 'import'):
+                mod = importlib.import_module(modspec)
+            plugin = getattr(mod, 'plugin', None) or Plugin(old.name)
+            plugin.name = old.name
+            plugin.config = dict(old.config or {})
+            plugin.adapter = self
+            plugin.enabled = old.enabled
+            plugin.modspec = modspec
+            plugin.timings = timings
+            plugin.prepare()
+            plugin.setup()
+        except Exception:
+            with self._handlers_lock:
+                staged = self._staged_handlers.pop(modspec)
+                self._process_keys -= {handler.process_key for _, handler in staged if handler.process_key}
+                self._process_keys |= old_keys
+            self._remove_plugin_jobs(modspec)
+            self._restore_jobs(modspec, old_jobs)
+            # Put the old modules back, the old plugin never stopped
+            for name in [name for name in sys.modules if in_package(name, modspec)]:
+                sys.modules.pop(name)
+            sys.modules.update(old_modules)
+            parent, _, child = modspec.rpartition('.')
+            if parent and parent in sys.modules and modspec in old_modules:
+                setattr(sys.modules[parent], child, old_modules[modspec])
+            raise
+
+        with self._handlers_lock:
+            staged = self._staged_handlers.pop(modspec)
+            for handler in old_handlers:
+                self.remove_handler(handler)
+            for priority, handler in staged:
+                handler.plugin = plugin
+                self.handlers[priority].append(handler)
+            self.plugin_registry[plugin.name] = plugin
+            self.invalidate_dispatch_index()
+
+        if any(handler.executor == "process" for handler in old_handlers + [h for _, h in staged]):
+            # Workers have the old code loaded, new ones will be started on demand
+            pool, self._process_pool = self._process_pool, None
+            if pool is not None:
+                pool.shutdown(wait=False)
+        try:
+            old.unload()
+        except Exception as e:
+            log.exception(e)
+
+        log.info("Reloaded plugin [%s] in %.3fs, %d handlers replaced by %d",
+                 plugin.name, sum(timings.values()), len(old_handlers), len(staged))
+        return plugin
+
+    def _remove_plugin_jobs(self, modspec):
+        """Remove the jobs a plugin scheduled, returns them."""
+        jobs = []
+        for job_id in self._plugin_jobs.pop(modspec, []):
+            try:
+                job = self.get_job(job_id)
+                self.remove_job(job_id)
+            except Exception:
+                # Already gone, one-off jobs remove themselves once they run
+                continue
+            if job is not None:
+                jobs.append(job)
+        return jobs
+
+    def _restore_jobs(self, modspec, jobs):
+        for job in jobs:
+            try:
+                restored = self.scheduler.add_job(
+                    job.func, job.trigger, args=job.args, kwargs=job.kwargs, id=job.id, name=job.name,
+                    misfire_grace_time=job.misfire_grace_time, coalesce=job.coalesce,
+                    max_instances=job.max_instances, next_run_time=job.next_run_time,
+                    executor=job.executor, jobstore=getattr(job, '_jobstore_alias', 'default'))
+                self._plugin_jobs[modspec].append(restored.id)
+            except Exception as e:
+                log.exception(e)
+
+    def iter_handlers(self):
+        for priority in sorted(self.handlers):
+            for handler in list(self.handlers[priority]):
+                yield handler
+
     def commands(self, exclude_internal=False):
         from marvinbot.handlers import CommandHandler
 
@@ -121,13 +395,18 @@ class Adapter(object, metaclass=AdapterMeta):
     def scheduler_available(self):
         return hasattr(self, "scheduler") and self.scheduler
 
-    def add_job(self, func, *args, **kwargs):
+    def add_job(self, func, *args, plugin=None, **kwargs):
         if not self.scheduler_available:
             raise ValueError("Scheduler not available")
 
         # Add the adapter for easy reference
         func.adapter = self
-        return self.scheduler.add_job(func, *args, **kwargs)
+        job = self.scheduler.add_job(func, *args, **kwargs)
+        plugin = plugin or self.plugin_for_callable(func)
+        if plugin is not None:
+            # So they can be removed when the plugin is reloaded
+            self._plugin_jobs[plugin.modspec].append(job.id)
+        return job
 
     def pause_job(self, job_id):
         if not self.scheduler_available:
@@ -177,16 +456,12 @@ class Adapter(object, metaclass=AdapterMeta):
         return self._updater
 
 
-def on_rate_limited(until, key=None):
-    duration = int(round(until - time.time()))
-    log.info(f"Rate limiter hit for key {key}, sleeping for {duration} seconds")
-
-
-RATE_LIMITERS = {
-    "default": RateLimiter(
-        max_calls=30, period=1, callback=partial(on_rate_limited, key="normal")
-    )
-}
+def run_coroutine(awaitable):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(awaitable)
+    finally:
+        loop.close()
 
 
 class RateLimitedBot(telegram.Bot):
@@ -197,68 +472,156 @@ class RateLimitedBot(telegram.Bot):
         chat_type = chat_info.type
         return chat_type in ["group", "supergroup"]
 
+    def rate_limiter_key(self, chat_id):
+        """Returns the (key, limit name) pair for the rate limiter covering chat_id."""
+        if chat_id and self.is_group_chat(chat_id):
+            return f"group-{chat_id}", "group"
+        return "default", "default"
+
     def get_group_rate_limiter(self, chat_id):
-        key = f"group-{chat_id}"
-        if key not in RATE_LIMITERS:
-            log.info("Making rate limiter for key [%s]", key)
-            limiter = RateLimiter(
-                max_calls=20, period=60, callback=partial(on_rate_limited, key=key)
-            )
-            RATE_LIMITERS[key] = limiter
-        return RATE_LIMITERS[key]
+        return get_rate_limiter(f"group-{chat_id}", "group")
 
     def send_message(self, *args, **kwargs):
+        """Sends through the outbound queue and blocks until it's sent.
+
+        This keeps replies (Message.reply_text ends up here) behind the messages already
+        queued for the chat with send_message_later."""
+        outbound = getattr(self, "outbound", None)
+        if outbound is not None and not outbound.in_sender:
+            return outbound.enqueue("send_message", *args, **kwargs).result()
+        # Waiting on the queue from one of its senders could deadlock, send right away
         chat_id = kwargs.get("chat_id") or args[0]
-        if chat_id and self.is_group_chat(chat_id):
-            rate_limiter = self.get_group_rate_limiter(chat_id)
-            log.info("Using group rate limiter for group [%s]", chat_id)
-        else:
-            rate_limiter = RATE_LIMITERS["default"]
-        with rate_limiter:
+        key, limit = self.rate_limiter_key(chat_id)
+        with get_rate_limiter(key, limit):
             return super(RateLimitedBot, self).send_message(*args, **kwargs)
 
+    def send_message_later(self, chat_id, text, **kwargs):
+        """Non-blocking send_message: queues the message and returns a Future for it.
+
+        Messages to the same chat are sent in order, by the outbound sender pool."""
+        return self.outbound.send_message(chat_id, text, **kwargs)
+
 
 class TelegramAdapter(Adapter):
     def __init__(self, config):
         token = config.get("telegram_token")
+        configure_rate_limiter(config)
+        configure_banlist(config)
+        configure_state(config)
+        configure_user_upserts(config)
         self.bot = RateLimitedBot(token)
-        self.bot_info = self.bot.getMe()
+        self.bot.outbound = configure_outbound(config, self.bot)
+        self._bot_info = None
         self._updater = None
+
+        from marvinbot.updatequeue import configure_update_queue
+
+        # When set, updates are published for the worker processes instead of handled here
+        self.update_queue = configure_update_queue(config)
+        self.publish_updates = self.update_queue is not None
+        self.consumers = []
         super(TelegramAdapter, self).__init__(config)
 
+    @property
+    def bot_info(self):
+        """The bot's own telegram.User, fetched on first use"""
+        if self._bot_info is None:
+            self._bot_info = self.bot.getMe()
+        return self._bot_info
+
     def fetch_updates(self, last_update_id=None):
         for update in self.bot.getUpdates(
             offset=last_update_id, timeout=int(self.config.get("fetch_timeout", 5))
         ):
             yield update
 
+    def receive_update(self, update):
+        """Entry point for the updaters: process the update, or publish it to the update queue."""
+        if self.publish_updates:
+            return self.update_queue.publish(update)
+        return self.process_update(update)
+
     def process_update(self, update):
         if update.effective_user and is_user_banned(update.effective_user):
             return
         log.debug("Processing message: %s", str(update.effective_message).encode("utf-8"))
-        for priority in sorted(self.handlers):
-            for handler in self.handlers[priority]:
-                try:
-                    log.debug("Trying handler: %s", str(handler))
-                    if handler.plugin and not handler.plugin.enabled:
-                        continue
-                    if handler.can_handle(update):
-                        log.debug("Using handler: %s", str(handler))
-                        handler.process_update(update)
-                        if not handler.is_final:
-                            continue
-                except Exception as e:
-                    log.exception(e)
-                    # self.notify_owners(r"⚠ Handler Error: ```{}```".format(traceback.format_exc()))
-                    raise HandlerException from e
+        with evaluation_context(update.effective_message):
+            self.dispatch(update)
+
+    def shutdown_outbound(self, wait=True):
+        self.bot.outbound.shutdown(wait=wait)
 
     def notify_owners(self, message: str, **kwargs):
+        """Queue a message for every owner, returns a list of Futures."""
         owners = User.objects.filter(role="owner")
-        for owner in owners:
-            self.bot.sendMessage(owner.id, message, **kwargs)
+        return [self.bot.send_message_later(owner.id, message, **kwargs) for owner in owners]
+
+    @property
+    def updater_mode(self):
+        """Either polling or webhook"""
+        return self.config.get("updater", {}).get("mode", "polling")
+
+    def make_webhook_updater(self):
+        from marvinbot.webhook import WebhookUpdater
+
+        return WebhookUpdater(self)
 
     def make_updater(self):
+        if self.updater_mode == "webhook":
+            return self.make_webhook_updater()
+
         from marvinbot.polling import TelegramPollingThread
 
         updater = TelegramPollingThread(self)
         return updater
+
+
+class AsyncTelegramAdapter(TelegramAdapter):
+    """Telegram adapter that dispatches updates on an asyncio event loop.
+
+    Select it with `"adapter_name": "asynctelegram"`. Handlers with coroutine callbacks
+    are awaited on the loop, legacy sync handlers run on the updater's executor."""
+
+    async def process_update_async(self, update, executor=None):
+        if update.effective_user and is_user_banned(update.effective_user):
+            return
+        log.debug("Processing message: %s", str(update.effective_message).encode("utf-8"))
+        with evaluation_context(update.effective_message):
+            await self.dispatch_async(update, executor)
+
+    async def dispatch_async(self, update, executor=None):
+        """Dispatch update from the event loop.
+
+        Anything that may block runs on executor: picking the handlers (`can_handle` may
+        look up the bot's info or the user), the legacy sync handlers, and the part of
+        coroutine handlers before their callback is awaited (e.g. the role check)."""
+        loop = asyncio.get_event_loop()
+        candidates = self.dispatch_index.candidates(update)
+        position = 0
+        while True:
+            try:
+                position = await loop.run_in_executor(executor, self.next_handler, update, candidates, position)
+                if position is None:
+                    return
+                handler = candidates[position]
+                position += 1
+                log.debug("Using handler: %s", str(handler))
+                if handler.executor == "process":
+                    await asyncio.wrap_future(self.process_pool.submit(handler, update))
+                else:
+                    result = await loop.run_in_executor(executor, handler.process_update, update)
+                    if inspect.isawaitable(result):
+                        # Coroutine callback, awaited on the loop
+                        await result
+            except Exception as e:
+                log.exception(e)
+                raise HandlerException from e
+
+    def make_updater(self):
+        if self.updater_mode == "webhook":
+            return self.make_webhook_updater()
+
+        from marvinbot.polling import AsyncTelegramPollingThread
+
+        updater = AsyncTelegramPollingThread(self)
+        return updater
@@ -0,0 +1,231 @@
+from marvinbot.handlers import Handler, CommandHandler, CallbackQueryHandler, MessageHandler
+from marvinbot.filters import RegexpFilterSet, is_plain_regexp_filter
+from concurrent.futures import Future
+from collections import defaultdict, deque
+import threading
+import logging
+
+
+log = logging.getLogger(__name__)
+
+
+__all__ = ['DispatchIndex', 'ChatDispatcher', 'chat_key']
+
+
+def _is_plain_command_handler(handler):
+    cls = type(handler)
+    return (isinstance(handler, CommandHandler) and cls.can_handle is Handler.can_handle
+            and cls.validate is CommandHandler.validate)
+
+
+def _is_plain_message_handler(handler):
+    cls = type(handler)
+    return (isinstance(handler, MessageHandler) and cls.can_handle is Handler.can_handle
+            and cls.validate is MessageHandler.validate)
+
+
+def _is_plain_callback_handler(handler):
+    cls = type(handler)
+    return (isinstance(handler, CallbackQueryHandler)
+            and cls.can_handle is CallbackQueryHandler.can_handle
+            and cls.validate is CallbackQueryHandler.validate)
+
+
+class DispatchIndex(object):
+    """Precompiled lookup structure for the handlers registered on an adapter.
+
+    Handlers are bucketed so that only the ones that could possibly accept an update
+    get their `can_handle` called:
+
+    - `CommandHandler`s are keyed by command name.
+    - `CallbackQueryHandler`s are keyed by prefix.
+    - Everything else (`MessageHandler`s, custom handlers) stays in a residual list.
+      `MessageHandler`s with `RegexpFilter`s are pre-screened: all their patterns are
+      matched in a single pass (see `RegexpFilterSet`), and handlers whose patterns
+      can't match are left out.
+
+    Candidates are always returned in the same order a full scan would visit them:
+    ascending priority, then registration order."""
+    def __init__(self, handlers):
+        """Build the index from an adapter's `{priority: [handlers]}` mapping."""
+        self.commands = defaultdict(list)
+        self.callbacks = defaultdict(list)
+        self.residual = []
+        # handler id -> (strict, [regexp filter ids])
+        self.prescreened = {}
+        regexp_filters = []
+
+        for priority in sorted(handlers):
+            for position, handler in enumerate(handlers[priority]):
+                if handler.plugin and not handler.plugin.enabled:
+                    continue
+                entry = ((priority, position), handler)
+                if _is_plain_command_handler(handler):
+                    self.commands[handler.command].append(entry)
+                elif _is_plain_callback_handler(handler):
+                    self.callbacks[handler.prefix].append(entry)
+                else:
+                    self.residual.append(entry)
+                    if _is_plain_message_handler(handler):
+                        regexp_filters.extend(self._add_prescreen(handler))
+
+        self.regexps = RegexpFilterSet(regexp_filters) if regexp_filters else None
+
+        # Only probe the prefix lengths we actually have
+        self.prefix_lengths = sorted({len(prefix) for prefix in self.callbacks})
+
+    def _add_prescreen(self, handler):
+        filters = [f for f in handler.filters if is_plain_regexp_filter(f)]
+        # A non-strict handler can match through any of its filters, only
+        # screen it if they're all regexps
+        if not filters or (not handler.strict and len(filters) != len(handler.filters)):
+            return []
+        self.prescreened[id(handler)] = (handler.strict, [id(f) for f in filters])
+        return filters
+
+    def _may_match(self, handler, matched):
+        requirements = self.prescreened.get(id(handler))
+        if requirements is None:
+            return True
+        strict, filter_ids = requirements
+        if strict:
+            return all(filter_id in matched for filter_id in filter_ids)
+        return any(filter_id in matched for filter_id in filter_ids)
+
+    def residual_for(self, update):
+        message = update.effective_message
+        if self.regexps is None or message is None:
+            return self.residual
+        matched = self.regexps.matching(message.text)
+        # Handlers evaluating these filters later on get the results for free
+        self.regexps.seed(message, matched)
+        return [entry for entry in self.residual if self._may_match(entry[1], matched)]
+
+    @staticmethod
+    def command_for(update):
+        message = update.effective_message
+        if message is None or not message.text or not message.text.startswith('/'):
+            return None
+        return message.text[1:].split(' ')[0].split('@', 1)[0]
+
+    def candidates(self, update):
+        """Returns the handlers that may accept this update, in dispatch order."""
+        buckets = []
+        command = self.command_for(update)
+        if command is not None and command in self.commands:
+            buckets.append(self.commands[command])
+
+        query = update.callback_query
+        if query and query.data and self.callbacks:
+            for length in self.prefix_lengths:
+                if length > len(query.data):
+                    break
+                bucket = self.callbacks.get(query.data[:length])
+                if bucket:
+                    buckets.append(bucket)
+
+        residual = self.residual_for(update)
+        if not buckets:
+            return [handler for key, handler in residual]
+
+        entries = list(residual)
+        for bucket in buckets:
+            entries.extend(bucket)
+        entries.sort(key=lambda entry: entry[0])
+        return [handler for key, handler in entries]
+
+    def __len__(self):
+        return (len(self.residual) + sum(map(len, self.commands.values()))
+                + sum(map(len, self.callbacks.values())))
+
+
+def chat_key(update):
+    """Returns the key used to serialize updates: the chat id, or the user id for
+    updates without a chat (e.g. inline queries). None if there's neither."""
+    chat = update.effective_chat
+    if chat is not None:
+        return chat.id
+    user = update.effective_user
+    if user is not None:
+        return user.id
+    return None
+
+
+class ChatQueue(object):
+    __slots__ = ('pending', 'running')
+
+    def __init__(self):
+        self.pending = deque()
+        self.running = 0
+
+
+class ChatDispatcher(object):
+    def __init__(self, executor, process_func, max_in_flight=1):
+        """Runs `process_func` for every update on `executor`, keeping a FIFO per chat.
+
+        Updates from the same chat are started in arrival order, at most `max_in_flight`
+        at a time (1 means strictly sequential), while different chats run in parallel.
+        A busy chat only ever holds `max_in_flight` workers, so it can't starve the rest."""
+        self.executor = executor
+        self.process_func = process_func
+        self.max_in_flight = max(1, int(max_in_flight))
+        self.chats = {}
+        self.lock = threading.Lock()
+        self.idle = threading.Condition(self.lock)
+
+    def submit(self, update):
+        """Queue an update, returns a Future for the result of `process_func`."""
+        key = chat_key(update)
+        if key is None:
+            return self.executor.submit(self.process_func, update)
+
+        future = Future()
+        with self.lock:
+            queue = self.chats.get(key)
+            if queue is None:
+                queue = self.chats[key] = ChatQueue()
+            queue.pending.append((update, future))
+            ready = self._take_ready(queue)
+        self._start(key, ready)
+        return future
+
+    def _take_ready(self, queue):
+        ready = []
+        while queue.pending and queue.running < self.max_in_flight:
+            ready.append(queue.pending.popleft())
+            queue.running += 1
+        return ready
+
+    def _start(self, key, jobs):
+        for update, future in jobs:
+            self.executor.submit(self._run, key, update, future)
+
+    def _run(self, key, update, future):
+        try:
+            if future.set_running_or_notify_cancel():
+                try:
+                    future.set_result(self.process_func(update))
+                except Exception as e:
+                    future.set_exception(e)
+        finally:
+            with self.lock:
+                queue = self.chats[key]
+                queue.running -= 1
+                ready = self._take_ready(queue)
+                if not queue.running and not queue.pending:
+                    del self.chats[key]
+                    if not self.chats:
+                        self.idle.notify_all()
+            self._start(key, ready)
+
+    def wait_idle(self, timeout=None):
+        """Wait for every queued update to be processed, returns False on timeout.
+
+        Call this before shutting down the executor, queued updates need it to get started."""
+        with self.idle:
+            return self.idle.wait_for(lambda: not self.chats, timeout)
+
+    @property
+    def pending_count(self):
+        with self.lock:
+            return sum(len(queue.pending) for queue in self.chats.values())
@@ -6,5 +6,13 @@ class DownloadException(Exception):
     pass
 
 
+class DownloadCancelled(DownloadException):
+    pass
+
+
+class DownloadTimeout(DownloadException):
+    pass
+
+
 class PluginLoadException(Exception):
     pass
\ No newline at end of file
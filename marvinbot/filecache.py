@@ -0,0 +1,268 @@
+from contextlib import contextmanager
+from collections import Counter
+import threading
+import sqlite3
+import logging
+import time
+import os
+
+
+log = logging.getLogger(__name__)
+
+
+__all__ = ['FileCache']
+
+
+INDEX_FILENAME = '.index.sqlite'
+
+
+class CachedFile(object):
+    __slots__ = ('path', 'size', 'last_access', 'source', 'digest')
+
+    def __init__(self, path, size, last_access, source=None, digest=None):
+        self.path = path
+        self.size = size
+        self.last_access = last_access
+        self.source = source
+        self.digest = digest
+
+
+class FileCache(object):
+    def __init__(self, root, quota=0, objects_dir=None, shared=False):
+        """Index of the files under root, with a size quota.
+
+        The index lives in memory and is persisted to a SQLite file in root, so lookups
+        never hit the filesystem. Files are added with `add` once complete. When their total
+        size goes over `quota` bytes (0 for no limit), the least recently used ones are
+        deleted, except the ones pinned with `pin`. Eviction only happens on `add`, so a
+        pinned file stays past the quota until a later one is added. Files sharing a digest
+        are hardlinks (see `marvinbot.net.store_content`) and are only counted once.
+
+        With `shared`, several processes can use the same root, each with its own
+        FileCache (e.g. update queue workers, handler processes): a path missing from memory
+        is looked up in SQLite, a hit is checked to still be on disk, and the changes other
+        processes made are loaded before evicting. Pins only protect files in the process
+        that took them, a file another process evicts is gone for everyone (open handles
+        keep working), lookups then miss and it's downloaded again.
+
+        Files changed under root by anything else are only noticed by `scan`."""
+        self.root = os.path.abspath(root)
+        self.quota = int(quota or 0)
+        self.objects_dir = objects_dir
+        self.shared = shared
+        self.files = {}
+        self.usage = 0
+        self.evictions = 0
+        self.pins = Counter()
+        # Digest -> amount of indexed paths with it
+        self.links = Counter()
+        self.lock = threading.RLock()
+        os.makedirs(self.root, exist_ok=True)
+        self.db = sqlite3.connect(os.path.join(self.root, INDEX_FILENAME), check_same_thread=False)
+        if shared:
+            # Readers don't block the writer, and the other way around
+            self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, size INTEGER, '
+                        'last_access REAL, source TEXT, digest TEXT)')
+        self._touched = set()
+        # Changes when another connection commits, see `refresh`
+        self._data_version = None
+        self.load()
+
+    def load(self):
+        with self.lock:
+            self._data_version = self._current_data_version()
+            rows = self.db.execute('SELECT path, size, last_access, source, digest FROM files').fetchall()
+            for row in rows:
+                self._index(CachedFile(*row))
+            if not rows:
+                self.scan()
+        log.info("File cache has %d files, %d bytes", len(self.files), self.usage)
+
+    def _current_data_version(self):
+        return self.db.execute('PRAGMA data_version').fetchone()[0]
+
+    def refresh(self):
+        """Load the changes other processes made to the index since the last call, returns
+        False if there were none. Only used when shared."""
+        with self.lock:
+            version = self._current_data_version()
+            if version == self._data_version:
+                return False
+            self._data_version = version
+            rows = self.db.execute('SELECT path, size, last_access, source, digest FROM files').fetchall()
+            indexed = set()
+            for row in rows:
+                indexed.add(row[0])
+                if row[0] not in self.files:
+                    self._index(CachedFile(*row))
+            for path in [path for path in self.files if path not in indexed]:
+                # Evicted by another process
+                self._unindex(self.files[path])
+            return True
+
+    def _index(self, entry):
+        previous = self.files.get(entry.path)
+        if previous:
+            self._unindex(previous)
+        self.files[entry.path] = entry
+        if entry.digest:
+            self.links[entry.digest] += 1
+            if self.links[entry.digest] > 1:
+                return
+        self.usage += entry.size
+
+    def _unindex(self, entry):
+        del self.files[entry.path]
+        if entry.digest:
+            self.links[entry.digest] -= 1
+            if self.links[entry.digest] > 0:
+                return
+            del self.links[entry.digest]
+        self.usage -= entry.size
+
+    def scan(self):
+        """Index the files already under root, returns how many were added."""
+        added = 0
+        with self.lock:
+            for directory, dirnames, filenames in os.walk(self.root):
+                if self.objects_dir:
+                    dirnames[:] = [d for d in dirnames
+                                   if os.path.join(directory, d) != os.path.join(self.root, self.objects_dir)]
+                for filename in filenames:
+                    path = os.path.join(directory, filename)
+                    if filename.startswith(INDEX_FILENAME) or filename.endswith('.part') or path in self.files:
+                        continue
+                    stat = os.stat(path)
+                    self.add(path, size=stat.st_size, last_access=stat.st_atime, evict=False)
+                    added += 1
+            self.evict()
+        return added
+
+    def __contains__(self, path):
+        return self.get(path) is not None
+
+    def get(self, path):
+        """The CachedFile for path, None if it's not in the cache. Counts as an access."""
+        with self.lock:
+            entry = self.files.get(path)
+            if self.shared:
+                entry = self._check_shared(path, entry)
+            if entry is not None:
+                entry.last_access = time.time()
+                self._touched.add(path)
+            return entry
+
+    def _check_shared(self, path, entry):
+        if entry is None:
+            # Maybe another process downloaded it
+            row = self.db.execute('SELECT path, size, last_access, source, digest FROM files WHERE path = ?',
+                                  (path,)).fetchone()
+            if row is None or not os.path.exists(path):
+                return None
+            entry = CachedFile(*row)
+            self._index(entry)
+            return entry
+        if not os.path.exists(path):
+            # Evicted by another process
+            self._unindex(entry)
+            self.db.execute('DELETE FROM files WHERE path = ?', (path,))
+            self.db.commit()
+            return None
+        return entry
+
+    def add(self, path, source=None, digest=None, size=None, last_access=None, evict=True):
+        if size is None:
+            size = os.stat(path).st_size
+        entry = CachedFile(path, size, last_access or time.time(), source, digest)
+        with self.lock:
+            if self.shared:
+                self.refresh()
+            self._index(entry)
+            self._touched.discard(path)
+            self.db.execute('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?)',
+                            (entry.path, entry.size, entry.last_access, entry.source, entry.digest))
+            # Eviction goes by these, bring them up to date
+            self.sync()
+            if evict:
+                self.evict()
+        return entry
+
+    def add_alias(self, existing, path):
+        """Index path as another name for the existing file (a hardlink or copy of it)."""
+        entry = self.files.get(existing)
+        if entry is None:
+            return self.add(path)
+        return self.add(path, source=entry.source, digest=entry.digest, size=entry.size)
+
+    def remove(self, path):
+        with self.lock:
+            entry = self.files.get(path)
+            if entry is None:
+                return False
+            self._unindex(entry)
+            self.db.execute('DELETE FROM files WHERE path = ?', (path,))
+            self.db.commit()
+            last_link = entry.digest and entry.digest not in self.links
+        for filename in [path] + ([self._object_path(entry.digest)] if last_link and self.objects_dir else []):
+            try:
+                os.remove(filename)
+            except FileNotFoundError:
+                pass
+        return True
+
+    def _object_path(self, digest):
+        return os.path.join(self.root, self.objects_dir, digest[:2], digest)
+
+    @contextmanager
+    def pin(self, path):
+        """Keep path from being evicted while in the block. It doesn't have to be in the
+        cache yet: pin a file before adding it, so it can't be evicted by its own `add`."""
+        with self.lock:
+            self.pins[path] += 1
+        try:
+            yield path
+        finally:
+            with self.lock:
+                self.pins[path] -= 1
+                if self.pins[path] <= 0:
+                    del self.pins[path]
+
+    def evict(self):
+        """Remove least recently used files until usage is under the quota, returns how many."""
+        if not self.quota or self.usage <= self.quota:
+            return 0
+        evicted = 0
+        with self.lock:
+            for entry in sorted(self.files.values(), key=lambda e: e.last_access):
+                if self.usage <= self.quota:
+                    break
+                if entry.path in self.pins:
+                    continue
+                self.remove(entry.path)
+                evicted += 1
+            self.evictions += evicted
+        if evicted:
+            log.info("Evicted %d files from the file cache, %d bytes used", evicted, self.usage)
+        return evicted
+
+    def sync(self):
+        """Persist access times, they're only kept in memory in between."""
+        with self.lock:
+            touched, self._touched = self._touched, set()
+            self.db.executemany('UPDATE files SET last_access = ? WHERE path = ?',
+                                [(self.files[path].last_access, path) for path in touched if path in self.files])
+            self.db.commit()
+
+    def close(self):
+        self.sync()
+        self.db.close()
+
+    def stats(self):
+        return {
+            'files': len(self.files),
+            'bytes': self.usage,
+            'quota': self.quota,
+            'pinned': len(self.pins),
+            'evictions': self.evictions,
+        }
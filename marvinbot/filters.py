@@ -1,9 +1,200 @@
 from marvinbot.cache import cache
 from telegram.ext.filters import BaseFilter
+from collections import defaultdict
+from contextlib import contextmanager
+import threading
+import logging
+import weakref
+import time
 import re
 
 
+log = logging.getLogger(__name__)
+
+DEFAULT_COST = 1.0
+# Evaluations needed before measured cost/selectivity replace the cost hints
+MIN_SAMPLES = 32
+# Re-sort a handler's filters every X evaluations
+REORDER_INTERVAL = 256
+
+# Constructs that change meaning (or break) once the pattern is embedded in a bigger one
+NOT_COMBINABLE = re.compile(r'\\[1-9]|\(\?P=|\(\?\(|\(\?[aiLmsux]+\)')
+
+
+class FilterStats(object):
+    __slots__ = ('calls', 'passes', 'elapsed')
+
+    def __init__(self):
+        self.calls = 0
+        self.passes = 0
+        self.elapsed = 0.0
+
+    @property
+    def cost(self):
+        return self.elapsed / self.calls
+
+    @property
+    def pass_rate(self):
+        return self.passes / self.calls
+
+
+# filter -> FilterStats, dropped along with the filter (e.g. on plugin reload)
+FILTER_STATS = weakref.WeakKeyDictionary()
+_STATS_LOCK = threading.Lock()
+
+# id(message) -> FilterContext for the messages being dispatched right now
+_CONTEXTS = {}
+
+
+def stats_for(f):
+    try:
+        stats = FILTER_STATS.get(f)
+        if stats is None:
+            with _STATS_LOCK:
+                stats = FILTER_STATS.setdefault(f, FilterStats())
+        return stats
+    except TypeError:
+        # Builtins can't be weakly referenced, they just don't get measured
+        return FilterStats()
+
+
+def cost_hint(cost):
+    """Decorator for filters: sets the relative cost of evaluating it.
+
+    It also marks the filter as side-effect free and independent of the filters around it,
+    so it can be evaluated in any order and memoized. Filters without one (BaseFilters
+    included) are left where they are, e.g. a guard like `Filters.reply` stays in front of
+    the filters that read `reply_to_message`. BaseFilter subclasses can set a `cost`
+    class attribute instead."""
+    def decorator(f):
+        f.cost = cost
+        return f
+    return decorator
+
+
+def is_reorderable(f):
+    return hasattr(f, 'cost')
+
+
+class FilterContext(object):
+    __slots__ = ('results',)
+
+    def __init__(self):
+        self.results = {}
+
+
+@contextmanager
+def evaluation_context(message):
+    """Memoize filter results for message while the block runs.
+
+    Every handler evaluating the same filter object on this message gets the cached result."""
+    if message is None:
+        yield None
+        return
+    key = id(message)
+    context = _CONTEXTS.get(key)
+    if context is not None:
+        # Already being dispatched, share the outer context
+        yield context
+        return
+    context = _CONTEXTS[key] = FilterContext()
+    try:
+        yield context
+    finally:
+        _CONTEXTS.pop(key, None)
+
+
+def seed_results(message, results):
+    """Record already known filter results ({id(filter): result}) for message."""
+    context = _CONTEXTS.get(id(message))
+    if context is not None:
+        for key, value in results.items():
+            context.results.setdefault(key, value)
+
+
+def evaluate(f, message):
+    """Evaluate a filter, memoized if message is being dispatched. Records cost and selectivity.
+
+    Only side-effect free filters (see `is_reorderable`) get memoized."""
+    context = _CONTEXTS.get(id(message)) if is_reorderable(f) else None
+    if context is not None:
+        key = id(f)
+        if key in context.results:
+            return context.results[key]
+    start = time.perf_counter()
+    result = f(message)
+    # Not locked, the stats only have to be roughly right
+    stats = stats_for(f)
+    stats.calls += 1
+    stats.elapsed += time.perf_counter() - start
+    if result:
+        stats.passes += 1
+    if context is not None:
+        context.results[key] = result
+    return result
+
+
+class FilterGroup(BaseFilter):
+    def __init__(self, *filters, strict=True):
+        """Combines filters, evaluating them cheapest and most decisive first.
+
+        :param strict: if True, all filters must pass (AND), else any of them (OR).
+
+        Filters are reordered only among neighbouring filters that declared a cost (see
+        `cost_hint`), other filters keep their position. The order comes from the cost
+        hints at first, then from measured cost and pass rates once there's enough data."""
+        if len(filters) == 1 and isinstance(filters[0], (list, tuple)):
+            filters = filters[0]
+        self.filters = list(filters)
+        self.strict = strict
+        self.ordered = self.order()
+        self.evaluations = 0
+
+    def score(self, f, measured):
+        if measured:
+            stats = stats_for(f)
+            # AND: prefer the ones that fail the most, OR: the ones that pass the most
+            decisive = 1 - stats.pass_rate if self.strict else stats.pass_rate
+            return stats.cost / max(decisive, 0.001)
+        return getattr(f, 'cost', DEFAULT_COST)
+
+    def order(self):
+        ordered = []
+        run = []
+        for f in self.filters + [None]:
+            if f is not None and is_reorderable(f):
+                run.append(f)
+                continue
+            if run:
+                measured = all(stats_for(r).calls >= MIN_SAMPLES for r in run)
+                ordered.extend(sorted(run, key=lambda r: self.score(r, measured)))
+                run = []
+            if f is not None:
+                ordered.append(f)
+        return ordered
+
+    def filter(self, message):
+        self.evaluations += 1
+        if self.evaluations % REORDER_INTERVAL == 0:
+            self.ordered = self.order()
+        if self.strict:
+            return all(evaluate(f, message) for f in self.ordered)
+        return any(evaluate(f, message) for f in self.ordered)
+
+
+class All(FilterGroup):
+    def __init__(self, *filters):
+        super(All, self).__init__(*filters, strict=True)
+
+
+class Any(FilterGroup):
+    def __init__(self, *filters):
+        super(Any, self).__init__(*filters, strict=False)
+
+
 class RegexpFilter(BaseFilter):
+    cost = 5.0
+
     def __init__(self, pattern, mode='match', **options):
         """Takes a pattern, and returns a match object if it complies.
 
@@ -41,3 +232,75 @@ class MultiRegexpFilter(RegexpFilter):
                                            for name, pattern in patterns.items()]))
         elif isinstance(patterns, list):
             return "({})".format('|'.join(patterns))
+
+
+def is_plain_regexp_filter(f):
+    """True for RegexpFilters that behave exactly like `pattern.match(message.text)`"""
+    cls = type(f)
+    return (isinstance(f, RegexpFilter) and cls.filter is RegexpFilter.filter
+            and cls.__call__ is BaseFilter.__call__)
+
+
+class RegexpFilterSet(object):
+    def __init__(self, filters):
+        """Evaluates many RegexpFilters against a text in a single pass.
+
+        Patterns sharing the same flags are merged into one expression, where each pattern
+        sits in its own optional lookahead with a named group. One `match` call then tells
+        which of them match at the start of the text, just like `RegexpFilter.filter` does.
+
+        Patterns that can't be safely embedded (backreferences, conditionals, global inline
+        flags, clashing group names) are kept apart and matched one by one."""
+        self.filters = []
+        self.combined = []
+        self.separate = []
+        by_flags = defaultdict(list)
+        for f in filters:
+            if any(f is known for known in self.filters):
+                continue
+            self.filters.append(f)
+            if NOT_COMBINABLE.search(f.pattern.pattern):
+                self.separate.append(f)
+            else:
+                by_flags[f.pattern.flags].append(f)
+
+        for flags, group in by_flags.items():
+            names = {}
+            parts = []
+            for f in group:
+                name = '_mrvf{}'.format(len(parts))
+                part = '(?:(?=(?P<{}>{}))|)'.format(name, f.pattern.pattern)
+                try:
+                    re.compile(''.join(parts + [part]), flags)
+                except re.error:
+                    self.separate.append(f)
+                    continue
+                parts.append(part)
+                names[name] = f
+            if names:
+                self.combined.append((re.compile(''.join(parts), flags), names))
+        log.debug("Combined %d regexp filters into %d patterns, %d kept separate",
+                  len(self.filters), len(self.combined), len(self.separate))
+
+    def seed(self, message, matched):
+        """Record the outcome of `matching` for every filter in this set."""
+        seed_results(message, {id(f): id(f) in matched for f in self.filters})
+
+    def matching(self, text):
+        """Returns the ids of the filters in this set that match text."""
+        if text is None:
+            return set()
+        result = set()
+        for pattern, names in self.combined:
+            # Never fails, every lookahead is optional
+            match = pattern.match(text)
+            for name, f in names.items():
+                if match.group(name) is not None:
+                    result.add(id(f))
+        for f in self.separate:
+            if f.pattern.match(text):
+                result.add(id(f))
+        return result
+
+    def __len__(self):
+        return len(self.filters)
@@ -1,4 +1,5 @@
 import argparse
+import asyncio
 import logging
 import abc
 
@@ -6,6 +7,8 @@ from telegram.ext.filters import Filters
 from marvinbot.models import User
 from marvinbot.utils import get_message
 from marvinbot.core import get_adapter
+from marvinbot.argparsing import FastPathParser
+from marvinbot.filters import FilterGroup
 from datetime import datetime
 
 
@@ -13,6 +16,10 @@ log = logging.getLogger(__name__)
 
 
 class Handler(object, metaclass=abc.ABCMeta):
+    # Set by Adapter.add_handler
+    executor = None
+    process_key = None
+
     def __init__(self, callback, adapter=None, allow_edits=True, discard_threshold=300,
                  is_final=True):
         """Initialize this handler.
@@ -30,6 +37,11 @@ class Handler(object, metaclass=abc.ABCMeta):
         self.adapter = adapter or get_adapter()
         self.is_final = is_final
 
+    @property
+    def is_coroutine(self):
+        """True if the callback is a coroutine function and needs to be awaited."""
+        return asyncio.iscoroutinefunction(self.callback)
+
     def get_registered_user(self, message):
         """Return a registered User instance for message.
 
@@ -66,8 +78,10 @@ class Handler(object, metaclass=abc.ABCMeta):
 
         Callbacks are expected to get a hold of the adapter (it's a singleton).
         Override if you need to do anything other than calling the callback and then
-        call the parent class method."""
-        self.callback(update, *args, **kwargs)
+        call the parent class method.
+
+        :returns: whatever the callback returns, which is an awaitable for coroutine callbacks."""
+        return self.callback(update, *args, **kwargs)
 
 
 class ArgumentParsingError(Exception):
@@ -97,6 +111,7 @@ class CommandHandler(Handler):
         self._arg_parser = BotArgumentParser(prog='/{}'.format(self.command),
                                              description=command_description,
                                              epilog=command_epilog, add_help=False)
+        self._fast_parser = FastPathParser(self._arg_parser)
         self.description = command_description
         if required_roles:
             if not isinstance(required_roles, list):
@@ -117,8 +132,10 @@ class CommandHandler(Handler):
         return self._arg_parser.add_argument_group(*args, **kwargs)
 
     def parse_arguments(self, args):
-        """Parses a list of arguments, returns a tuple of (kwargs, args)."""
-        return self._arg_parser.parse_known_args(args)
+        """Parses a list of arguments, returns a tuple of (kwargs, args).
+
+        Simple argument specs skip argparse, see `FastPathParser`."""
+        return self._fast_parser.parse_known_args(args)
 
     def format_help(self):
         return self._arg_parser.format_help()
@@ -163,7 +180,7 @@ class CommandHandler(Handler):
         # Convert to a dict
         params = vars(params)
 
-        super(CommandHandler, self).process_update(update, *args, **params)
+        return super(CommandHandler, self).process_update(update, *args, **params)
 
     def __str__(self):
         return self.command
@@ -173,7 +190,10 @@ class MessageHandler(Handler):
     def __init__(self, filters, callback, strict=True, *args, **kwargs):
         """Handler that responds to messages based on whether they match filters.
 
-        :param strict: If True, message must match ALL filters."""
+        :param strict: If True, message must match ALL filters.
+
+        Filters are evaluated cheapest and most decisive first (see `marvinbot.filters.FilterGroup`),
+        and side-effect free ones are evaluated once per update, no matter how many handlers use them."""
         if not filters:
             raise ValueError('At least one filter is required')
 
@@ -182,13 +202,11 @@ class MessageHandler(Handler):
         else:
             self.filters = [filters]
         self.strict = strict
+        self.filter_group = FilterGroup(self.filters, strict=strict)
         super(MessageHandler, self).__init__(callback, *args, **kwargs)
 
     def validate(self, message):
-        if self.strict:
-            return all(f(message) for f in self.filters)
-        else:
-            return any(f(message) for f in self.filters)
+        return self.filter_group.filter(message)
 
     def __str__(self):
         return str(self.filters)
@@ -0,0 +1,120 @@
+from marvinbot.defaults import DEFAULT_PRIORITY
+from marvinbot.filters import RegexpFilter
+from marvinbot.handlers import CommandHandler, CallbackQueryHandler, MessageHandler
+from marvinbot.plugins import Plugin, load_module
+from marvinbot.signals import plugin_loaded
+import threading
+import weakref
+import logging
+
+
+log = logging.getLogger(__name__)
+
+
+__all__ = ['LazyPluginLoader']
+
+
+def _not_loaded(update, *args, **kwargs):
+    # Stubs never call their callback
+    raise RuntimeError('Plugin not loaded yet')
+
+
+class LazyHandlerMixin(object):
+    loader = None
+
+    def process_update(self, update, *args, **kwargs):
+        return self.loader.dispatch(update)
+
+
+class LazyCommandHandler(LazyHandlerMixin, CommandHandler):
+    pass
+
+
+class LazyCallbackQueryHandler(LazyHandlerMixin, CallbackQueryHandler):
+    pass
+
+
+class LazyMessageHandler(LazyHandlerMixin, MessageHandler):
+    pass
+
+
+class LazyPluginLoader(object):
+    def __init__(self, modspec, config, adapter, manifest):
+        """Stands in for a plugin until one of its handlers is needed.
+
+        The manifest lists the handlers the plugin would register, and stubs are registered
+        in their place. The first update one of them accepts imports and loads the real plugin,
+        swaps the stubs for the real handlers and hands them the update. Manifest format:
+
+            {"name": "weather", "handlers": [
+                {"command": "weather", "description": "Weather report", "priority": 100},
+                {"callback": "weather:"},
+                {"regexps": ["^hi\\b"], "strict": false}
+            ]}
+        """
+        self.modspec = modspec
+        self.config = config
+        self.adapter = adapter
+        self.manifest = manifest
+        name = config.get('short_name') or manifest.get('name') or modspec
+        self.plugin = Plugin(name, enabled=config.get('enabled', True), config=config)
+        self.plugin.modspec = modspec
+        self.plugin.adapter = adapter
+        self.stubs = []
+        self.loaded = None
+        self.lock = threading.Lock()
+        # Updates already handed to the real handlers, in case several stubs accepted them
+        self.dispatched = weakref.WeakSet()
+
+    def make_stub(self, spec):
+        kwargs = {'adapter': self.adapter}
+        if 'is_final' in spec:
+            kwargs['is_final'] = spec['is_final']
+        if 'command' in spec:
+            stub = LazyCommandHandler(spec['command'], _not_loaded,
+                                      command_description=spec.get('description'), **kwargs)
+        elif 'callback' in spec:
+            stub = LazyCallbackQueryHandler(spec['callback'], _not_loaded, **kwargs)
+        elif 'regexps' in spec:
+            stub = LazyMessageHandler([RegexpFilter(pattern) for pattern in spec['regexps']], _not_loaded,
+                                      strict=spec.get('strict', True), **kwargs)
+        else:
+            raise ValueError('Manifest handlers need one of: command, callback, regexps')
+        stub.loader = self
+        return stub
+
+    def register(self):
+        self.adapter.add_plugin(self.plugin)
+        for spec in self.manifest.get('handlers', []):
+            stub = self.make_stub(spec)
+            self.adapter.add_handler(stub, priority=spec.get('priority', DEFAULT_PRIORITY), plugin=self.plugin)
+            self.stubs.append(stub)
+        log.info("Registered %d handlers for plugin [%s], it will be loaded on first use",
+                 len(self.stubs), self.plugin.name)
+
+    def load(self):
+        """Import and load the real plugin, only the first call does anything."""
+        with self.lock:
+            if self.loaded is not None:
+                return self.loaded
+            log.info("Loading plugin [%s] on demand", self.plugin.name)
+            config = dict(self.config)
+            config['enabled'] = self.plugin.enabled
+            plugin = load_module(self.modspec, config, self.adapter)
+            if plugin.name != self.plugin.name:
+                self.adapter.plugin_registry.pop(self.plugin.name, None)
+            for stub in self.stubs:
+                self.adapter.remove_handler(stub)
+            self.loaded = plugin
+        log.info("Plugin [%s] loaded on demand in %.3fs", plugin.name, sum(plugin.timings.values()))
+        plugin_loaded.send(plugin)
+        return plugin
+
+    def dispatch(self, update):
+        """Load the plugin and give update to its handlers, through the adapter's own loop."""
+        plugin = self.load()
+        with self.lock:
+            if update in self.dispatched:
+                return None
+            self.dispatched.add(update)
+        self.adapter.dispatch_to(update, self.adapter.handlers_for_plugin(plugin))
@@ -2,6 +2,7 @@ from uuid import uuid5, NAMESPACE_X500
 from passlib.context import CryptContext
 from marvinbot.utils import localized_date
 from marvinbot.utils.mongoengine import EnumField
+from marvinbot.utils.lru import LRUCache
 from marvinbot.defaults import (
     DEFAULT_ROLE, ADMIN_ROLE, OWNER_ROLE,
     POWER_USERS, RoleType
@@ -21,6 +22,37 @@ def hash_password(pwd):
 def verify_password(pwd, hsh):
     return bot_security_context.verify(pwd, hsh)
 
+USER_CACHE_DEFAULTS = {
+    'max_size': 10000,
+    'ttl': 300,
+}
+
+# Fields taken from telegram.User, see `User.from_telegram`
+USER_FIELDS = ('first_name', 'last_name', 'username')
+
+# user id -> raw document (or None if there's no such user)
+USER_CACHE = LRUCache(**USER_CACHE_DEFAULTS)
+_MISSING = object()
+
+
+def configure_user_cache(config):
+    """Sets up the User read-through cache.
+
+    Changes made through `User.save`/`User.delete` are written through, anything else
+    (e.g. `User.objects(...).update(...)`) shows up after at most `ttl` seconds."""
+    global USER_CACHE
+
+    cconfig = {}
+    cconfig.update(USER_CACHE_DEFAULTS)
+    cconfig.update(config.get('user_cache', {}))
+    USER_CACHE = LRUCache(max_size=cconfig.get('max_size'), ttl=cconfig.get('ttl'))
+    return USER_CACHE
+
+
+# Updates to any of these change `banned`, see `UserQuerySet`
+BAN_UPDATES = ('banned', 'set__banned', 'unset__banned')
+
+
 def make_token(user):
     date = localized_date()
     # Automatically expires different after an hour
@@ -28,6 +60,23 @@ def make_token(user):
                                                date.strftime('%Y%m%d%h')])))
 
 
+class UserQuerySet(mongoengine.QuerySet):
+    """Stamps `ban_updated` on updates that change `banned`, so `BannedUserSet.sync` sees
+    them. Raw (`__raw__`) updates still have to set it themselves."""
+
+    @staticmethod
+    def _with_ban_updated(update):
+        if any(key in update for key in BAN_UPDATES) and 'set__ban_updated' not in update:
+            update = dict(update, set__ban_updated=localized_date())
+        return update
+
+    def update(self, *args, **update):
+        return super(UserQuerySet, self).update(*args, **self._with_ban_updated(update))
+
+    def modify(self, *args, **update):
+        return super(UserQuerySet, self).modify(*args, **self._with_ban_updated(update))
+
+
 class User(mongoengine.Document):
     id = mongoengine.LongField(primary_key=True)
     first_name = mongoengine.StringField()
@@ -39,18 +88,74 @@ class User(mongoengine.Document):
     # TODO: Implement proper groups
     role = EnumField(RoleType, default=DEFAULT_ROLE)
     banned = mongoengine.BooleanField(default=False)
+    # Last time `banned` changed, lets other processes pick up ban changes incrementally
+    ban_updated = mongoengine.DateTimeField()
     auth_token = mongoengine.StringField()
 
+    meta = {
+        'queryset_class': UserQuerySet,
+        'indexes': [
+            {'fields': ['ban_updated'], 'sparse': True},
+        ]
+    }
+
+    def set_banned(self, banned=True):
+        self.banned = banned
+        self.ban_updated = localized_date()
+
     def is_admin(self):
         # TODO: Actually check groups
         return self.role in POWER_USERS
 
+    @classmethod
+    def _from_cache(cls, son):
+        # Build a fresh instance every time, so callers can't modify each other's copy
+        return cls._from_son(dict(son)) if son is not None else None
+
     @classmethod
     def by_id(cls, user_id):
+        son = USER_CACHE.get(user_id, _MISSING)
+        if son is not _MISSING:
+            return cls._from_cache(son)
         try:
-            return cls.objects.get(id=user_id)
+            user = cls.objects.get(id=user_id)
         except cls.DoesNotExist:
-            return None
+            user = None
+        USER_CACHE.set(user_id, user.to_mongo() if user else None)
+        return user
+
+    @classmethod
+    def by_ids(cls, user_ids):
+        """Fetch many users at once, returns a dict of id -> User for the ones that exist.
+
+        Users not in the cache are fetched with a single query."""
+        result = {}
+        missing = []
+        for user_id in set(user_ids):
+            son = USER_CACHE.get(user_id, _MISSING)
+            if son is _MISSING:
+                missing.append(user_id)
+            elif son is not None:
+                result[user_id] = cls._from_cache(son)
+        if missing:
+            found = {user.id: user for user in cls.objects(id__in=missing)}
+            for user_id in missing:
+                user = found.get(user_id)
+                USER_CACHE.set(user_id, user.to_mongo() if user else None)
+                if user:
+                    result[user_id] = user
+        return result
+
+    def save(self, *args, **kwargs):
+        if (self._created and self.banned) or 'banned' in self._get_changed_fields():
+            self.ban_updated = localized_date()
+        result = super(User, self).save(*args, **kwargs)
+        USER_CACHE.set(self.id, self.to_mongo())
+        return result
+
+    def delete(self, *args, **kwargs):
+        USER_CACHE.pop(self.id)
+        return super(User, self).delete(*args, **kwargs)
 
     @classmethod
     def by_username(cls, username):
@@ -67,8 +172,14 @@ class User(mongoengine.Document):
         return u.is_admin()
 
     @classmethod
-    def from_telegram(cls, user_data, save=False):
+    def from_telegram(cls, user_data, save=False, buffered=False):
+        """Returns (user, created) for a telegram.User.
+
+        :param buffered: record new users and name changes through the upsert buffer,
+            written in bulk a moment later instead of right away."""
         prev = cls.by_id(user_data.id)
+        if buffered:
+            return cls._buffer_upsert(user_data, prev)
         if prev:
             return prev, False
         user = cls(id=user_data.id, first_name=user_data.first_name, last_name=user_data.last_name,
@@ -77,6 +188,26 @@ class User(mongoengine.Document):
             user.save()
         return user, True
 
+    @classmethod
+    def _buffer_upsert(cls, user_data, prev):
+        from marvinbot.userupserts import get_user_upserts
+
+        fields = {field: getattr(user_data, field) for field in USER_FIELDS}
+        if prev:
+            changed = {field: value for field, value in fields.items() if getattr(prev, field) != value}
+            if not changed:
+                return prev, False
+            user = prev
+            for field, value in changed.items():
+                setattr(user, field, value)
+        else:
+            changed = fields
+            user = cls(id=user_data.id, **fields)
+        get_user_upserts().add(user_data.id, **changed)
+        # Don't look for it in the database again before it's written
+        USER_CACHE.set(user.id, user.to_mongo())
+        return user, prev is None
+
     def check_password(self, password):
         """Check if the password is correct"""
         if not self.password:
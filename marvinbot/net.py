@@ -1,84 +1,623 @@
-from marvinbot.errors import DownloadException
+from marvinbot.errors import DownloadException, DownloadCancelled, DownloadTimeout
+from marvinbot.filecache import FileCache
 from marvinbot.utils import localized_date
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import ThreadPoolExecutor, Future
 from functools import partial
+from collections import deque
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import threading
+import tempfile
+import asyncio
+import hashlib
 import logging
 import requests
+import sqlite3
+import shutil
+import fcntl
+import time
 import os
 
 
 DOWNLOADER_DEFAULTS = {
     "download_path": os.path.abspath("var/files"),
-    "workers": 2
+    "workers": 2,
+    # Hosts to keep connections for, and connections kept per host
+    "pool_connections": 10,
+    "pool_maxsize": 10,
+    # Retries for connection errors and 429/5xx responses, waiting backoff_factor * 2^n between them
+    "retries": 3,
+    "backoff_factor": 0.5,
+    "connect_timeout": 10,
+    "read_timeout": 60,
+    # Bounds for the chunk size picked from the response size
+    "min_chunk_size": 64 * 1024,
+    "max_chunk_size": 1024 * 1024,
+    # Store files with the same content once, hardlinked from every path they were saved as
+    "dedupe": True,
+    # Byte ranges fetched at once for large files, 1 to download them in a single stream
+    "parallel_chunks": 1,
+    "parallel_min_size": 8 * 1024 * 1024,
+    # Times a dropped download is resumed from where it stopped
+    "resume_attempts": 3,
+    # Bytes the download path can take up, least recently used files are deleted past it. 0 for no limit
+    "quota": 0,
+    # Other processes (update queue workers, handler processes) download to the same path,
+    # check the index against the disk on lookups, see `marvinbot.filecache.FileCache`
+    "shared_index": True,
 }
 
 DOWNLOAD_PATH = DOWNLOADER_DEFAULTS.get('download_path')
 WORKERS = None
+FILE_CACHE = None
+SESSION = None
+DOWNLOADER_CONFIG = dict(DOWNLOADER_DEFAULTS)
+_SESSION_LOCK = threading.Lock()
 
-METHOD_MAP = {
-    'get': requests.get,
-    'delete': requests.delete,
-    'put': requests.put,
-    'post': requests.post,
-    'patch': requests.patch,
-}
+METHODS = ('get', 'delete', 'put', 'post', 'patch')
+# Suffix of the files being downloaded, renamed once complete
+PARTIAL_SUFFIX = '.part'
+# Next to a resumable `.part` file: what identifies the version being downloaded, and who's downloading it
+VALIDATOR_SUFFIX = '.validator' + PARTIAL_SUFFIX
+LOCK_SUFFIX = '.lock' + PARTIAL_SUFFIX
+# Directory under the download path with a file per content hash, see `store_content`
+OBJECTS_DIR = '.objects'
+
+# Downloads in progress, by target path or telegram file_id
+_IN_FLIGHT = {}
+_IN_FLIGHT_LOCK = threading.Lock()
 
 
 log = logging.getLogger(__name__)
 
 
-__all__ = ['fetch_from_telegram', 'download_file', 'configure_downloader']
+__all__ = ['fetch_from_telegram', 'download_file', 'configure_downloader', 'pin_file', 'get_file_cache',
+           'download', 'fetch_telegram', 'iter_download', 'iter_download_async', 'DownloadFuture']
 
 
 def fetch_from_telegram(adapter, file_id, target_filename=None, on_done=None, file_prefix='telegram'):
-    target = target_filename or file_id
-    target = make_path(file_prefix, target)
-    if os.path.exists(target):
-        # Already got it
-        if on_done:
-            on_done(target)
+    """Download a file sent to the bot, returns (path, is_async). See `fetch_telegram`."""
+    future = fetch_telegram(adapter, file_id, target_filename=target_filename, file_prefix=file_prefix,
+                            on_done=on_done)
+    return wait_inline(future)
+
+
+def fetch_telegram(adapter, file_id, target_filename=None, file_prefix='telegram', on_done=None, deadline=None):
+    """Download a file sent to the bot, returns a DownloadFuture for its path."""
+    target = make_path(file_prefix, target_filename or file_id)
+    if target in get_file_cache():
         log.info("%s already exists, returning existing copy", target)
-        return target, False
-    telegram_file = adapter.bot.getFile(file_id)
-    future, is_async = execute_async(on_done, save_from_telegram, telegram_file, target)
-    return target, is_async
+        return DownloadFuture.completed(target, on_done)
+    return execute_once('telegram:{}'.format(file_id), target, on_done, deadline,
+                        fetch_telegram_file, adapter, file_id, target)
+
+
+def fetch_telegram_file(adapter, file_id, target, cancelled=None):
+    try:
+        telegram_file = adapter.bot.getFile(file_id)
+    except Exception as e:
+        log.error(e)
+        raise DownloadException from e
+    if cancelled is not None and cancelled.is_set():
+        raise DownloadCancelled(file_id)
+    return save_from_telegram(telegram_file, target)
 
 
 def save_from_telegram(telegram_file, target):
+    partial_target = make_partial(target)
     try:
-        telegram_file.download(target)
-        return target
+        telegram_file.download(partial_target)
+        digest = file_digest(partial_target)
+        os.replace(partial_target, target)
     except Exception as e:
         log.error(e)
+        remove_partial(partial_target)
         raise DownloadException from e
+    return store_content(target, digest, source=telegram_file.file_id)
+
+
+def download_file(url, method='get', target_filename=None, file_prefix=None, on_done=None, **kwargs):
+    """Download url into the download path, returns (path, is_async). See `download`."""
+    future = download(url, method=method, target_filename=target_filename, file_prefix=file_prefix,
+                      on_done=on_done, **kwargs)
+    return wait_inline(future)
+
+
+def download(url, method='get', target_filename=None, file_prefix=None, on_done=None, chunk_size=None,
+             on_progress=None, parallel=None, resume=True, deadline=None, **params):
+    """Download url into the download path, returns a DownloadFuture for its path.
 
+    The future can be waited on, or awaited from a coroutine. It fails with the
+    DownloadException that stopped the download, DownloadTimeout if `deadline` seconds
+    pass first, or gets cancelled by `future.cancel()`. Params are passed on to `requests`.
 
-def download_file(url, method='get', target_filename=None, file_prefix=None,
-                  on_done=None, chunk_size=2048, **params):
+    :param on_done: (optional) function(path), called once it's downloaded.
+    :param chunk_size: bytes written at a time, picked from the response size if None.
+    :param on_progress: (optional) function(downloaded_bytes, total_bytes), total is None if unknown.
+    :param parallel: fetch files over `parallel_min_size` as this many byte ranges at once,
+        defaults to the `parallel_chunks` setting. Needs server support for Range requests.
+    :param resume: keep what was downloaded when the connection drops, and pick it up from
+        there (also on the next call for the same file)."""
+    if method not in METHODS:
+        raise ValueError('method should be one of: {}'.format(', '.join(METHODS)))
     target = target_filename or os.path.basename(url)
     filename = make_path(file_prefix, target)
 
-    if os.path.exists(filename):
-        # Already got it
-        if on_done:
-            on_done(filename)
+    if filename in get_file_cache():
         log.info("%s already exists, returning existing copy", filename)
-        return filename, False
-    r = partial(METHOD_MAP.get(method), url, **params)
-    future, is_async = execute_async(on_done, save_from_request, filename, r, chunk_size)
-    return filename, is_async
+        return DownloadFuture.completed(filename, on_done)
+    fetcher = make_fetcher(url, method, params)
+    if parallel is None:
+        parallel = DOWNLOADER_CONFIG['parallel_chunks']
+    if method != 'get':
+        parallel, resume = 1, False
+    return execute_once(filename, filename, on_done, deadline, save_from_request, filename, fetcher, chunk_size,
+                        on_progress, parallel, resume, url)
+
+
+def make_fetcher(url, method='get', params=None):
+    """Returns fetcher(headers=None), that makes the request on the shared session."""
+    params = dict(params or {})
+    params.setdefault('timeout', (DOWNLOADER_CONFIG['connect_timeout'], DOWNLOADER_CONFIG['read_timeout']))
+    session = get_session()
 
+    def fetcher(headers=None):
+        kwargs = dict(params)
+        if headers:
+            kwargs['headers'] = dict(params.get('headers') or {}, **headers)
+        return session.request(method, url, stream=True, **kwargs)
+    return fetcher
 
-def save_from_request(filename, fetcher, chunk_size):
+
+def iter_download(url, method='get', chunk_size=None, deadline=None, **params):
+    """Yields the response body in chunks, without saving it. Closing the generator
+    closes the connection."""
+    expires = time.monotonic() + deadline if deadline else None
+    with make_fetcher(url, method, params)() as response:
+        try:
+            response.raise_for_status()
+        except Exception as e:
+            raise DownloadException from e
+        chunks = response.iter_content(chunk_size or pick_chunk_size(response.headers.get('Content-Length')))
+        for chunk in chunks:
+            if expires and time.monotonic() > expires:
+                raise DownloadTimeout(url)
+            yield chunk
+
+
+async def iter_download_async(url, method='get', chunk_size=None, deadline=None, **params):
+    """`iter_download` for coroutines: the blocking reads run on WORKERS (or the loop's
+    default executor), e.g. `async for chunk in iter_download_async(url): ...`"""
+    loop = asyncio.get_event_loop()
+    chunks = iter_download(url, method=method, chunk_size=chunk_size, deadline=deadline, **params)
     try:
-        request = fetcher()
-        with open(filename, 'wb') as fd:
-            for chunk in request.iter_content(chunk_size):
-                fd.write(chunk)
-        return filename
+        while True:
+            chunk = await loop.run_in_executor(WORKERS, next, chunks, None)
+            if chunk is None:
+                return
+            yield chunk
+    finally:
+        await loop.run_in_executor(WORKERS, chunks.close)
+
+
+def wait_inline(future):
+    """(path, is_async) for the old API, waits for the download when there are no WORKERS."""
+    if not WORKERS or future.done():
+        return future.result(), False
+    return future.target, True
+
+
+class Progress(object):
+    def __init__(self, callback, cancelled=None):
+        """Reports bytes downloaded to callback(downloaded, total), from any amount of threads.
+
+        Also where the download stops once the `cancelled` Event is set."""
+        self.callback = callback
+        self.cancelled = cancelled
+        self.downloaded = 0
+        self.total = None
+        self.lock = threading.Lock()
+
+    def start(self, total, downloaded=0):
+        with self.lock:
+            self.total = total
+            self.downloaded = downloaded
+        self.add(0)
+
+    def add(self, size):
+        if self.cancelled is not None and self.cancelled.is_set():
+            raise DownloadCancelled()
+        if not self.callback:
+            return
+        with self.lock:
+            self.downloaded += size
+            try:
+                self.callback(self.downloaded, self.total)
+            except Exception as e:
+                # Not worth failing the download over
+                log.exception(e)
+
+
+def save_from_request(filename, fetcher, chunk_size=None, on_progress=None, parallel=1, resume=False,
+                      source=None, cancelled=None):
+    """Write the response body to filename. It's written to a `.part` file first, so
+    `filename` only exists once it's complete.
+
+    `fetcher(headers=None)` makes the request, with extra headers for Range requests
+    when resuming or fetching in parallel."""
+    # A stable name lets a later attempt find it. `execute_once` keeps this process from
+    # downloading it twice, the lock keeps other processes off it
+    lock = lock_partial(filename) if resume else None
+    if resume and lock is None:
+        log.info("%s is being downloaded by another process, not resuming", filename)
+        resume = False
+    partial_filename = filename + PARTIAL_SUFFIX if resume else make_partial(filename)
+    validator_filename = filename + VALIDATOR_SUFFIX if resume else None
+    progress = Progress(on_progress, cancelled)
+    total = validator = None
+    try:
+        if parallel > 1:
+            total, validator = probe_size(fetcher)
+        if total and total >= DOWNLOADER_CONFIG['parallel_min_size']:
+            fetch_ranges(fetcher, partial_filename, total, validator, parallel, chunk_size, progress)
+            digest = None
+        else:
+            total = None
+            digest = fetch_sequential(fetcher, partial_filename, chunk_size, progress, validator_filename)
+        os.replace(partial_filename, filename)
+        if validator_filename:
+            remove_partial(validator_filename)
     except Exception as e:
         log.error(e)
+        if not resume or total:
+            # Ranges leave holes, a partial file from them can't be resumed
+            remove_partial(partial_filename)
+            if validator_filename:
+                remove_partial(validator_filename)
+        if isinstance(e, DownloadException):
+            raise
         raise DownloadException from e
+    finally:
+        unlock_partial(lock)
+    return store_content(filename, digest or file_digest(filename), source=source)
+
+
+def lock_partial(filename):
+    """Lock the resumable `.part` file of filename, returns the lock to pass to
+    `unlock_partial`, or None if another process holds it. Released if the process dies."""
+    lock_filename = filename + LOCK_SUFFIX
+    while True:
+        fd = os.open(lock_filename, os.O_CREAT | os.O_WRONLY)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            return None
+        try:
+            if os.fstat(fd).st_ino == os.stat(lock_filename).st_ino:
+                return fd, lock_filename
+        except FileNotFoundError:
+            pass
+        # Removed by the holder we were waiting for, take the new one
+        os.close(fd)
+
+
+def unlock_partial(lock):
+    if lock is None:
+        return
+    fd, lock_filename = lock
+    remove_partial(lock_filename)
+    os.close(fd)
+
+
+# Errors after which a download can be resumed
+RESUMABLE_ERRORS = (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError)
+
+
+def fetch_sequential(fetcher, partial_filename, chunk_size, progress, validator_filename=None):
+    """Stream the response into partial_filename, resuming from whatever it already has if
+    there's a `validator_filename` to keep what identifies that version of the file in.
+
+    Returns the sha256 of the content, if it was all downloaded in this call."""
+    resume = validator_filename is not None
+    attempts = int(DOWNLOADER_CONFIG['resume_attempts']) if resume else 0
+    while True:
+        offset = os.path.getsize(partial_filename) if resume and os.path.exists(partial_filename) else 0
+        validator = read_validator(validator_filename) if offset else None
+        if offset and not validator:
+            # Nothing to tell whether it's still the same file
+            offset = 0
+        try:
+            headers = {'Range': 'bytes={}-'.format(offset), 'If-Range': validator} if offset else None
+            with fetcher(headers=headers) as response:
+                if offset and response.status_code == 416:
+                    # It changed since, start over
+                    remove_partial(partial_filename)
+                    continue
+                response.raise_for_status()
+                if offset and response.status_code != 206:
+                    log.info("File changed or the server doesn't support resuming, starting over")
+                    offset = 0
+                elif offset and range_start(response) != offset:
+                    log.warning("Server didn't resume at %d bytes, starting over", offset)
+                    remove_partial(partial_filename)
+                    continue
+                elif offset:
+                    log.info("Resuming download at %d bytes", offset)
+                if resume and not offset:
+                    write_validator(validator_filename, response_validator(response))
+                length = response.headers.get('Content-Length')
+                progress.start(offset + int(length) if length else None, offset)
+                digest = hashlib.sha256() if not offset else None
+                with open(partial_filename, 'ab' if offset else 'wb') as fd:
+                    for chunk in response.iter_content(chunk_size or pick_chunk_size(length)):
+                        if digest:
+                            digest.update(chunk)
+                        fd.write(chunk)
+                        progress.add(len(chunk))
+            return digest.hexdigest() if digest else None
+        except RESUMABLE_ERRORS:
+            if attempts <= 0:
+                raise
+            attempts -= 1
+            log.warning("Download interrupted, resuming (%d attempts left)", attempts)
+
+
+def response_validator(response):
+    """What identifies this version of the file for If-Range: a strong ETag, or else Last-Modified."""
+    etag = response.headers.get('ETag')
+    if etag and not etag.startswith('W/'):
+        return etag
+    return response.headers.get('Last-Modified')
+
+
+def read_validator(validator_filename):
+    try:
+        with open(validator_filename) as f:
+            return f.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+
+def write_validator(validator_filename, validator):
+    if validator:
+        with open(validator_filename, 'w') as f:
+            f.write(validator)
+    else:
+        remove_partial(validator_filename)
+
+
+def range_start(response):
+    """First byte of a 206 response, None if its Content-Range can't be read."""
+    try:
+        return int(response.headers['Content-Range'].split(' ', 1)[1].split('-', 1)[0])
+    except (KeyError, IndexError, ValueError):
+        return None
+
+
+def probe_size(fetcher):
+    """Size of the response body and its validator (see `response_validator`),
+    (None, None) if the server doesn't do Range requests."""
+    try:
+        with fetcher(headers={'Range': 'bytes=0-0'}) as response:
+            content_range = response.headers.get('Content-Range', '')
+            if response.status_code != 206 or '/' not in content_range:
+                return None, None
+            return int(content_range.rsplit('/', 1)[1]), response_validator(response)
+    except (ValueError, requests.RequestException) as e:
+        log.debug("Couldn't find out the size: %s", e)
+        return None, None
+
+
+def fetch_ranges(fetcher, partial_filename, total, validator, parts, chunk_size, progress):
+    """Fetch total bytes in byte ranges, `parts` of them at a time, into partial_filename.
+
+    Ranges are taken from a shared queue by this thread and by up to `parts - 1` helpers
+    on WORKERS. This thread never waits for a helper that didn't start, so it can't
+    deadlock when it's running on WORKERS too."""
+    with open(partial_filename, 'wb') as fd:
+        fd.truncate(total)
+    size = -(-total // parts)
+    ranges = deque((start, min(start + size, total) - 1) for start in range(0, total, size))
+    progress.start(total)
+    errors = []
+    state = {'active': 0}
+    condition = threading.Condition()
+
+    def take_ranges():
+        while True:
+            with condition:
+                if not ranges or errors:
+                    return
+                start, end = ranges.popleft()
+                state['active'] += 1
+            try:
+                fetch_range(fetcher, partial_filename, start, end, validator, chunk_size, progress)
+            except BaseException as e:
+                errors.append(e)
+            finally:
+                with condition:
+                    state['active'] -= 1
+                    condition.notify_all()
+
+    if WORKERS:
+        try:
+            for _ in range(parts - 1):
+                WORKERS.submit(take_ranges)
+        except RuntimeError:
+            # Shutting down, do the rest here
+            pass
+    take_ranges()
+    with condition:
+        condition.wait_for(lambda: state['active'] == 0)
+    if errors:
+        raise errors[0]
+
+
+def fetch_range(fetcher, partial_filename, start, end, validator, chunk_size, progress):
+    position = start
+    attempts = int(DOWNLOADER_CONFIG['resume_attempts'])
+    headers = {'If-Range': validator} if validator else {}
+    while True:
+        try:
+            headers['Range'] = 'bytes={}-{}'.format(position, end)
+            with fetcher(headers=headers) as response:
+                response.raise_for_status()
+                if response.status_code != 206:
+                    raise DownloadException('Server ignored the Range header, or the file changed')
+                if range_start(response) != position:
+                    raise DownloadException('Server sent the wrong range')
+                with open(partial_filename, 'r+b') as fd:
+                    fd.seek(position)
+                    for chunk in response.iter_content(chunk_size or pick_chunk_size(end - start + 1)):
+                        fd.write(chunk)
+                        position += len(chunk)
+                        progress.add(len(chunk))
+            return
+        except RESUMABLE_ERRORS:
+            if attempts <= 0:
+                raise
+            attempts -= 1
+
+
+def pick_chunk_size(content_length):
+    """About 64 chunks per file, between min_chunk_size and max_chunk_size."""
+    low, high = DOWNLOADER_CONFIG['min_chunk_size'], DOWNLOADER_CONFIG['max_chunk_size']
+    try:
+        size = int(content_length) // 64
+    except (TypeError, ValueError):
+        # Unknown size
+        return low
+    return max(low, min(high, size))
+
+
+def make_partial(filename):
+    """Name for a file to download filename into, unique so concurrent writers don't mix."""
+    fd, partial_filename = tempfile.mkstemp(prefix=os.path.basename(filename) + '.',
+                                            suffix=PARTIAL_SUFFIX, dir=os.path.dirname(filename))
+    os.close(fd)
+    return partial_filename
+
+
+def file_digest(filename):
+    digest = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for block in iter(partial(f.read, 1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def content_path(digest):
+    return os.path.join(DOWNLOAD_PATH, OBJECTS_DIR, digest[:2], digest)
+
+
+def store_content(filename, digest, source=None):
+    """Index filename by its content hash. If the same content was already downloaded
+    (e.g. the same media sent with a different file_id), filename becomes a hardlink to
+    that copy, so it's only stored once. Returns filename.
+
+    Callers pin filename before, the cache evicts files as soon as they're added."""
+    if not DOWNLOADER_CONFIG.get('dedupe'):
+        return index_file(filename, source=source)
+    stored = content_path(digest)
+    try:
+        os.makedirs(os.path.dirname(stored), exist_ok=True)
+        try:
+            os.link(filename, stored)
+        except FileExistsError:
+            # Downloaded before, or by a download that just finished too
+            if not os.path.samefile(stored, filename):
+                link = make_partial(filename)
+                os.remove(link)
+                os.link(stored, link)
+                os.replace(link, filename)
+                log.info("%s has the same content as an existing file, stored once", filename)
+    except OSError as e:
+        # Hardlinks not supported here, keep the copy
+        log.warning("Not deduplicating %s: %s", filename, e)
+        digest = None
+    return index_file(filename, source=source, digest=digest)
+
+
+def index_file(filename, **kwargs):
+    try:
+        get_file_cache().add(filename, **kwargs)
+    except sqlite3.Error as e:
+        # e.g. another process holding the index locked for too long
+        log.error("Could not index %s: %s", filename, e)
+        raise DownloadException(filename) from e
+    return filename
+
+
+def materialize(source, target):
+    """Make target have the same content as source, with a hardlink if possible.
+
+    Like `store_content`, callers pin target before."""
+    if source == target:
+        return target
+    partial_target = make_partial(target)
+    os.remove(partial_target)
+    try:
+        os.link(source, partial_target)
+        get_file_cache().add_alias(source, target)
+    except OSError:
+        shutil.copyfile(source, partial_target)
+        get_file_cache().add(target)
+    except sqlite3.Error as e:
+        log.error("Could not index %s: %s", target, e)
+        remove_partial(partial_target)
+        raise DownloadException(target) from e
+    os.replace(partial_target, target)
+    return target
+
+
+def get_file_cache():
+    """The index of the files in the download path, created on first use."""
+    global FILE_CACHE
+    if FILE_CACHE is None:
+        with _SESSION_LOCK:
+            if FILE_CACHE is None:
+                FILE_CACHE = make_file_cache(DOWNLOADER_CONFIG)
+    return FILE_CACHE
+
+
+def make_file_cache(dconfig):
+    return FileCache(DOWNLOAD_PATH, quota=dconfig.get('quota'), objects_dir=OBJECTS_DIR,
+                     shared=dconfig.get('shared_index'))
+
+
+def pin_file(filename):
+    """Context manager that keeps a downloaded file from being evicted while it's used."""
+    return get_file_cache().pin(filename)
+
+
+def remove_partial(filename):
+    try:
+        os.remove(filename)
+    except FileNotFoundError:
+        pass
+
+
+def make_session(dconfig):
+    """A requests.Session with a connection pool and retries, as described by the downloader config."""
+    retry = Retry(total=int(dconfig.get('retries')), backoff_factor=dconfig.get('backoff_factor'),
+                  status_forcelist=(429, 500, 502, 503, 504))
+    adapter = HTTPAdapter(pool_connections=int(dconfig.get('pool_connections')),
+                          pool_maxsize=int(dconfig.get('pool_maxsize')), max_retries=retry)
+    session = requests.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def get_session():
+    """The session shared by every download, created on first use."""
+    global SESSION
+    if SESSION is None:
+        with _SESSION_LOCK:
+            if SESSION is None:
+                SESSION = make_session(DOWNLOADER_CONFIG)
+    return SESSION
 
 
 def make_path(prefix, *args):
@@ -91,11 +630,158 @@ def make_path(prefix, *args):
     return os.path.abspath(path)
 
 
+class InFlight(object):
+    def __init__(self):
+        """A download in progress, and how many callers are still waiting for it."""
+        self.future = Future()
+        self.cancelled = threading.Event()
+        self.waiters = 0
+
+
+class DownloadFuture(Future):
+    def __init__(self, target, inflight=None):
+        """What download functions return: a Future for the downloaded file's path.
+
+        Several DownloadFutures can share one download, cancelling one only stops the
+        download once nobody else is waiting for it. Can be awaited in a coroutine."""
+        super(DownloadFuture, self).__init__()
+        self.target = target
+        self._inflight = inflight
+        # Reentrant, done callbacks run while it's held
+        self._settle_lock = threading.RLock()
+        self._released = False
+        self._timer = None
+
+    @classmethod
+    def completed(cls, target, on_done=None):
+        future = cls(target)
+        if on_done:
+            future.add_done_callback(done_callback(on_done))
+        future.set_result(target)
+        return future
+
+    def _settle(self, result=None, exception=None):
+        with self._settle_lock:
+            if self.done():
+                return False
+            if exception is not None:
+                self.set_exception(exception)
+            else:
+                self.set_result(result)
+        self._release()
+        return True
+
+    def _attach(self, shared):
+        """Done callback for the shared download."""
+        if self.done():
+            return
+        # Until our done callbacks have run, after that it's up to whoever uses the file
+        with pin_file(self.target):
+            try:
+                result = materialize(shared.result(), self.target)
+            except BaseException as e:
+                self._settle(exception=e)
+            else:
+                self._settle(result)
+
+    def _release(self):
+        with _IN_FLIGHT_LOCK:
+            if self._released or self._inflight is None:
+                return
+            self._released = True
+            if self._timer:
+                self._timer.cancel()
+            self._inflight.waiters -= 1
+            if self._inflight.waiters <= 0 and not self._inflight.future.done():
+                self._inflight.cancelled.set()
+
+    def set_deadline(self, seconds):
+        """Fail with DownloadTimeout if it isn't done in `seconds`."""
+        self._timer = threading.Timer(seconds, self._settle,
+                                      kwargs={'exception': DownloadTimeout(self.target)})
+        self._timer.daemon = True
+        self._timer.start()
+
+    def cancel(self):
+        with self._settle_lock:
+            cancelled = super(DownloadFuture, self).cancel()
+        if cancelled:
+            self._release()
+        return cancelled
+
+    def __await__(self):
+        return asyncio.wrap_future(self).__await__()
+
+
+def done_callback(on_done):
+    """Future callback that calls on_done with the path, with the file pinned while it runs.
+
+    Failed downloads are logged here, their exception stays with the future."""
+    def callback(future):
+        if future.cancelled():
+            return
+        error = future.exception()
+        if error is not None:
+            log.error("Download of %s failed: %s", getattr(future, 'target', None), error)
+            return
+        filename = future.result()
+        with pin_file(filename):
+            on_done(filename)
+    return callback
+
+
+def execute_once(key, target, on_done, deadline, func, *args):
+    """Run func(*args, cancelled=Event) on WORKERS (or inline), returns a DownloadFuture.
+
+    Concurrent calls with the same key share a single run of func: the first one starts
+    it, the others wait for it. If one of those wanted its file at a different target,
+    it gets a link to the downloaded one."""
+    with _IN_FLIGHT_LOCK:
+        inflight = _IN_FLIGHT.get(key)
+        owner = inflight is None or inflight.cancelled.is_set()
+        if owner:
+            inflight = InFlight()
+            _IN_FLIGHT[key] = inflight
+        inflight.waiters += 1
+
+    future = DownloadFuture(target, inflight)
+    if on_done:
+        future.add_done_callback(done_callback(on_done))
+    if deadline:
+        future.set_deadline(deadline)
+    if not owner:
+        log.info("Waiting for the download already in progress for %s", key)
+    inflight.future.add_done_callback(future._attach)
+
+    if owner:
+        def run():
+            shared = inflight.future
+            try:
+                # So the file can't be evicted before the waiters got it, see `_attach`
+                with pin_file(target):
+                    try:
+                        result = func(*args, cancelled=inflight.cancelled)
+                    except BaseException as e:
+                        shared.set_exception(e)
+                    else:
+                        shared.set_result(result)
+            finally:
+                with _IN_FLIGHT_LOCK:
+                    if _IN_FLIGHT.get(key) is inflight:
+                        del _IN_FLIGHT[key]
+
+        if WORKERS:
+            WORKERS.submit(run)
+        else:
+            run()
+    return future
+
+
 def execute_async(on_done, func, *args, **kwargs):
     if WORKERS:
         future = WORKERS.submit(func, *args, **kwargs)
         if on_done:
-            future.add_done_callback(lambda x: on_done(x.result()))
+            future.add_done_callback(done_callback(on_done))
         return future, True
     else:
         result = func(*args, **kwargs)
@@ -103,13 +789,23 @@ def execute_async(on_done, func, *args, **kwargs):
 
 
 def configure_downloader(config):
-    global DOWNLOAD_PATH, WORKERS
+    global DOWNLOAD_PATH, WORKERS, SESSION, DOWNLOADER_CONFIG, FILE_CACHE
 
     dconfig = {}
     dconfig.update(DOWNLOADER_DEFAULTS)
     dconfig.update(config.get('downloader', {}))
 
+    DOWNLOADER_CONFIG = dconfig
     DOWNLOAD_PATH = dconfig.get('download_path')
+    if SESSION is not None:
+        SESSION.close()
+    SESSION = make_session(dconfig)
+    if FILE_CACHE is not None:
+        FILE_CACHE.close()
+    FILE_CACHE = make_file_cache(dconfig)
+    if WORKERS is not None:
+        # Downloads already running on it finish, nothing new goes there
+        WORKERS.shutdown(wait=False)
     # Create an executor or not if no workers
     workers = dconfig.get('workers')
     if workers:
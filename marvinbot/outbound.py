@@ -0,0 +1,212 @@
+from marvinbot.ratelimit import get_registry
+from concurrent.futures import Future, ThreadPoolExecutor
+from collections import deque
+import threading
+import logging
+import telegram
+
+
+log = logging.getLogger(__name__)
+
+
+__all__ = ['OutboundQueue', 'configure_outbound']
+
+
+OUTBOUND_DEFAULTS = {
+    'workers': 3,
+    'coalesce': False,
+    'coalesce_max_length': 4096,
+    'coalesce_separator': '\n',
+}
+
+# Sends with any of these can't be merged with their neighbours
+NOT_COALESCIBLE = ('reply_markup', 'reply_to_message_id')
+
+
+class OutboundMessage(object):
+    __slots__ = ('method', 'args', 'kwargs', 'future')
+
+    def __init__(self, method, args, kwargs):
+        self.method = method
+        self.args = args
+        self.kwargs = kwargs
+        self.future = Future()
+
+    @property
+    def coalescible(self):
+        return (self.method == 'send_message' and not self.args
+                and not any(self.kwargs.get(k) for k in NOT_COALESCIBLE))
+
+    def same_options(self, other):
+        mine = {k: v for k, v in self.kwargs.items() if k != 'text'}
+        theirs = {k: v for k, v in other.kwargs.items() if k != 'text'}
+        return mine == theirs
+
+
+class OutboundChat(object):
+    __slots__ = ('pending', 'busy')
+
+    def __init__(self):
+        self.pending = deque()
+        self.busy = False
+
+
+class OutboundQueue(object):
+    def __init__(self, bot, workers=3, coalesce=False, coalesce_max_length=4096,
+                 coalesce_separator='\n'):
+        """Sends messages on behalf of handlers from a small pool of sender threads.
+
+        Every chat gets a FIFO that is drained by one sender at a time, so messages keep
+        their order. When the chat's rate limiter says to wait, the chat is rescheduled
+        instead of keeping a sender asleep.
+
+        Parameters:
+        - `bot`: a RateLimitedBot.
+        - `workers`: amount of sender threads.
+        - `coalesce`: merge consecutive plain text messages to the same chat that are
+          waiting in the queue into a single message.
+        - `coalesce_max_length`: never merge past this many characters (Telegram's limit).
+        """
+        self.bot = bot
+        self.coalesce = coalesce
+        self.coalesce_max_length = coalesce_max_length
+        self.coalesce_separator = coalesce_separator
+        self.executor = ThreadPoolExecutor(max_workers=int(workers))
+        self.chats = {}
+        self.lock = threading.Lock()
+        # Notified whenever a chat's queue is emptied
+        self.idle = threading.Condition(self.lock)
+        self._local = threading.local()
+        self.sent = 0
+        self.coalesced = 0
+
+    @property
+    def in_sender(self):
+        """True when called from a sender thread, e.g. from a callback of a queued message's Future"""
+        return getattr(self._local, 'sending', False)
+
+    def send_message(self, chat_id, text, **kwargs):
+        """Queue a send_message call, returns a Future for the resulting telegram.Message"""
+        return self.enqueue('send_message', chat_id=chat_id, text=text, **kwargs)
+
+    def enqueue(self, method, *args, **kwargs):
+        """Queue a call to `telegram.Bot.<method>(*args, **kwargs)`.
+
+        The target chat is taken from the `chat_id` keyword or the first positional argument."""
+        chat_id = kwargs.get('chat_id') or args[0]
+        message = OutboundMessage(method, args, kwargs)
+        with self.lock:
+            chat = self.chats.get(chat_id)
+            if chat is None:
+                chat = self.chats[chat_id] = OutboundChat()
+            chat.pending.append(message)
+            start = not chat.busy
+            chat.busy = True
+        if start:
+            self.executor.submit(self._drain, chat_id)
+        return message.future
+
+    def _take_batch(self, chat):
+        batch = [chat.pending.popleft()]
+        if not self.coalesce or not batch[0].coalescible:
+            return batch
+        length = len(batch[0].kwargs['text'])
+        while chat.pending:
+            candidate = chat.pending[0]
+            if not candidate.coalescible or not candidate.same_options(batch[0]):
+                break
+            length += len(self.coalesce_separator) + len(candidate.kwargs['text'])
+            if length > self.coalesce_max_length:
+                break
+            batch.append(chat.pending.popleft())
+        return batch
+
+    def _drain(self, chat_id, reserved=False):
+        self._local.sending = True
+        try:
+            registry = get_registry()
+            key, limit = self.bot.rate_limiter_key(chat_id)
+            while True:
+                if not reserved:
+                    bucket = registry.get(key, limit)
+                    delay = bucket.reserve()
+                    if delay:
+                        log.info("Rate limiter hit for key %s, resuming chat %s in %.2f seconds",
+                                 key, chat_id, delay)
+                        registry.delayed.call_later(delay, self._resume, bucket, chat_id)
+                        return
+                reserved = False
+
+                with self.lock:
+                    chat = self.chats[chat_id]
+                    batch = self._take_batch(chat)
+                self._send(batch)
+
+                with self.lock:
+                    if not chat.pending:
+                        chat.busy = False
+                        del self.chats[chat_id]
+                        self.idle.notify_all()
+                        return
+        except Exception as e:
+            log.exception(e)
+            self._fail(chat_id, e)
+        finally:
+            self._local.sending = False
+
+    def _resume(self, bucket, chat_id):
+        bucket.done_waiting()
+        try:
+            self.executor.submit(self._drain, chat_id, True)
+        except RuntimeError as e:
+            # Shut down while the chat was waiting on its rate limiter
+            self._fail(chat_id, e)
+
+    def _send(self, batch):
+        head = batch[0]
+        kwargs = head.kwargs
+        if len(batch) > 1:
+            kwargs = dict(kwargs)
+            kwargs['text'] = self.coalesce_separator.join(m.kwargs['text'] for m in batch)
+            self.coalesced += len(batch) - 1
+        try:
+            # Call telegram.Bot directly, the rate limiting already happened here
+            result = getattr(telegram.Bot, head.method)(self.bot, *head.args, **kwargs)
+        except Exception as e:
+            log.exception(e)
+            for message in batch:
+                message.future.set_exception(e)
+        else:
+            self.sent += 1
+            for message in batch:
+                message.future.set_result(result)
+
+    def _fail(self, chat_id, error):
+        with self.lock:
+            chat = self.chats.pop(chat_id, None)
+            self.idle.notify_all()
+        if chat:
+            for message in chat.pending:
+                message.future.set_exception(error)
+
+    def metrics(self):
+        with self.lock:
+            queued = {chat_id: len(chat.pending) for chat_id, chat in self.chats.items()}
+        return {'sent': self.sent, 'coalesced': self.coalesced, 'queued': queued}
+
+    def shutdown(self, wait=True, timeout=10):
+        """Stop the senders. With `wait`, give the queued messages up to `timeout` seconds to go out first."""
+        if wait:
+            with self.idle:
+                if not self.idle.wait_for(lambda: not self.chats, timeout):
+                    log.warning("Outbound queue shut down with messages for %d chats still queued", len(self.chats))
+        self.executor.shutdown(wait=wait)
+
+
+def configure_outbound(config, bot):
+    oconfig = {}
+    oconfig.update(OUTBOUND_DEFAULTS)
+    oconfig.update(config.get('outbound', {}))
+
+    log.info('Starting outbound queue, workers=%d, coalesce=%s', oconfig['workers'], oconfig['coalesce'])
+    return OutboundQueue(bot, **oconfig)
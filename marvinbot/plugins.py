@@ -2,20 +2,98 @@ from flask import Blueprint
 from marvinbot.defaults import DEFAULT_PRIORITY
 from marvinbot.errors import PluginLoadException
 from marvinbot.signals import plugin_loaded
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from contextlib import contextmanager
+from collections import OrderedDict
+import importlib.util
 import importlib
 import logging
+import json
+import time
+import os
 from urllib.parse import quote_plus
 
 log = logging.getLogger(__name__)
 
 
-__all__ = ['load_module', 'load_plugins', 'Plugin']
+__all__ = ['load_module', 'load_plugins', 'Plugin', 'find_manifest', 'STARTUP_PROFILE']
 
 
-def load_module(modspec, config, adapter=None, webapp=None):
+PLUGIN_LOADER_DEFAULTS = {
+    # Plugins with a manifest get imported on their first matching update, can be
+    # overriden per plugin with a `lazy` key in its configuration
+    'lazy': False,
+    # Log how long each plugin took to import/configure/setup
+    'profile': True,
+    # Configure plugins concurrently, see `load_plugins_parallel`. Opt-in: only for
+    # plugins whose `configure` doesn't depend on the order plugins are loaded in
+    'parallel': False,
+    'workers': 4,
+    # Seconds a plugin gets to configure itself before it's skipped
+    'timeout': 30,
+}
+
+# Plugin name -> {stage: seconds}, for every plugin loaded so far
+STARTUP_PROFILE = OrderedDict()
+
+
+@contextmanager
+def timed(timings, stage):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[stage] = timings.get(stage, 0) + time.perf_counter() - start
+
+
+def in_package(module, modspec):
+    """Whether module is modspec or one of its submodules."""
+    return bool(module) and (module == modspec or module.startswith(modspec + '.'))
+
+
+def has_submodule(modspec, name):
+    """Whether modspec has a `name` submodule, without importing it."""
+    try:
+        return importlib.util.find_spec('{}.{}'.format(modspec, name)) is not None
+    except ImportError:
+        # modspec isn't a package
+        return False
+
+
+def find_manifest(modspec, config):
+    """Returns the plugin's manifest: the `manifest` key in its config, or the manifest.json
+    file in the plugin package. None if there's none.
+
+    The package doesn't get imported to find it."""
+    if config.get('manifest'):
+        return config['manifest']
+    spec = importlib.util.find_spec(modspec)
+    if spec is None or not spec.submodule_search_locations:
+        return None
+    for location in spec.submodule_search_locations:
+        path = os.path.join(location, 'manifest.json')
+        if os.path.exists(path):
+            with open(path, 'r') as f:
+                return json.load(f)
+    return None
+
+
+def format_profile(profile):
+    lines = []
+    totals = {name: sum(timings.values()) for name, timings in profile.items()}
+    for name in sorted(profile, key=totals.get, reverse=True):
+        stages = ' '.join('{}={:.3f}s'.format(stage, seconds) for stage, seconds in profile[name].items())
+        lines.append('{}: {:.3f}s ({})'.format(name, totals[name], stages))
+    return '\n'.join(lines)
+
+
+def import_plugin(modspec, config, adapter=None):
+    """Import a plugin module and register its Plugin, without loading it yet."""
     enabled = config.pop('enabled', True)
     short_name = config.get('short_name')
-    mod = importlib.import_module(modspec)
+    timings = OrderedDict()
+    with timed(timings, 'import'):
+        mod = importlib.import_module(modspec)
     if hasattr(mod, 'plugin'):
         plugin = mod.plugin
     else:
@@ -26,42 +104,185 @@ def load_module(modspec, config, adapter=None, webapp=None):
     plugin.adapter = adapter
     plugin.enabled = enabled
     plugin.modspec = modspec
+    plugin.timings = timings
 
     if adapter:
         adapter.add_plugin(plugin)
+        # Handlers added while importing didn't know their plugin yet
+        adapter.adopt_handlers(plugin)
+    return plugin
+
+
+def mount_plugin(plugin, webapp, adapter=None):
+    web_interface = plugin.provide_blueprint(plugin.config)
+    if adapter:
+        web_interface.adapter = adapter
+    if web_interface:
+        plugin_path = quote_plus(plugin.name)
+        log.info(f"Mounting plugin [{plugin.name}] at path /plugins/{plugin_path}")
+        webapp.register_blueprint(web_interface, url_prefix=f'/plugins/{plugin_path}')
+
+
+def load_module(modspec, config, adapter=None, webapp=None):
+    plugin = import_plugin(modspec, config, adapter)
     plugin.load()
+    STARTUP_PROFILE[plugin.name] = plugin.timings
 
     if webapp:
-        web_interface = plugin.provide_blueprint(config)
-        if adapter:
-            web_interface.adapter = adapter
-        if web_interface:
-            plugin_path = quote_plus(plugin.name)
-            log.info(f"Mounting plugin [{plugin.name}] at path /plugins/{plugin_path}")
-            webapp.register_blueprint(web_interface, url_prefix=f'/plugins/{plugin_path}')
+        mount_plugin(plugin, webapp, adapter)
 
     return plugin
 
 
 def load_plugins(config, adapter=None, webapp=None):
-    modules_to_load = config.get("plugins")
+    modules_to_load = [module for module in config.get("plugins") or [] if module]
     plugin_configs = config.get("plugin_configuration", {})
+    loader_config = {}
+    loader_config.update(PLUGIN_LOADER_DEFAULTS)
+    loader_config.update(config.get("plugin_loader", {}))
 
-    if modules_to_load:
+    started = time.perf_counter()
+    if loader_config['parallel'] and len(modules_to_load) > 1:
+        load_plugins_parallel(modules_to_load, plugin_configs, loader_config, adapter, webapp)
+    else:
         for module in modules_to_load:
-            if module:
-                # Pass along module specific configuration, if available
+            # Pass along module specific configuration, if available
+            plugin_config = plugin_configs.get(module, {})
+            try:
+                if adapter and not webapp and plugin_config.get('lazy', loader_config['lazy']):
+                    if load_lazily(module, plugin_config, adapter):
+                        continue
+                plugin = load_module(module, plugin_config, adapter, webapp)
+                plugin_loaded.send(plugin)
+            except Exception as e:
+                # Report the error, continue loading the other plugins
+                log.warn("Plugin [{}] not loaded due to an error".format(module))
+                log.exception(e)
+
+    if loader_config['profile'] and STARTUP_PROFILE:
+        log.info("Loaded plugins in %.3fs:\n%s", time.perf_counter() - started,
+                 format_profile(STARTUP_PROFILE))
+
+
+def load_plugins_parallel(modules, plugin_configs, loader_config, adapter=None, webapp=None):
+    """Load plugins, running their `configure` and models import concurrently.
+
+    1. Plugins are imported one by one, in order (imports can register handlers).
+    2. Each plugin is prepared (configured, models imported) on a thread pool, as soon as
+       the plugins it `depends_on` are. A plugin taking longer than `timeout` seconds is
+       given up on, along with the ones depending on it.
+    3. Handlers are set up one by one, in the configured order, so they end up registered
+       exactly like the sequential loader would.
+
+    Anything a plugin does in `configure` itself (registering handlers, changing globals)
+    happens in no particular order, which is why this is off unless `parallel` is set."""
+    plugins = OrderedDict()
+    for module in modules:
+        plugin_config = plugin_configs.get(module, {})
+        try:
+            if adapter and not webapp and plugin_config.get('lazy', loader_config['lazy']):
+                if load_lazily(module, plugin_config, adapter):
+                    continue
+            plugins[module] = import_plugin(module, plugin_config, adapter)
+        except Exception as e:
+            log.warn("Plugin [{}] not loaded due to an error".format(module))
+            log.exception(e)
+
+    prepared = prepare_plugins(plugins, workers=loader_config['workers'], timeout=loader_config['timeout'])
+
+    for module, plugin in plugins.items():
+        if module not in prepared:
+            continue
+        try:
+            plugin.setup()
+            STARTUP_PROFILE[plugin.name] = plugin.timings
+            if webapp:
+                mount_plugin(plugin, webapp, adapter)
+            plugin_loaded.send(plugin)
+        except Exception as e:
+            log.warn("Plugin [{}] not loaded due to an error".format(module))
+            log.exception(e)
+
+
+def prepare_plugins(plugins, workers=4, timeout=30):
+    """Run `prepare` for every plugin ({modspec: plugin}) on a thread pool, respecting
+    `depends_on`. Returns the modspecs of the plugins that were prepared successfully."""
+    dependencies = {}
+    for module, plugin in plugins.items():
+        depends_on = plugin.get_config().get('depends_on') or plugin.depends_on or []
+        dependencies[module] = [d for d in depends_on if d in plugins]
+        missing = set(depends_on) - set(plugins)
+        if missing:
+            log.warn("Plugin [%s] depends on plugins that aren't being loaded: %s", module, sorted(missing))
+
+    done = set()
+    failed = set()
+    # Future -> (modspec, deadline)
+    running = {}
+    executor = ThreadPoolExecutor(max_workers=int(workers), thread_name_prefix='plugin-loader')
+    try:
+        while True:
+            busy = {module for module, _ in running.values()}
+            for module in plugins:
+                if module in done or module in failed or module in busy:
+                    continue
+                if any(d in failed for d in dependencies[module]):
+                    log.warn("Plugin [%s] not loaded, a plugin it depends on failed", module)
+                    failed.add(module)
+                elif all(d in done for d in dependencies[module]):
+                    future = executor.submit(plugins[module].prepare)
+                    running[future] = (module, time.monotonic() + timeout)
+            if not running:
+                blocked = [module for module in plugins if module not in done and module not in failed]
+                if blocked:
+                    log.error("Plugins %s not loaded, they depend on each other", blocked)
+                break
+
+            next_deadline = min(deadline for _, deadline in running.values())
+            finished, _ = wait(running, timeout=max(0, next_deadline - time.monotonic()),
+                               return_when=FIRST_COMPLETED)
+            for future in finished:
+                module, _ = running.pop(future)
                 try:
-                    plugin = load_module(module, plugin_configs.get(module, {}), adapter, webapp)
-                    plugin_loaded.send(plugin)
+                    future.result()
+                    done.add(module)
                 except Exception as e:
-                    # Report the error, continue loading the other plugins
                     log.warn("Plugin [{}] not loaded due to an error".format(module))
                     log.exception(e)
+                    failed.add(module)
+            now = time.monotonic()
+            for future, (module, deadline) in list(running.items()):
+                if deadline <= now:
+                    # Can't interrupt it, but we don't have to wait for it either
+                    log.error("Plugin [%s] took more than %ss to configure, not loading it", module, timeout)
+                    del running[future]
+                    failed.add(module)
+    finally:
+        executor.shutdown(wait=False)
+    return done
+
+
+def load_lazily(modspec, config, adapter):
+    """Register the handlers in the plugin's manifest, returns False if it has no manifest."""
+    from marvinbot.lazyplugins import LazyPluginLoader
+
+    timings = OrderedDict()
+    with timed(timings, 'manifest'):
+        manifest = find_manifest(modspec, config)
+        if manifest is None:
+            log.info("Plugin [%s] has no manifest, loading it now", modspec)
+            return False
+        loader = LazyPluginLoader(modspec, config, adapter, manifest)
+        loader.register()
+    STARTUP_PROFILE[loader.plugin.name] = timings
+    return True
 
 
 class Plugin(object):
     """An object representing a bot plugin"""
+    # Modspecs of the plugins that have to be configured before this one
+    depends_on = ()
+
     def __init__(self, name=None, enabled=True, config=None):
         self.name = name
 
@@ -70,6 +291,7 @@ class Plugin(object):
         self.modspec = None
         self.adapter = None
         self.enabled = enabled
+        self.timings = OrderedDict()
 
     def get_default_config(self) -> dict:
         """Returns a dict with the default config for the plugin.
@@ -104,14 +326,14 @@ class Plugin(object):
         pass
 
     def _do_load_models(self):
+        if not has_submodule(self.modspec, 'models'):
+            return
         try:
             log.info('[%s] Attempting to import models', self.name)
-            models_mod = importlib.import_module(self.modspec + ".models")
+            importlib.import_module(self.modspec + ".models")
         except Exception as e:
-            # Suppress these, as they are not helpful in case the plugin just doesn't have this.
-            if "No module named" not in str(e):
-                log.warn('[%s] No models loaded for [%s]', self.name, self.module)
-                log.exception(e)
+            log.warn('[%s] No models loaded for [%s]', self.name, self.module)
+            log.exception(e)
 
     def _do_setup_handlers(self):
         try:
@@ -122,16 +344,16 @@ class Plugin(object):
             else:
                 log.warn("[%s] Not loading schedules because inhibit_schedules==True", self.name)
 
+            if not has_submodule(self.modspec, 'tasks'):
+                return
             tasks_mod = importlib.import_module(self.modspec + ".tasks")
             if hasattr(tasks_mod, 'setup'):
                 tasks_mod.setup(self.adapter)
             if self.adapter.scheduler_available and hasattr(tasks_mod, 'setup_schedules'):
-                tasks_mod.setup_schedulers(self.adapter)
+                tasks_mod.setup_schedules(self.adapter)
         except Exception as e:
-            # Module has no tasks, ignore
-            if "No module named" not in str(e):
-                log.warn('[%s] No handlers loaded for [%s]', self.name, self.module)
-                log.exception(e)
+            log.warn('[%s] No handlers loaded for [%s]', self.name, self.module)
+            log.exception(e)
 
     def setup_handlers(self, adapter):
         """Override this to setup handlers directly from this plugin"""
@@ -142,16 +364,44 @@ class Plugin(object):
         pass
 
     def load(self):
+        self.prepare()
+        self.setup()
+
+    def prepare(self):
+        """Import, configure and load the models, safe to run alongside other plugins."""
         log.info("Loading plugin [%s]", self.name)
         if not self.modspec:
             raise ValueError('Modspec is required')
-        self.module = importlib.import_module(self.modspec)
-        self._do_configure()
-        self._do_load_models()
-        self._do_setup_handlers()
+        with timed(self.timings, 'import'):
+            self.module = importlib.import_module(self.modspec)
+        with timed(self.timings, 'configure'):
+            self._do_configure()
+        with timed(self.timings, 'models'):
+            self._do_load_models()
+
+    def setup(self):
+        """Register handlers and schedules."""
+        with timed(self.timings, 'handlers'):
+            self._do_setup_handlers()
+
+    def add_handler(self, handler, priority=DEFAULT_PRIORITY, executor=None):
+        """Register a handler for this plugin, pass executor="process" for CPU heavy handlers."""
+        self.adapter.add_handler(handler, priority=priority, plugin=self, executor=executor)
 
-    def add_handler(self, handler, priority=DEFAULT_PRIORITY):
-        self.adapter.add_handler(handler, priority=priority, plugin=self)
+    @property
+    def state(self):
+        """This plugin's persistent state, e.g. `self.state.update(chat_id=chat.id, step=2)`"""
+        from marvinbot.state import get_state_store
+        return get_state_store().scope(self.name)
+
+    def add_job(self, func, *args, **kwargs):
+        """Schedule a job for this plugin, it's removed if the plugin gets reloaded."""
+        return self.adapter.add_job(func, *args, plugin=self, **kwargs)
+
+    def unload(self):
+        """Override this to release resources (threads, connections) once this instance
+        has been replaced by a reload. Its handlers and jobs are already gone by then."""
+        pass
 
     def provide_blueprint(self, config: dict) -> Blueprint:
         """Returns a flask blueprint, if the plugin provides one"""
@@ -1,9 +1,13 @@
 from marvinbot.utils import localized_date
+from marvinbot.dispatch import ChatDispatcher, ChatQueue, chat_key
+from marvinbot.models import User
 from telegram.error import NetworkError, Unauthorized
 from concurrent.futures import ThreadPoolExecutor
 from functools import partial
 import threading
+import asyncio
 import polling
+import queue
 import logging
 import time
 
@@ -127,10 +131,25 @@ class PollingThread(threading.Thread):
             self.executor.shutdown()
 
 
+def warm_user_cache(updates):
+    """Load the users in a batch of updates with a single query."""
+    user_ids = [update.effective_user.id for update in updates if update.effective_user]
+    if user_ids:
+        try:
+            User.by_ids(user_ids)
+        except Exception as e:
+            log.exception(e)
+
+
 UPDATER_DEFAULTS = {
     'polling_interval': 0.5,
     'polling_expiry': 10,
     'polling_workers': 5,
+    'chat_concurrency': 1,
+    'prefetch_users': False,
+    'max_in_flight': 1000,
+    # Batches fetched ahead of dispatch, 0 polls and dispatches one batch at a time
+    'pipeline_depth': 2,
 }
 
 
@@ -150,6 +169,15 @@ class TelegramPollingThread(PollingThread):
                                                     poll_timeout=updater_config.get('polling_expiry'),
                                                     thread_name='telegram-polling-thread',
                                                     workers=updater_config.get('polling_workers'))
+        self.prefetch_users = updater_config.get('prefetch_users')
+        self.pipeline_depth = int(updater_config.get('pipeline_depth') or 0)
+        self.long_polling = int(self.adapter.config.get('fetch_timeout', 5)) > 0
+        self.batches = None
+        if self.executor:
+            self.dispatcher = ChatDispatcher(self.executor, self.adapter.receive_update,
+                                             max_in_flight=updater_config.get('chat_concurrency'))
+        else:
+            self.dispatcher = None
 
     def fetch_updates(self, last_result=None, last_update_time=None):
         # Fetch a list of Telegram updates for the bot, passing in the last_update_id
@@ -157,12 +185,202 @@ class TelegramPollingThread(PollingThread):
         yield from self.adapter.fetch_updates(last_result)
 
     def on_update(self, updates):
+        """Dispatch a batch of updates, returns the offset for the next poll."""
         last_update = None
+        updates = list(updates)
+        if self.prefetch_users:
+            warm_user_cache(updates)
         for update in updates:
-            # Execute the actual processing asynchronously
-            self.execute(self.adapter.process_update, update)
+            # Execute the actual processing asynchronously, in order for each chat
+            self.dispatch(update)
             last_update = update
         if last_update:
             # This is needed so we can avoid pulling the same update twice
             # Telegram's API returns the latest update after this ID
             return last_update.update_id + 1
+
+    def dispatch(self, update):
+        if self.dispatcher:
+            return self.dispatcher.submit(update)
+        return self.adapter.receive_update(update)
+
+    def run(self):
+        if not self.pipeline_depth:
+            return super(TelegramPollingThread, self).run()
+
+        self.running = True
+        log.info("Starting pipelined polling thread, depth=%d", self.pipeline_depth)
+        # Bounded, so fetching stops getting ahead when dispatch can't keep up
+        self.batches = queue.Queue(maxsize=self.pipeline_depth)
+        dispatch_thread = threading.Thread(target=self.dispatch_batches, name='telegram-dispatch-thread',
+                                           daemon=True)
+        dispatch_thread.start()
+
+        last_update_id = None
+        cur_interval = self.poll_interval
+        try:
+            while self.running:
+                try:
+                    updates = list(self.adapter.fetch_updates(last_update_id))
+                except Exception as e:
+                    log.debug("Error fetching updates: %s", e)
+                    cur_interval = self.adjust_interval(cur_interval)
+                    time.sleep(cur_interval)
+                    continue
+                cur_interval = self.poll_interval
+
+                if updates:
+                    # The offset is known right away, the next long poll starts while
+                    # this batch is being dispatched
+                    last_update_id = updates[-1].update_id + 1
+                    self.batches.put(updates)
+                elif not self.long_polling:
+                    time.sleep(cur_interval)
+        finally:
+            self.batches.put(None)
+            dispatch_thread.join()
+
+    def stop(self):
+        """Stop polling, queued updates are allowed to finish"""
+        self.running = False
+        if self.batches is not None and self.is_alive() and threading.current_thread() is not self:
+            # Wait for the batches already fetched to be handed over
+            self.join()
+        if self.dispatcher:
+            self.dispatcher.wait_idle()
+        super(TelegramPollingThread, self).stop()
+
+    def dispatch_batches(self):
+        while True:
+            updates = self.batches.get()
+            if updates is None:
+                return
+            try:
+                self.on_update(updates)
+                self.func_kwargs['last_update_time'] = localized_date()
+            except Exception as e:
+                log.exception(e)
+
+
+class AsyncTelegramPollingThread(threading.Thread):
+    def __init__(self, adapter, workers=None):
+        """Long-polls Telegram and dispatches every update as a task on a private event loop.
+
+        Up to `max_in_flight` updates are processed concurrently. Updates are queued per
+        chat (a `ChatQueue` each), and at most `chat_concurrency` tasks drain a chat's queue,
+        so with the default of 1 they're handled in order within each chat. Sync handlers run
+        on a ThreadPoolExecutor of `polling_workers` threads, coroutine handlers on the loop itself.
+        """
+        self.adapter = adapter
+        updater_config = dict(UPDATER_DEFAULTS)
+        updater_config.update(self.adapter.config.get('updater', {}))
+
+        self.poll_interval = updater_config.get('polling_interval')
+        self.max_in_flight = int(updater_config.get('max_in_flight'))
+        self.chat_concurrency = max(1, int(updater_config.get('chat_concurrency')))
+        self.prefetch_users = updater_config.get('prefetch_users')
+        self.chats = {}
+        # Tasks draining a chat queue, awaited before the loop is closed
+        self.tasks = set()
+        workers = int(workers or updater_config.get('polling_workers'))
+
+        self.running = False
+        self.loop = None
+        super(AsyncTelegramPollingThread, self).__init__()
+        self.name = 'telegram-async-polling-thread'
+        self.daemon = True
+
+        # getUpdates blocks for up to fetch_timeout, give it its own thread
+        self.fetch_executor = ThreadPoolExecutor(max_workers=1)
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        log.info('Starting async poller, max_in_flight=%d, workers=%d', self.max_in_flight, workers)
+
+    def run(self):
+        self.running = True
+        log.info("Starting async polling thread")
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        try:
+            self.loop.run_until_complete(self.poll())
+        finally:
+            if self.tasks:
+                # Polling failed or was stopped, let the updates already taken finish
+                self.loop.run_until_complete(asyncio.gather(*self.tasks, return_exceptions=True))
+            self.loop.close()
+            self.fetch_executor.shutdown(wait=False)
+            self.executor.shutdown()
+
+    def fetch_updates(self, last_update_id):
+        return list(self.adapter.fetch_updates(last_update_id))
+
+    async def poll(self):
+        in_flight = asyncio.Semaphore(self.max_in_flight)
+        last_update_id = None
+        cur_interval = self.poll_interval
+
+        while self.running:
+            try:
+                updates = await self.loop.run_in_executor(self.fetch_executor,
+                                                          self.fetch_updates, last_update_id)
+                if updates and self.prefetch_users:
+                    await self.loop.run_in_executor(self.fetch_executor, warm_user_cache, updates)
+                cur_interval = self.poll_interval
+            except Exception as e:
+                log.debug("Error fetching updates: %s", e)
+                cur_interval = PollingThread.adjust_interval(cur_interval)
+                await asyncio.sleep(cur_interval)
+                continue
+
+            for update in updates:
+                await in_flight.acquire()
+                self.schedule(update, in_flight)
+                # This is needed so we can avoid pulling the same update twice
+                last_update_id = update.update_id + 1
+
+            if not updates:
+                await asyncio.sleep(cur_interval)
+
+        if self.tasks:
+            await asyncio.wait(set(self.tasks))
+
+    def schedule(self, update, in_flight):
+        key = chat_key(update)
+        queue = self.chats.get(key)
+        if queue is None:
+            queue = self.chats[key] = ChatQueue()
+        queue.pending.append(update)
+        if key is None or queue.running < self.chat_concurrency:
+            queue.running += 1
+            task = self.loop.create_task(self.drain(key, queue, in_flight))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+    async def drain(self, key, queue, in_flight):
+        try:
+            while queue.pending:
+                update = queue.pending.popleft()
+                try:
+                    await self.dispatch(update)
+                finally:
+                    in_flight.release()
+        finally:
+            queue.running -= 1
+            if not queue.running and not queue.pending:
+                self.chats.pop(key, None)
+
+    async def dispatch(self, update):
+        try:
+            if self.adapter.publish_updates:
+                await self.loop.run_in_executor(self.executor, self.adapter.receive_update, update)
+                return
+            await self.adapter.process_update_async(update, executor=self.executor)
+        except Exception:
+            # Already logged by the adapter, keep going
+            pass
+
+    def stop(self):
+        """Stop polling, in-flight updates are allowed to finish before this returns"""
+        self.running = False
+        if self.is_alive() and threading.current_thread() is not self:
+            # Returns once the poll in progress is over and every task is done
+            self.join()
@@ -0,0 +1,119 @@
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+import inspect
+import logging
+import sys
+
+
+log = logging.getLogger(__name__)
+
+
+__all__ = ['ProcessHandlerPool', 'configure_process_pool', 'handler_key']
+
+
+PROCESS_POOL_DEFAULTS = {
+    'workers': 2,
+    # spawn gives every worker a clean interpreter, fork is faster to start but inherits
+    # the parent's threads and connections in whatever state they were
+    'start_method': 'spawn',
+}
+
+# Handlers with executor="process", by key. Only filled in the pool's worker processes.
+_HANDLERS = None
+
+
+def handler_key(handler, taken):
+    """Key that names the same handler in every process that loads the same plugins.
+
+    :param taken: keys already in use, the key gets a counter to keep it unique."""
+    callback = handler.callback
+    name = '{}.{}'.format(callback.__module__, getattr(callback, '__qualname__', callback.__name__))
+    key = name
+    counter = 1
+    while key in taken:
+        counter += 1
+        key = '{}#{}'.format(name, counter)
+    return key
+
+
+def init_worker(config):
+    """Runs once in every worker process: configure everything and load the plugins."""
+    global _HANDLERS
+    from marvinbot.log import configure_logging
+    from marvinbot.utils import configure_mongoengine
+    from marvinbot.worker import prepare_adapter
+    import mongoengine
+
+    configure_logging(config)
+    # A forked process would otherwise share the parent's sockets
+    mongoengine.disconnect()
+    configure_mongoengine(config)
+    adapter = prepare_adapter(config)
+    _HANDLERS = {handler.process_key: handler
+                 for handlers in adapter.handlers.values() for handler in handlers
+                 if handler.process_key}
+    log.info("Process worker ready with %d handlers", len(_HANDLERS))
+
+
+def _ensure_worker():
+    if _HANDLERS is None:
+        from marvinbot.utils import get_config
+        init_worker(get_config())
+
+
+def _warm_up():
+    _ensure_worker()
+    return len(_HANDLERS)
+
+
+def _run_handler(key, payload):
+    from marvinbot.core import get_adapter, run_coroutine
+    from telegram import Update
+
+    _ensure_worker()
+    handler = _HANDLERS.get(key)
+    if handler is None:
+        raise LookupError('No handler [{}] in this worker, are the same plugins loaded?'.format(key))
+    update = Update.de_json(payload, get_adapter().bot)
+    result = handler.process_update(update)
+    if inspect.isawaitable(result):
+        run_coroutine(result)
+    # Whatever the handler returned may not survive pickling, and nobody looks at it
+    return None
+
+
+class ProcessHandlerPool(object):
+    def __init__(self, config, workers=2, start_method='spawn'):
+        """Runs the handlers added with `executor="process"` on a pool of processes.
+
+        Every worker process configures its own adapter and loads the plugins, so it knows
+        the same handlers. Updates are sent over as `update.to_dict()`."""
+        self.config = config
+        self.workers = int(workers)
+        kwargs = {}
+        if sys.version_info >= (3, 7):
+            kwargs['mp_context'] = multiprocessing.get_context(start_method)
+            kwargs['initializer'] = init_worker
+            kwargs['initargs'] = (config,)
+        # On 3.6 workers are forked and set themselves up on their first call
+        self.executor = ProcessPoolExecutor(max_workers=self.workers, **kwargs)
+
+    def start(self):
+        """Start the workers and have them load the plugins now, instead of on the first update."""
+        log.info("Starting %d handler processes", self.workers)
+        return [self.executor.submit(_warm_up) for _ in range(self.workers)]
+
+    def submit(self, handler, update):
+        """Run handler in a worker process, returns a Future."""
+        return self.executor.submit(_run_handler, handler.process_key, update.to_dict())
+
+    def shutdown(self, wait=True):
+        self.executor.shutdown(wait=wait)
+
+
+def configure_process_pool(config):
+    pconfig = {}
+    pconfig.update(PROCESS_POOL_DEFAULTS)
+    pconfig.update(config.get('process_pool', {}))
+    return ProcessHandlerPool(config, workers=pconfig.get('workers'),
+                              start_method=pconfig.get('start_method'))
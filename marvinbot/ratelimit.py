@@ -0,0 +1,252 @@
+from marvinbot.utils.lru import LRUCache
+from concurrent.futures import Future, ThreadPoolExecutor
+import threading
+import logging
+import heapq
+import time
+
+
+log = logging.getLogger(__name__)
+
+
+__all__ = ['TokenBucket', 'RateLimiterRegistry', 'DelayedExecutor', 'configure_rate_limiter',
+           'get_rate_limiter', 'rate_limit_metrics']
+
+
+RATE_LIMIT_DEFAULTS = {
+    # Telegram allows ~30 messages per second overall and 20 per minute on a group
+    'default': {'max_calls': 30, 'period': 1},
+    'group': {'max_calls': 20, 'period': 60},
+    'max_limiters': 10000,
+    'idle_ttl': 3600,
+    'workers': 2,
+}
+
+REGISTRY = None
+
+
+class TokenBucket(object):
+    __slots__ = ('key', 'rate', 'capacity', 'tokens', 'updated', 'queued', 'delayed',
+                 'total_delay', 'lock')
+
+    def __init__(self, max_calls, period, key=None):
+        """Allows bursts of up to `max_calls`, refilling at `max_calls / period` per second."""
+        self.key = key
+        self.capacity = float(max_calls)
+        self.rate = float(max_calls) / period
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.queued = 0
+        self.delayed = 0
+        self.total_delay = 0.0
+        self.lock = threading.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    @property
+    def idle(self):
+        """True if the bucket is full and nobody waits on it, dropping it changes nothing."""
+        with self.lock:
+            self._refill(time.monotonic())
+            return self.tokens >= self.capacity and not self.queued
+
+    @property
+    def available(self):
+        with self.lock:
+            self._refill(time.monotonic())
+            return self.tokens
+
+    def reserve(self):
+        """Take a token, even if it isn't there yet.
+
+        :returns: how many seconds the caller has to wait before using it, 0 if none.
+
+        Callers that got a delay must call `done_waiting()` once they go ahead."""
+        with self.lock:
+            self._refill(time.monotonic())
+            self.tokens -= 1
+            if self.tokens >= 0:
+                return 0
+            delay = -self.tokens / self.rate
+            self.queued += 1
+            self.delayed += 1
+            self.total_delay += delay
+            return delay
+
+    def done_waiting(self):
+        with self.lock:
+            self.queued -= 1
+
+    def acquire(self):
+        """Block until a token is available."""
+        delay = self.reserve()
+        if delay:
+            log.info("Rate limiter hit for key %s, sleeping for %.2f seconds", self.key, delay)
+            time.sleep(delay)
+            self.done_waiting()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+    def metrics(self):
+        return {
+            'tokens': self.available,
+            'queued': self.queued,
+            'delayed': self.delayed,
+            'total_delay': self.total_delay,
+        }
+
+
+class DelayedExecutor(object):
+    def __init__(self, workers=2, thread_name='delayed-executor'):
+        """Runs functions after a delay without parking a thread per call.
+
+        A single timer thread keeps a heap of due times, and hands due calls over to a
+        ThreadPoolExecutor of `workers` threads."""
+        self.executor = ThreadPoolExecutor(max_workers=int(workers))
+        self.thread_name = thread_name
+        self._heap = []
+        self._counter = 0
+        self._condition = threading.Condition()
+        self._thread = None
+        self.running = True
+
+    def _ensure_thread(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name=self.thread_name, daemon=True)
+            self._thread.start()
+
+    def call_later(self, delay, func, *args, **kwargs):
+        """Run func after `delay` seconds, returns a Future for its result."""
+        future = Future()
+        with self._condition:
+            self._ensure_thread()
+            self._counter += 1
+            heapq.heappush(self._heap, (time.monotonic() + delay, self._counter, future, func, args, kwargs))
+            self._condition.notify()
+        return future
+
+    def submit(self, func, *args, **kwargs):
+        return self.executor.submit(func, *args, **kwargs)
+
+    def _run(self):
+        while self.running:
+            with self._condition:
+                while self.running and (not self._heap or self._heap[0][0] > time.monotonic()):
+                    timeout = self._heap[0][0] - time.monotonic() if self._heap else None
+                    self._condition.wait(timeout)
+                if not self.running:
+                    return
+                due, counter, future, func, args, kwargs = heapq.heappop(self._heap)
+            self.executor.submit(self._call, future, func, args, kwargs)
+
+    @staticmethod
+    def _call(future, func, args, kwargs):
+        if not future.set_running_or_notify_cancel():
+            return
+        try:
+            future.set_result(func(*args, **kwargs))
+        except Exception as e:
+            future.set_exception(e)
+
+    def __len__(self):
+        return len(self._heap)
+
+    def shutdown(self):
+        with self._condition:
+            self.running = False
+            self._condition.notify()
+        self.executor.shutdown()
+
+
+class RateLimiterRegistry(object):
+    def __init__(self, limits=None, max_limiters=10000, idle_ttl=3600, workers=2):
+        """Keeps one TokenBucket per key, evicting the least recently used/idle ones.
+
+        Parameters:
+        - `limits`: dict of limit name -> {'max_calls': X, 'period': Y}.
+        - `max_limiters`: max amount of buckets to keep around.
+        - `idle_ttl`: buckets get dropped this many seconds after they were made, once idle.
+        - `workers`: threads that run the sends scheduled by `schedule`.
+
+        Only full buckets are evicted: a new bucket starts full, so dropping one that's still
+        limiting its key would let a burst through. `max_limiters` may be exceeded meanwhile.
+        """
+        self.limits = limits or {name: RATE_LIMIT_DEFAULTS[name] for name in ('default', 'group')}
+        self.buckets = LRUCache(max_size=max_limiters, ttl=idle_ttl, can_evict=lambda key, bucket: bucket.idle)
+        self.delayed = DelayedExecutor(workers, thread_name='rate-limiter-scheduler')
+        self.expire_interval = min(idle_ttl, 60) if idle_ttl else None
+        self._last_expire = time.monotonic()
+
+    def get(self, key, limit='default'):
+        if self.expire_interval and time.monotonic() - self._last_expire > self.expire_interval:
+            self._last_expire = time.monotonic()
+            self.expire()
+
+        def make_bucket():
+            log.info("Making rate limiter for key [%s]", key)
+            return TokenBucket(key=key, **self.limits[limit])
+        return self.buckets.get_or_create(key, make_bucket)
+
+    def schedule(self, key, func, *args, limit='default', **kwargs):
+        """Reserve a token for `key` and run func as soon as it's allowed to.
+
+        Never blocks: returns a Future for func's result. If no wait is needed, func runs
+        on the calling thread."""
+        bucket = self.get(key, limit)
+        delay = bucket.reserve()
+        if not delay:
+            future = Future()
+            future.set_running_or_notify_cancel()
+            try:
+                future.set_result(func(*args, **kwargs))
+            except Exception as e:
+                future.set_exception(e)
+            return future
+
+        def run():
+            bucket.done_waiting()
+            return func(*args, **kwargs)
+        log.info("Rate limiter hit for key %s, scheduling in %.2f seconds", key, delay)
+        return self.delayed.call_later(delay, run)
+
+    def expire(self):
+        return self.buckets.expire()
+
+    def metrics(self):
+        """Returns {key: {'tokens', 'queued', 'delayed', 'total_delay'}} for every live limiter."""
+        return {key: bucket.metrics() for key, bucket in self.buckets.items()}
+
+
+def configure_rate_limiter(config):
+    global REGISTRY
+
+    rconfig = {}
+    rconfig.update(RATE_LIMIT_DEFAULTS)
+    rconfig.update(config.get('rate_limits', {}))
+
+    REGISTRY = RateLimiterRegistry({name: rconfig[name] for name in ('default', 'group')},
+                                   max_limiters=rconfig.get('max_limiters'),
+                                   idle_ttl=rconfig.get('idle_ttl'),
+                                   workers=rconfig.get('workers'))
+    return REGISTRY
+
+
+def get_registry():
+    if REGISTRY is None:
+        configure_rate_limiter({})
+    return REGISTRY
+
+
+def get_rate_limiter(key, limit='default'):
+    return get_registry().get(key, limit)
+
+
+def rate_limit_metrics():
+    return get_registry().metrics()
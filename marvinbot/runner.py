@@ -2,17 +2,26 @@ from marvinbot.plugins import load_plugins
 from marvinbot.signals import bot_shutdown, bot_started
 from marvinbot.polling import TelegramPollingThread
 from marvinbot.scheduler import configure_scheduler
+from marvinbot.updatequeue import LocalUpdateQueue, start_local_consumers
 import logging
 
 log = logging.getLogger(__name__)
 
 
 def shutdown_bot(adapter):
+    """Stop everything, in order. Also used by the worker processes (`marvinbot.worker`),
+    that have consumers but no updater, and a scheduler that never starts."""
     log.info('Shutting down...')
-    if adapter.scheduler_available:
+    if adapter.scheduler_available and adapter.scheduler.running:
         adapter.scheduler.shutdown()
-    adapter.updater.stop()
+    if getattr(adapter, '_updater', None) is not None:
+        adapter.updater.stop()
+    for consumer in adapter.consumers:
+        consumer.stop()
+    adapter.shutdown_process_pool()
     bot_shutdown.send(adapter)
+    # Last, bot_shutdown receivers may still queue messages
+    adapter.shutdown_outbound()
 
 
 def run_bot(adapter):
@@ -22,6 +31,12 @@ def run_bot(adapter):
     adapter.updater.start()
     configure_scheduler(adapter.config, adapter)
     load_plugins(adapter.config, adapter)
+    if adapter.has_process_handlers:
+        # Have the plugins loaded in the workers before the first update shows up
+        adapter.process_pool.start()
+    if isinstance(adapter.update_queue, LocalUpdateQueue):
+        # Ingest and workers in the same process
+        adapter.consumers = start_local_consumers(adapter, adapter.config)
     if adapter.scheduler_available:
         adapter.scheduler.start()
     bot_started.send(adapter)
@@ -0,0 +1,296 @@
+from marvinbot.signals import bot_shutdown
+from marvinbot.utils import localized_date
+from marvinbot.utils.lru import LRUCache
+from pymongo import ReplaceOne, DeleteOne
+import threading
+import logging
+import mongoengine
+import copy
+
+
+log = logging.getLogger(__name__)
+
+
+__all__ = ['StateStore', 'PluginState', 'configure_state', 'get_state_store']
+
+
+STATE_DEFAULTS = {
+    # Records kept in memory, least recently used ones are dropped past this
+    'max_entries': 10000,
+    # Seconds between writes to MongoDB, 0 writes every change right away
+    'flush_interval': 5,
+    # Flush early once this many records are waiting to be written
+    'max_dirty': 1000,
+    # Past this many unwritten records (e.g. MongoDB is down), writes flush first and
+    # raise if that fails, instead of piling up in memory
+    'max_pending': 10000,
+    # Longest wait between flush attempts while they fail, the wait doubles on each failure
+    'max_backoff': 300,
+    'flush_on_shutdown': True,
+}
+
+STATE_STORE = None
+_DELETED = object()
+
+
+class StateRecord(mongoengine.Document):
+    id = mongoengine.StringField(primary_key=True)
+    plugin = mongoengine.StringField(required=True)
+    chat_id = mongoengine.LongField()
+    user_id = mongoengine.LongField()
+    data = mongoengine.DictField()
+    date_updated = mongoengine.DateTimeField(default=localized_date)
+
+    meta = {
+        'collection': 'state',
+        'indexes': [
+            ('plugin', 'chat_id', 'user_id'),
+        ]
+    }
+
+
+def record_id(plugin, chat_id=None, user_id=None):
+    return '{}:{}:{}'.format(plugin, '' if chat_id is None else chat_id, '' if user_id is None else user_id)
+
+
+class StateStore(object):
+    def __init__(self, max_entries=10000, flush_interval=5, max_dirty=1000, max_pending=10000, max_backoff=300):
+        """Key/value state for plugins, scoped by plugin and optionally chat and/or user.
+
+        Reads are served from an in-memory LRU, loaded from MongoDB on a miss. Writes only
+        touch memory and mark the record dirty, dirty records are written in a single
+        `bulk_write` every `flush_interval` seconds (or once `max_dirty` pile up). Values
+        are stored in MongoDB as they are, so keys must be strings.
+
+        Records that aren't in MongoDB yet (dirty, or being flushed) are never evicted.
+        While flushes fail they're retried with a growing delay, up to `max_backoff`
+        seconds, and once `max_pending` records are waiting, writes raise the flush error.
+
+        `get` returns a copy: change it and `set` it back, or use `update`."""
+        self.flush_interval = flush_interval
+        self.max_dirty = max_dirty
+        self.max_pending = max_pending
+        self.max_backoff = max_backoff
+        self.cache = LRUCache(max_size=max_entries, can_evict=self._can_evict)
+        # record id -> (plugin, chat_id, user_id, data or _DELETED), not yet in MongoDB
+        self.dirty = {}
+        # The batch being written by flush, same format
+        self.flushing = {}
+        self.lock = threading.RLock()
+        self.flush_lock = threading.Lock()
+        self.flushes = 0
+        self.written = 0
+        self.failures = 0
+        # Set while flushes fail, filling up doesn't cut the retry delay short then
+        self._backing_off = False
+        self.running = False
+        self._wakeup = threading.Event()
+        self._thread = None
+
+    def _can_evict(self, key, data):
+        # Dropping it would make the next read load what MongoDB has, older than this
+        return key not in self.dirty and key not in self.flushing
+
+    def _check_pending(self):
+        if self.max_pending and len(self.dirty) >= self.max_pending:
+            # Raises if MongoDB still can't take them
+            self.flush()
+
+    def _load(self, key):
+        document = StateRecord._get_collection().find_one({'_id': key}, {'data': 1})
+        return document.get('data', {}) if document else {}
+
+    def _current(self, key):
+        with self.lock:
+            pending = self.dirty.get(key)
+            if pending is not None:
+                data = pending[3]
+                return {} if data is _DELETED else data
+            data = self.cache.get(key)
+        if data is None:
+            data = self._load(key)
+            with self.lock:
+                # A write may have happened while we were reading
+                if key not in self.dirty:
+                    self.cache.set(key, data)
+                else:
+                    return self._current(key)
+        return data
+
+    def get(self, plugin, chat_id=None, user_id=None, default=None):
+        data = self._current(record_id(plugin, chat_id, user_id))
+        if not data and default is not None:
+            return copy.deepcopy(default)
+        return copy.deepcopy(data)
+
+    def set(self, plugin, data, chat_id=None, user_id=None):
+        key = record_id(plugin, chat_id, user_id)
+        data = copy.deepcopy(data)
+        self._check_pending()
+        with self.lock:
+            self.cache.set(key, data)
+            self.dirty[key] = (plugin, chat_id, user_id, data)
+            pending = len(self.dirty)
+        self._written(pending)
+
+    def update(self, plugin, chat_id=None, user_id=None, **values):
+        """Merge values into the record, returns the updated copy."""
+        key = record_id(plugin, chat_id, user_id)
+        self._check_pending()
+        # Load it without holding the lock
+        self._current(key)
+        with self.lock:
+            data = dict(self._current(key))
+            data.update(copy.deepcopy(values))
+            self.cache.set(key, data)
+            self.dirty[key] = (plugin, chat_id, user_id, data)
+            pending = len(self.dirty)
+        self._written(pending)
+        return copy.deepcopy(data)
+
+    def delete(self, plugin, chat_id=None, user_id=None):
+        key = record_id(plugin, chat_id, user_id)
+        self._check_pending()
+        with self.lock:
+            self.cache.set(key, {})
+            self.dirty[key] = (plugin, chat_id, user_id, _DELETED)
+            pending = len(self.dirty)
+        self._written(pending)
+
+    def scope(self, plugin):
+        return PluginState(self, plugin)
+
+    def _written(self, pending):
+        if not self.flush_interval:
+            self.flush()
+        elif pending >= self.max_dirty and not self._backing_off:
+            self._wakeup.set()
+
+    def flush(self):
+        """Write every dirty record to MongoDB, returns how many were written."""
+        with self.flush_lock:
+            with self.lock:
+                batch, self.dirty = self.dirty, {}
+                self.flushing = batch
+            if not batch:
+                return 0
+            now = localized_date()
+            operations = []
+            for key, (plugin, chat_id, user_id, data) in batch.items():
+                if data is _DELETED:
+                    operations.append(DeleteOne({'_id': key}))
+                else:
+                    operations.append(ReplaceOne({'_id': key}, {
+                        'plugin': plugin, 'chat_id': chat_id, 'user_id': user_id,
+                        'data': data, 'date_updated': now,
+                    }, upsert=True))
+            try:
+                StateRecord._get_collection().bulk_write(operations, ordered=False)
+            except Exception:
+                with self.lock:
+                    # Keep them for the next flush, unless they changed since
+                    for key, entry in batch.items():
+                        self.dirty.setdefault(key, entry)
+                    self.flushing = {}
+                self.failures += 1
+                raise
+            with self.lock:
+                self.flushing = {}
+            self.flushes += 1
+            self.written += len(operations)
+            return len(operations)
+
+    def start(self):
+        if self._thread or not self.flush_interval:
+            return
+        self.running = True
+        self._thread = threading.Thread(target=self._flush_periodically, name='state-flush', daemon=True)
+        self._thread.start()
+
+    def stop(self, flush=True):
+        self.running = False
+        self._wakeup.set()
+        if self._thread and self._thread is not threading.current_thread():
+            self._thread.join()
+        self._thread = None
+        if flush:
+            self.flush()
+
+    def _flush_periodically(self):
+        delay = self.flush_interval
+        while self.running:
+            self._wakeup.wait(delay)
+            self._wakeup.clear()
+            if not self.running:
+                return
+            try:
+                written = self.flush()
+                if written:
+                    log.debug("Flushed %d state records", written)
+                delay = self.flush_interval
+                self._backing_off = False
+            except Exception as e:
+                log.exception(e)
+                delay = min(delay * 2, self.max_backoff)
+                self._backing_off = True
+                log.warning("Couldn't flush %d state records, retrying in %ss", len(self.dirty), delay)
+
+    def stats(self):
+        stats = self.cache.stats()
+        stats.update({'dirty': len(self.dirty), 'flushes': self.flushes, 'written': self.written,
+                      'failures': self.failures})
+        return stats
+
+
+class PluginState(object):
+    def __init__(self, store, plugin):
+        """A plugin's view of a StateStore, see `Plugin.state`."""
+        self.store = store
+        self.plugin = plugin
+
+    def get(self, chat_id=None, user_id=None, default=None):
+        return self.store.get(self.plugin, chat_id=chat_id, user_id=user_id, default=default)
+
+    def set(self, data, chat_id=None, user_id=None):
+        return self.store.set(self.plugin, data, chat_id=chat_id, user_id=user_id)
+
+    def update(self, chat_id=None, user_id=None, **values):
+        return self.store.update(self.plugin, chat_id=chat_id, user_id=user_id, **values)
+
+    def delete(self, chat_id=None, user_id=None):
+        return self.store.delete(self.plugin, chat_id=chat_id, user_id=user_id)
+
+
+def _flush_on_shutdown(adapter):
+    if STATE_STORE is not None:
+        STATE_STORE.stop()
+
+
+def configure_state(config):
+    global STATE_STORE
+
+    sconfig = {}
+    sconfig.update(STATE_DEFAULTS)
+    sconfig.update(config.get('state', {}))
+
+    if STATE_STORE:
+        STATE_STORE.stop()
+    STATE_STORE = StateStore(max_entries=sconfig.get('max_entries'),
+                             flush_interval=sconfig.get('flush_interval'),
+                             max_dirty=sconfig.get('max_dirty'),
+                             max_pending=sconfig.get('max_pending'),
+                             max_backoff=sconfig.get('max_backoff'))
+    STATE_STORE.start()
+    if sconfig.get('flush_on_shutdown'):
+        bot_shutdown.connect(_flush_on_shutdown)
+    else:
+        bot_shutdown.disconnect(_flush_on_shutdown)
+    return STATE_STORE
+
+
+def get_state_store():
+    global STATE_STORE
+    if STATE_STORE is None:
+        STATE_STORE = StateStore()
+        STATE_STORE.start()
+    return STATE_STORE
@@ -1,11 +1,13 @@
+from concurrent.futures import wait
 from telegram import InlineKeyboardMarkup, InlineKeyboardButton
 from telegram.error import Unauthorized
-from marvinbot.core import get_adapter, BANNED_IDS_CACHE_KEY
-from marvinbot.cache import cache
+from marvinbot.core import get_adapter
+from marvinbot.banlist import get_banlist
 from marvinbot.signals import bot_started, bot_shutdown, plugin_reload, joined_chat, left_chat
 from marvinbot.handlers import CommandHandler, MessageHandler, CallbackQueryHandler
 from marvinbot.defaults import DEFAULT_ROLE, OWNER_ROLE, POWER_USERS, RoleType
 from marvinbot.models import User, make_token
+from marvinbot.filters import cost_hint
 
 import logging
 
@@ -20,7 +22,11 @@ def on_start(adapter):
 
 @bot_shutdown.connect
 def on_shutdown(adapter):
-    adapter.notify_owners('❌ *Bot shutting down*.', parse_mode='Markdown')
+    if adapter.is_worker:
+        # The ingest process speaks for the bot
+        return
+    # Give the queued notifications a chance to go out before we exit
+    wait(adapter.notify_owners('❌ *Bot shutting down*.', parse_mode='Markdown'), timeout=10)
 
 
 def format_plugins():
@@ -44,13 +50,22 @@ def plugin_control(update, *args, **kwargs):
         for plugin in kwargs.get('enable', []):
             adapter.enable_plugin(plugin)
 
+    reloaded = []
     if kwargs.get('reload'):
         for plugin in kwargs.get('reload', []):
             p = adapter.plugin_definition(plugin)
-            if p.enabled:
-                plugin_reload.send(p, update=update)
+            if not p or not p.enabled:
+                continue
+            try:
+                p = adapter.reload_plugin(plugin)
+            except Exception as e:
+                log.exception(e)
+                reloaded.append('❌ *{}* not reloaded: {}'.format(plugin, type(e).__name__))
+                continue
+            reloaded.append('🔄 *{}* reloaded in {:.2f}s.'.format(p.name, sum(p.timings.values())))
+            plugin_reload.send(p, update=update)
 
-    update.effective_message.reply_text(format_plugins(), parse_mode='Markdown')
+    update.effective_message.reply_text("\n".join(reloaded + [format_plugins()]), parse_mode='Markdown')
 
 
 def authenticate(update, *args, **kwargs):
@@ -110,6 +125,7 @@ def manage_users(update, *args, **kwargs):
     u, created = User.from_telegram(update.effective_message.reply_to_message.from_user)
     if kwargs.get('forget', False):
         u.delete()
+        get_banlist().unban(u.id)
         update.effective_message.reply_text('🚮 Who _was_ that anyways?', parse_mode='Markdown')
         return
 
@@ -121,14 +137,18 @@ def manage_users(update, *args, **kwargs):
         if u.role in POWER_USERS:
             update.effective_message.reply_text("❌ Can't ban an admin/owner.")
             return
-        u.banned = True
+        u.set_banned(True)
         update.effective_message.reply_text('🔨 Applying BanHammer!', parse_mode='Markdown')
     elif kwargs.get('unignore', False):
-        u.banned = False
+        u.set_banned(False)
         update.effective_message.reply_text('Not ignoring this user anymore.', parse_mode='Markdown')
-    cache.delete(BANNED_IDS_CACHE_KEY)
     u.save()
 
+    if u.banned:
+        get_banlist().ban(u.id)
+    else:
+        get_banlist().unban(u.id)
+
 
 def commands_list(update, *args, **kwargs):
     exclude_internal = kwargs.get('exclude_internal')
@@ -196,6 +216,7 @@ def on_leave_chat(update):
     except Unauthorized as err:
         message.chat.send_message(text='❌ {}'.format(err.message))
 
+@cost_hint(1)
 def filter_bot_membership_change(message):
     return any(new_chat_member.id == adapter.bot_info.id for new_chat_member in message.new_chat_members) or\
         (message.left_chat_member and message.left_chat_member.id == adapter.bot_info.id) or\
@@ -211,7 +232,7 @@ adapter.add_handler(CommandHandler('plugins', plugin_control,
                                    'display a list of registered plugins.', required_roles=POWER_USERS)
                     .add_argument('--enable', nargs='+', metavar="PLUGIN", help='enables the listed plugins.')
                     .add_argument('--disable', nargs='+', metavar="PLUGIN", help='disables the listed plugins.')
-                    .add_argument('--reload', nargs='+', metavar="PLUGIN", help='signals the specified plugins to reload, if supported.'), 0)
+                    .add_argument('--reload', nargs='+', metavar="PLUGIN", help='reloads the code of the specified plugins.'), 0)
 
 adapter.add_handler(CommandHandler('authenticate', authenticate, command_description='Authenticate yourself to the bot.')
                     .add_argument('token', nargs='?', help='your authentication token.'), 0)
@@ -0,0 +1,81 @@
+from werkzeug.test import Client
+from itertools import count
+import threading
+import logging
+import json
+import time
+
+
+log = logging.getLogger(__name__)
+
+
+__all__ = ['FakeTelegramClient']
+
+
+class FakeTelegramClient(object):
+    def __init__(self, target, path='/telegram/webhook', first_update_id=1, secret_token=None):
+        """Posts made up updates to a webhook receiver, the way Telegram would.
+
+        Parameters:
+        - `target`: a WSGI app (e.g. `WebhookUpdater.wsgi_app` or a Flask app), called in
+          process, or the base url of a running receiver, posted to over HTTP.
+        - `path`: the webhook path, including the secret if there's one.
+        - `secret_token`: sent in the X-Telegram-Bot-Api-Secret-Token header, like Telegram
+          does (see `WebhookUpdater.secret_token`).
+        """
+        self.path = path
+        self.headers = {'X-Telegram-Bot-Api-Secret-Token': secret_token} if secret_token else {}
+        if isinstance(target, str):
+            import requests
+            self.session = requests.Session()
+            self.url = target.rstrip('/') + path
+            self.client = None
+        else:
+            self.session = self.url = None
+            self.client = Client(target)
+        self._ids = count(first_update_id)
+        self._lock = threading.Lock()
+
+    def next_update_id(self):
+        with self._lock:
+            return next(self._ids)
+
+    def make_message(self, text, chat_id=1, user_id=1, chat_type='private', username='user',
+                     **extra):
+        """Returns the payload of an update carrying a text message."""
+        message_id = self.next_update_id()
+        message = {
+            'message_id': message_id,
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': chat_type},
+            'from': {'id': user_id, 'is_bot': False, 'first_name': username, 'username': username},
+            'text': text,
+        }
+        if text.startswith('/'):
+            command = text.split(' ')[0]
+            message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(command)}]
+        message.update(extra)
+        return {'update_id': message_id, 'message': message}
+
+    def post(self, payload):
+        """Post an update payload, returns the HTTP status the receiver replied with."""
+        body = json.dumps(payload)
+        if self.client:
+            response = self.client.post(self.path, data=body, content_type='application/json',
+                                        headers=self.headers)
+            return response.status_code
+        headers = dict(self.headers, **{'Content-Type': 'application/json'})
+        response = self.session.post(self.url, data=body, headers=headers, timeout=10)
+        return response.status_code
+
+    def send_message(self, text, **kwargs):
+        return self.post(self.make_message(text, **kwargs))
+
+    def flood(self, texts, chats=1, users=1):
+        """Post every text, spread round robin over `chats` chats and `users` users.
+
+        Meant for benchmarks: returns (statuses, seconds it took to get them acknowledged)."""
+        started = time.perf_counter()
+        statuses = [self.send_message(text, chat_id=i % chats + 1, user_id=i % users + 1)
+                    for i, text in enumerate(texts)]
+        return statuses, time.perf_counter() - started
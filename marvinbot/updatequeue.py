@@ -0,0 +1,262 @@
+from marvinbot.dispatch import ChatDispatcher, chat_key
+from marvinbot.utils import localized_date
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+import threading
+import logging
+import mongoengine
+import telegram
+import time
+
+
+log = logging.getLogger(__name__)
+
+
+__all__ = ['LocalUpdateQueue', 'MongoUpdateQueue', 'UpdateConsumer', 'configure_update_queue',
+           'get_update_queue', 'start_local_consumers', 'worker_partitions']
+
+
+UPDATE_QUEUE_DEFAULTS = {
+    'enabled': False,
+    # One of: local, mongo
+    'backend': 'mongo',
+    # Updates are partitioned by chat, each partition is consumed by a single worker
+    'partitions': 8,
+    # Amount of consumers started by the ingest process itself (local backend only)
+    'local_workers': 2,
+    'batch_size': 100,
+    # How often an idle consumer checks for new updates (mongo backend only)
+    'poll_interval': 0.2,
+}
+
+UPDATE_QUEUE = None
+
+
+class UpdateQueue(object):
+    def __init__(self, partitions=8):
+        """Carries updates from the process that receives them to the ones that handle them.
+
+        Every update goes to partition `chat_id % partitions`, and each partition is read by
+        one consumer only, in order, so updates from the same chat are handled in order."""
+        self.partitions = int(partitions)
+
+    def partition_for(self, chat_id):
+        return chat_id % self.partitions if chat_id is not None else 0
+
+    def publish(self, update):
+        """Queue a telegram.Update for the workers."""
+        key = chat_key(update)
+        self.put(self.partition_for(key), update.update_id, key, update.to_dict())
+
+    def put(self, partition, update_id, chat_id, payload):
+        raise NotImplementedError
+
+    def take(self, partitions, limit, timeout):
+        """Returns up to `limit` (receipt, payload) pairs from partitions, oldest first.
+
+        Waits up to `timeout` seconds for something to show up."""
+        raise NotImplementedError
+
+    def ack(self, receipt):
+        """Drop a processed update for good."""
+        raise NotImplementedError
+
+    def recover(self, partitions):
+        """Make updates taken but never acknowledged by a previous consumer available again."""
+        pass
+
+
+class LocalUpdateQueue(UpdateQueue):
+    """In-process backend, for consumers running in the same process as the ingest."""
+
+    def __init__(self, partitions=8):
+        super(LocalUpdateQueue, self).__init__(partitions)
+        self.queues = [deque() for _ in range(self.partitions)]
+        self.condition = threading.Condition()
+
+    def put(self, partition, update_id, chat_id, payload):
+        with self.condition:
+            self.queues[partition].append(payload)
+            self.condition.notify_all()
+
+    def take(self, partitions, limit, timeout):
+        def available():
+            return any(self.queues[p] for p in partitions)
+
+        with self.condition:
+            if not self.condition.wait_for(available, timeout):
+                return []
+            taken = []
+            for partition in partitions:
+                queue = self.queues[partition]
+                while queue and len(taken) < limit:
+                    taken.append((None, queue.popleft()))
+            return taken
+
+    def ack(self, receipt):
+        pass
+
+    def __len__(self):
+        return sum(len(queue) for queue in self.queues)
+
+
+class QueuedUpdate(mongoengine.Document):
+    partition = mongoengine.IntField(required=True)
+    update_id = mongoengine.LongField(required=True)
+    chat_id = mongoengine.LongField()
+    payload = mongoengine.DictField()
+    taken = mongoengine.BooleanField(default=False)
+    date_added = mongoengine.DateTimeField(default=localized_date)
+
+    meta = {
+        'collection': 'update_queue',
+        'indexes': [
+            ('partition', 'taken', 'update_id'),
+        ]
+    }
+
+
+class MongoUpdateQueue(UpdateQueue):
+    """MongoDB backend, a collection shared by the ingest and the worker processes."""
+
+    def __init__(self, partitions=8, poll_interval=0.2):
+        super(MongoUpdateQueue, self).__init__(partitions)
+        self.poll_interval = poll_interval
+
+    def put(self, partition, update_id, chat_id, payload):
+        QueuedUpdate(partition=partition, update_id=update_id, chat_id=chat_id,
+                     payload=payload).save()
+
+    def take(self, partitions, limit, timeout):
+        deadline = time.monotonic() + (timeout or 0)
+        while True:
+            # Telegram's update ids grow over time, they give us the arrival order
+            # Raw documents, de_json modifies the payloads it gets
+            found = list(QueuedUpdate.objects(partition__in=list(partitions), taken=False)
+                         .order_by('update_id').only('id', 'payload').limit(limit).as_pymongo())
+            if found:
+                QueuedUpdate.objects(id__in=[doc['_id'] for doc in found]).update(set__taken=True)
+                return [(doc['_id'], doc['payload']) for doc in found]
+            if time.monotonic() >= deadline:
+                return []
+            time.sleep(self.poll_interval)
+
+    def ack(self, receipt):
+        QueuedUpdate.objects(id=receipt).delete()
+
+    def recover(self, partitions):
+        recovered = QueuedUpdate.objects(partition__in=list(partitions), taken=True).update(set__taken=False)
+        if recovered:
+            log.warning("Re-queued %d updates left unprocessed by a previous worker", recovered)
+        return recovered
+
+    def __len__(self):
+        return QueuedUpdate.objects.count()
+
+
+class UpdateConsumer(threading.Thread):
+    def __init__(self, adapter, queue, partitions, workers=5, chat_concurrency=1, batch_size=100):
+        """Feeds the updates in some partitions of an UpdateQueue to `adapter.process_update`.
+
+        Updates are dispatched through a ChatDispatcher, and acknowledged once processed."""
+        super(UpdateConsumer, self).__init__()
+        self.adapter = adapter
+        self.queue = queue
+        self.partitions = list(partitions)
+        self.batch_size = batch_size
+        self.executor = ThreadPoolExecutor(max_workers=int(workers))
+        self.dispatcher = ChatDispatcher(self.executor, self.adapter.process_update,
+                                         max_in_flight=chat_concurrency)
+        self.running = False
+        self.name = 'update-consumer-{}'.format('-'.join(str(p) for p in self.partitions))
+        self.daemon = True
+
+    def run(self):
+        self.running = True
+        log.info("Consuming updates from partitions %s", self.partitions)
+        self.queue.recover(self.partitions)
+        while self.running:
+            try:
+                taken = self.queue.take(self.partitions, self.batch_size, timeout=1)
+            except Exception as e:
+                log.exception(e)
+                time.sleep(1)
+                continue
+            for receipt, payload in taken:
+                self.dispatch(receipt, payload)
+
+    def dispatch(self, receipt, payload):
+        try:
+            update = telegram.Update.de_json(payload, getattr(self.adapter, 'bot', None))
+        except Exception as e:
+            log.exception(e)
+            self.queue.ack(receipt)
+            return
+        future = self.dispatcher.submit(update)
+        future.add_done_callback(lambda f: self.ack(receipt))
+
+    def ack(self, receipt):
+        try:
+            self.queue.ack(receipt)
+        except Exception as e:
+            log.exception(e)
+
+    def stop(self):
+        """Stop consuming, updates already taken are allowed to finish"""
+        self.running = False
+        if self.is_alive() and threading.current_thread() is not self:
+            # Let it hand over what it already took
+            self.join()
+        self.dispatcher.wait_idle()
+        self.executor.shutdown()
+
+
+def worker_partitions(partitions, index, count):
+    """Partitions owned by worker number `index` (0 based) out of `count`."""
+    if not 0 <= index < count:
+        raise ValueError('worker index should be between 0 and {}'.format(count - 1))
+    return [p for p in range(partitions) if p % count == index]
+
+
+def start_local_consumers(adapter, config):
+    """Start the consumers of a local update queue in this process, returns them."""
+    qconfig = {}
+    qconfig.update(UPDATE_QUEUE_DEFAULTS)
+    qconfig.update(config.get('update_queue', {}))
+    updater_config = config.get('updater', {})
+
+    count = int(qconfig.get('local_workers'))
+    consumers = []
+    for index in range(count):
+        consumer = UpdateConsumer(adapter, UPDATE_QUEUE,
+                                  worker_partitions(UPDATE_QUEUE.partitions, index, count),
+                                  workers=updater_config.get('polling_workers', 5),
+                                  chat_concurrency=updater_config.get('chat_concurrency', 1),
+                                  batch_size=qconfig.get('batch_size'))
+        consumer.start()
+        consumers.append(consumer)
+    return consumers
+
+
+def configure_update_queue(config):
+    """Returns the UpdateQueue described by the `update_queue` config, None if disabled."""
+    global UPDATE_QUEUE
+
+    qconfig = {}
+    qconfig.update(UPDATE_QUEUE_DEFAULTS)
+    qconfig.update(config.get('update_queue', {}))
+
+    if not qconfig.get('enabled'):
+        UPDATE_QUEUE = None
+    elif qconfig.get('backend') == 'local':
+        UPDATE_QUEUE = LocalUpdateQueue(partitions=qconfig.get('partitions'))
+    elif qconfig.get('backend') == 'mongo':
+        UPDATE_QUEUE = MongoUpdateQueue(partitions=qconfig.get('partitions'),
+                                        poll_interval=qconfig.get('poll_interval'))
+    else:
+        raise ValueError('update_queue backend should be one of: local, mongo')
+    return UPDATE_QUEUE
+
+
+def get_update_queue():
+    return UPDATE_QUEUE
@@ -0,0 +1,211 @@
+from marvinbot.models import User
+from marvinbot.signals import bot_shutdown
+from collections import OrderedDict
+from pymongo import UpdateOne
+import threading
+import logging
+import time
+
+
+log = logging.getLogger(__name__)
+
+
+__all__ = ['UserUpsertBuffer', 'configure_user_upserts', 'get_user_upserts']
+
+
+USER_UPSERTS_DEFAULTS = {
+    # Seconds changes are collected before being written
+    'window': 1.0,
+    # Flush early once this many users are waiting
+    'max_batch': 500,
+    # Past this many unwritten users (e.g. MongoDB is down), the oldest ones are dropped
+    'max_pending': 10000,
+    # Longest wait between flush attempts while they fail, the wait doubles on each failure
+    'max_backoff': 300,
+}
+
+USER_UPSERTS = None
+
+
+class UserUpsertBuffer(object):
+    def __init__(self, window=1.0, max_batch=500, max_pending=10000, max_backoff=300):
+        """Collects new users and name changes, and writes them every `window` seconds with
+        a single `bulk_write`. A user seen several times in a window is written once, with
+        the latest names. See `User.from_telegram(..., buffered=True)`.
+
+        While flushes fail they're retried with a growing delay, up to `max_backoff`
+        seconds. Past `max_pending` waiting users the oldest ones are dropped, they're
+        written again the next time they show up."""
+        self.window = window
+        self.max_batch = max_batch
+        self.max_pending = max_pending
+        self.max_backoff = max_backoff
+        # user id -> {field: value}
+        self.pending = OrderedDict()
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.running = False
+        self._wakeup = threading.Event()
+        self._thread = None
+        # Set while flushes fail, filling up doesn't cut the retry delay short then
+        self._backing_off = False
+        # Set once users got dropped, until a flush works again
+        self._dropping = False
+        # Metrics
+        self.dropped = 0
+        self.failures = 0
+        self.flushes = 0
+        self.upserts = 0
+        self.deduplicated = 0
+        self.last_batch_size = 0
+        self.max_batch_size = 0
+        self.last_flush_latency = 0.0
+        self.max_flush_latency = 0.0
+        self.total_flush_latency = 0.0
+
+    def add(self, user_id, **fields):
+        with self.lock:
+            if user_id in self.pending:
+                self.deduplicated += 1
+                self.pending[user_id].update(fields)
+            else:
+                self.pending[user_id] = dict(fields)
+                self._drop_oldest()
+            pending = len(self.pending)
+        if not self.window:
+            self.flush()
+        elif pending >= self.max_batch and not self._backing_off:
+            self._wakeup.set()
+
+    def _drop_oldest(self):
+        dropped = 0
+        while self.max_pending and len(self.pending) > self.max_pending:
+            self.pending.popitem(last=False)
+            dropped += 1
+        if not dropped:
+            return
+        self.dropped += dropped
+        if not self._dropping:
+            self._dropping = True
+            log.warning("Too many users waiting to be written, dropping the oldest ones")
+
+    def flush(self):
+        """Write every pending user, returns how many were written."""
+        with self.flush_lock:
+            with self.lock:
+                batch, self.pending = self.pending, OrderedDict()
+            if not batch:
+                return 0
+            defaults = User().to_mongo()
+            defaults.pop('_id', None)
+            operations = []
+            for user_id, fields in batch.items():
+                on_insert = {key: value for key, value in defaults.items() if key not in fields}
+                update = {'$set': fields}
+                if on_insert:
+                    update['$setOnInsert'] = on_insert
+                operations.append(UpdateOne({'_id': user_id}, update, upsert=True))
+
+            started = time.perf_counter()
+            try:
+                User._get_collection().bulk_write(operations, ordered=False)
+            except Exception:
+                with self.lock:
+                    # Retry them on the next flush, newer changes win
+                    for user_id, fields in self.pending.items():
+                        batch.setdefault(user_id, {}).update(fields)
+                    self.pending = batch
+                    self._drop_oldest()
+                    self.failures += 1
+                raise
+            latency = time.perf_counter() - started
+            self._dropping = False
+
+            self.flushes += 1
+            self.upserts += len(operations)
+            self.last_batch_size = len(operations)
+            self.max_batch_size = max(self.max_batch_size, len(operations))
+            self.last_flush_latency = latency
+            self.max_flush_latency = max(self.max_flush_latency, latency)
+            self.total_flush_latency += latency
+            return len(operations)
+
+    def start(self):
+        if self._thread or not self.window:
+            return
+        self.running = True
+        self._thread = threading.Thread(target=self._flush_periodically, name='user-upserts', daemon=True)
+        self._thread.start()
+
+    def stop(self, flush=True):
+        self.running = False
+        self._wakeup.set()
+        if self._thread and self._thread is not threading.current_thread():
+            self._thread.join()
+        self._thread = None
+        if flush:
+            self.flush()
+
+    def _flush_periodically(self):
+        delay = self.window
+        while self.running:
+            self._wakeup.wait(delay)
+            self._wakeup.clear()
+            if not self.running:
+                return
+            try:
+                self.flush()
+                delay = self.window
+                self._backing_off = False
+            except Exception as e:
+                log.exception(e)
+                delay = min(delay * 2, self.max_backoff)
+                self._backing_off = True
+                log.warning("Couldn't write %d users (%d dropped so far), retrying in %ss",
+                            len(self.pending), self.dropped, delay)
+
+    def stats(self):
+        return {
+            'pending': len(self.pending),
+            'dropped': self.dropped,
+            'failures': self.failures,
+            'flushes': self.flushes,
+            'upserts': self.upserts,
+            'deduplicated': self.deduplicated,
+            'last_batch_size': self.last_batch_size,
+            'max_batch_size': self.max_batch_size,
+            'avg_batch_size': self.upserts / self.flushes if self.flushes else 0,
+            'last_flush_latency': self.last_flush_latency,
+            'max_flush_latency': self.max_flush_latency,
+            'avg_flush_latency': self.total_flush_latency / self.flushes if self.flushes else 0,
+        }
+
+
+def _flush_on_shutdown(adapter):
+    if USER_UPSERTS is not None:
+        USER_UPSERTS.stop()
+
+
+def configure_user_upserts(config):
+    global USER_UPSERTS
+
+    uconfig = {}
+    uconfig.update(USER_UPSERTS_DEFAULTS)
+    uconfig.update(config.get('user_upserts', {}))
+
+    if USER_UPSERTS:
+        USER_UPSERTS.stop()
+    USER_UPSERTS = UserUpsertBuffer(window=uconfig.get('window'), max_batch=uconfig.get('max_batch'),
+                                    max_pending=uconfig.get('max_pending'), max_backoff=uconfig.get('max_backoff'))
+    USER_UPSERTS.start()
+    bot_shutdown.connect(_flush_on_shutdown)
+    return USER_UPSERTS
+
+
+def get_user_upserts():
+    global USER_UPSERTS
+    if USER_UPSERTS is None:
+        USER_UPSERTS = UserUpsertBuffer()
+        USER_UPSERTS.start()
+        bot_shutdown.connect(_flush_on_shutdown)
+    return USER_UPSERTS
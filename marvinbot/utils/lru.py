@@ -0,0 +1,145 @@
+from collections import OrderedDict
+import threading
+import time
+
+
+__all__ = ['LRUCache']
+
+
+_MISSING = object()
+
+
+class LRUCache(object):
+    def __init__(self, max_size=1024, ttl=None, on_evict=None, can_evict=None):
+        """Thread-safe mapping that keeps at most `max_size` entries.
+
+        Parameters:
+        - `max_size`: least recently used entries get evicted past this size. None means unbounded.
+        - `ttl`: entries are considered expired `ttl` seconds after they were set. Reads don't
+          extend it, so a value read all the time still gets refreshed.
+        - `on_evict`: (optional) function(key, value) called after an entry is evicted or expires.
+        - `can_evict`: (optional) function(key, value) -> bool, entries it returns False for
+          are never evicted nor expired. The cache goes over `max_size` if it has to.
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self.on_evict = on_evict
+        self.can_evict = can_evict
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._data = OrderedDict()
+        self._lock = threading.RLock()
+
+    def _expires(self, now):
+        return now + self.ttl if self.ttl is not None else None
+
+    @staticmethod
+    def _is_expired(expires, now):
+        return expires is not None and now > expires
+
+    def _evictable(self, key, value):
+        return self.can_evict is None or self.can_evict(key, value)
+
+    def _notify(self, evicted):
+        if self.on_evict:
+            for key, value in evicted:
+                self.on_evict(key, value)
+
+    def get(self, key, default=None):
+        now = time.monotonic()
+        evicted = []
+        with self._lock:
+            entry = self._data.get(key, _MISSING)
+            if entry is _MISSING:
+                self.misses += 1
+                return default
+            value, expires = entry
+            if self._is_expired(expires, now) and self._evictable(key, value):
+                del self._data[key]
+                self.evictions += 1
+                self.misses += 1
+                evicted.append((key, value))
+                value = default
+            else:
+                self._data.move_to_end(key)
+                self.hits += 1
+        self._notify(evicted)
+        return value
+
+    def set(self, key, value):
+        now = time.monotonic()
+        evicted = []
+        with self._lock:
+            self._data[key] = (value, self._expires(now))
+            self._data.move_to_end(key)
+            excess = len(self._data) - self.max_size if self.max_size is not None else 0
+            if excess > 0:
+                for old_key, (old_value, expires) in self._data.items():
+                    if len(evicted) == excess:
+                        break
+                    if self._evictable(old_key, old_value):
+                        evicted.append((old_key, old_value))
+                for old_key, old_value in evicted:
+                    del self._data[old_key]
+                    self.evictions += 1
+        self._notify(evicted)
+
+    def get_or_create(self, key, creator):
+        """Returns the value for key, calling `creator()` to make it if missing."""
+        with self._lock:
+            value = self.get(key, _MISSING)
+            if value is _MISSING:
+                value = creator()
+                self.set(key, value)
+            return value
+
+    def pop(self, key, default=None):
+        with self._lock:
+            entry = self._data.pop(key, _MISSING)
+        return default if entry is _MISSING else entry[0]
+
+    def expire(self):
+        """Drop every expired entry, returns how many were dropped."""
+        if self.ttl is None:
+            return 0
+        now = time.monotonic()
+        evicted = []
+        with self._lock:
+            # Ordered by use, not by age, so all of them have to be looked at
+            for key, (value, expires) in list(self._data.items()):
+                if not self._is_expired(expires, now) or not self._evictable(key, value):
+                    continue
+                del self._data[key]
+                self.evictions += 1
+                evicted.append((key, value))
+        self._notify(evicted)
+        return len(evicted)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def items(self):
+        """Snapshot of (key, value) pairs, least recently used first. Doesn't touch them."""
+        with self._lock:
+            return [(key, value) for key, (value, expires) in self._data.items()]
+
+    def stats(self):
+        return {
+            'size': len(self),
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
+
+    def __contains__(self, key):
+        with self._lock:
+            entry = self._data.get(key, _MISSING)
+            return entry is not _MISSING and not self._is_expired(entry[1], time.monotonic())
+
+    def __len__(self):
+        return len(self._data)
+
+    def __setitem__(self, key, value):
+        self.set(key, value)
@@ -63,6 +63,10 @@ def create_app():
     from marvinbot.views import marvinbot
 
     app.register_blueprint(marvinbot)
+    if adapter.updater_mode == 'webhook' and adapter.updater.config.get('server') == 'flask':
+        # Receive Telegram updates on this app
+        app.register_blueprint(adapter.updater.blueprint())
+        adapter.updater.start()
     load_plugins(config, webapp=app, adapter=adapter)
 
     # Add the before request handler
@@ -0,0 +1,189 @@
+from marvinbot.dispatch import ChatDispatcher
+from concurrent.futures import ThreadPoolExecutor
+from werkzeug.serving import make_server, WSGIRequestHandler
+from werkzeug.wrappers import Request, Response
+from telegram import Update
+import ipaddress
+import threading
+import logging
+import secrets
+import hmac
+import json
+
+
+log = logging.getLogger(__name__)
+
+
+__all__ = ['WebhookUpdater', 'WEBHOOK_DEFAULTS']
+
+
+WEBHOOK_DEFAULTS = {
+    # Public HTTPS url Telegram should post updates to, the webhook is registered on start if set
+    'url': None,
+    # standalone: serve on listen:port from a thread of our own
+    # flask: mount on the app from marvinbot.web.create_app
+    'server': 'standalone',
+    # Anything but a loopback address needs a secret
+    'listen': '127.0.0.1',
+    'port': 8443,
+    'path': '/telegram/webhook',
+    # Telegram sends it in the X-Telegram-Bot-Api-Secret-Token header of every update, requests
+    # without it are refused. Also appended to the path. A random one is made up if not set
+    'secret': None,
+    'max_connections': 40,
+    'allowed_updates': None,
+}
+
+
+SECRET_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+
+
+def is_loopback(host):
+    if host == 'localhost':
+        return True
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return False
+
+
+class QuietRequestHandler(WSGIRequestHandler):
+    def log_request(self, *args, **kwargs):
+        # Access logs would be noisy, and leak the secret path
+        pass
+
+
+class WebhookUpdater(threading.Thread):
+    def __init__(self, adapter, workers=None):
+        """Receives updates pushed by Telegram over HTTP, instead of polling for them.
+
+        Every posted update is deserialized, handed to the same per-chat dispatch pipeline
+        the polling updater uses (see `ChatDispatcher`) and acknowledged right away, without
+        waiting for the handlers to run. Requests without the secret token Telegram was
+        given when registering the webhook are refused.
+
+        With `server: standalone` the receiver is a small werkzeug server running on this
+        thread. With `server: flask` the receiver is a blueprint mounted by `create_app`,
+        and this thread only registers the webhook."""
+        from marvinbot.polling import UPDATER_DEFAULTS
+
+        self.adapter = adapter
+        updater_config = dict(UPDATER_DEFAULTS)
+        updater_config.update(self.adapter.config.get('updater', {}))
+        self.config = dict(WEBHOOK_DEFAULTS)
+        self.config.update(updater_config.get('webhook', {}))
+        if self.config['server'] not in ('standalone', 'flask'):
+            raise ValueError('webhook server should be one of: standalone, flask')
+        if self.config['server'] == 'standalone' and not self.config['secret'] \
+                and not is_loopback(self.config['listen']):
+            raise ValueError('webhook secret must be set to listen on {}'.format(self.config['listen']))
+        # Only works if we register the webhook (see `url`) when it's made up
+        self.secret_token = self.config['secret'] or secrets.token_urlsafe(32)
+
+        workers = int(workers or updater_config.get('polling_workers'))
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.dispatcher = ChatDispatcher(self.executor, self.adapter.receive_update,
+                                         max_in_flight=updater_config.get('chat_concurrency'))
+        self.server = None
+        self.received = 0
+        self.rejected = 0
+
+        super(WebhookUpdater, self).__init__()
+        self.name = 'telegram-webhook-thread'
+        self.daemon = True
+        log.info('Starting webhook updater, server=%s, workers=%d', self.config['server'], workers)
+
+    @property
+    def path(self):
+        path = self.config['path'].rstrip('/')
+        if self.config['secret']:
+            path = '{}/{}'.format(path, self.config['secret'])
+        return path
+
+    @property
+    def url(self):
+        if not self.config['url']:
+            return None
+        return self.config['url'].rstrip('/') + self.path
+
+    def receive(self, payload):
+        """Deserialize an update and queue it for dispatch, returns a Future or None if ignored."""
+        update = Update.de_json(payload, self.adapter.bot)
+        if update is None:
+            return None
+        self.received += 1
+        return self.dispatcher.submit(update)
+
+    def handle(self, body, secret_token=None):
+        """Handle a request body posted by Telegram, returns the HTTP status to reply with.
+
+        :param secret_token: the X-Telegram-Bot-Api-Secret-Token header of the request."""
+        if not hmac.compare_digest((secret_token or '').encode('utf-8'), self.secret_token.encode('utf-8')):
+            self.rejected += 1
+            return 403
+        try:
+            payload = json.loads(body.decode('utf-8') if isinstance(body, bytes) else body)
+        except ValueError:
+            self.rejected += 1
+            return 400
+        if not isinstance(payload, dict):
+            self.rejected += 1
+            return 400
+        try:
+            self.receive(payload)
+        except Exception as e:
+            # Telegram would keep retrying an update we can't parse, so don't report an error
+            log.exception(e)
+            self.rejected += 1
+        return 200
+
+    def wsgi_app(self, environ, start_response):
+        request = Request(environ)
+        if request.path.rstrip('/') != self.path:
+            response = Response(status=404)
+        elif request.method != 'POST':
+            response = Response(status=405)
+        else:
+            response = Response(status=self.handle(request.get_data(), request.headers.get(SECRET_HEADER)))
+        return response(environ, start_response)
+
+    def blueprint(self):
+        """Flask blueprint exposing the receiver on `path`"""
+        from flask import Blueprint, request
+
+        blueprint = Blueprint('telegram_webhook', __name__)
+
+        @blueprint.route(self.path, methods=['POST'])
+        def webhook():
+            return '', self.handle(request.get_data(), request.headers.get(SECRET_HEADER))
+
+        return blueprint
+
+    def register_webhook(self):
+        if not self.url:
+            log.info('No webhook url configured, not registering it with Telegram')
+            return
+        log.info('Registering webhook with Telegram')
+        self.adapter.bot.setWebhook(url=self.url, max_connections=self.config['max_connections'],
+                                    allowed_updates=self.config['allowed_updates'],
+                                    secret_token=self.secret_token)
+
+    def run(self):
+        try:
+            self.register_webhook()
+        except Exception as e:
+            log.exception(e)
+        if self.config['server'] != 'standalone':
+            return
+        self.server = make_server(self.config['listen'], int(self.config['port']), self.wsgi_app,
+                                  threaded=True, request_handler=QuietRequestHandler)
+        log.info('Listening for webhook updates on %s:%s%s',
+                 self.config['listen'], self.server.server_port, self.config['path'])
+        self.server.serve_forever()
+
+    def stop(self):
+        """Stop receiving, in-flight updates are allowed to finish"""
+        if self.server:
+            self.server.shutdown()
+        self.dispatcher.wait_idle()
+        self.executor.shutdown()
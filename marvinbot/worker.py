@@ -0,0 +1,96 @@
+"""Worker process: handles the updates an ingest process publishes to the update queue.
+
+Run as many as needed, each one with its own index:
+
+    python -m marvinbot.worker --index 0 --count 2
+    python -m marvinbot.worker --index 1 --count 2
+
+Every worker owns the partitions `p % count == index`, so a chat is always handled by
+the same worker, in order. The ingest process is the regular bot (`run_standalone.py`)
+with `update_queue.enabled` set.
+
+Scheduled jobs only run in the ingest process. Workers get a scheduler that's never
+started, so plugins can still call `add_job` in their setup, but their jobs don't run
+once per worker. On SIGINT/SIGTERM a worker shuts down like the bot does (see
+`marvinbot.runner.shutdown_bot`): it finishes the updates it took, fires `bot_shutdown`
+(flushing the buffered writes) and sends the queued messages."""
+from marvinbot.log import configure_logging
+from marvinbot.utils import get_config, configure_mongoengine
+from marvinbot.cache import configure_cache
+import argparse
+import logging
+import signal
+import sys
+
+
+log = logging.getLogger(__name__)
+
+
+def prepare_adapter(config):
+    """Configure an adapter that only processes updates, with every plugin loaded."""
+    from marvinbot.core import configure_adapter
+    from marvinbot.net import configure_downloader
+    from marvinbot.plugins import load_plugins
+    from marvinbot.scheduler import configure_scheduler
+
+    adapter = configure_adapter(config)
+    configure_downloader(config)
+    # We're on the consuming end
+    adapter.publish_updates = False
+    adapter.is_worker = True
+    # Not started, the jobs run in the ingest process
+    configure_scheduler(config, adapter)
+
+    import marvinbot.tasks  # noqa: F401 (registers the core handlers)
+    load_plugins(config, adapter)
+    return adapter
+
+
+def run_worker(config, index, count):
+    from marvinbot.updatequeue import UpdateConsumer, LocalUpdateQueue, worker_partitions, UPDATE_QUEUE_DEFAULTS
+
+    adapter = prepare_adapter(config)
+    queue = adapter.update_queue
+    if queue is None or isinstance(queue, LocalUpdateQueue):
+        raise ValueError('Workers need update_queue enabled, with the mongo backend')
+
+    qconfig = dict(UPDATE_QUEUE_DEFAULTS)
+    qconfig.update(config.get('update_queue', {}))
+    updater_config = config.get('updater', {})
+    consumer = UpdateConsumer(adapter, queue, worker_partitions(queue.partitions, index, count),
+                              workers=updater_config.get('polling_workers', 5),
+                              chat_concurrency=updater_config.get('chat_concurrency', 1),
+                              batch_size=qconfig.get('batch_size'))
+    consumer.daemon = False
+    adapter.consumers = [consumer]
+    consumer.start()
+    return consumer
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Handle updates published by the marvinbot ingest process')
+    parser.add_argument('--index', type=int, default=0, help='This worker\'s number, starting at 0')
+    parser.add_argument('--count', type=int, default=1, help='Total amount of workers')
+    parser.add_argument('--config', default=None, help='Settings file')
+    args = parser.parse_args(argv)
+
+    config = get_config(args.config)
+    configure_logging(config)
+    configure_mongoengine(config)
+    configure_cache(config)
+
+    from marvinbot.runner import shutdown_bot
+
+    consumer = run_worker(config, args.index, args.count)
+
+    def terminate(signum, frame):
+        log.info('Stopping worker %d...', args.index)
+        shutdown_bot(consumer.adapter)
+
+    signal.signal(signal.SIGINT, terminate)
+    signal.signal(signal.SIGTERM, terminate)
+    consumer.join()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -35,7 +35,7 @@ setup(name='marvinbot',
       package_data={'': ['*.ini']},
       install_requires=REQUIREMENTS,
       setup_requires=['pytest-runner'],
-      tests_require=['pytest'],
+      tests_require=['pytest', 'mongomock'],
       dependency_links=[
 
       ],)
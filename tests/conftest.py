@@ -0,0 +1,12 @@
+import pytest
+
+
+@pytest.fixture
+def mongo():
+    """An in-memory MongoDB for the models, skips the test if mongomock isn't installed."""
+    mongomock = pytest.importorskip('mongomock')
+    import mongoengine
+
+    mongoengine.connect('marvinbot-test', mongo_client_class=mongomock.MongoClient)
+    yield
+    mongoengine.disconnect()
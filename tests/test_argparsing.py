@@ -0,0 +1,65 @@
+from marvinbot.argparsing import FastPathParser
+import argparse
+import itertools
+import pytest
+
+
+class Error(Exception):
+    pass
+
+
+class Parser(argparse.ArgumentParser):
+    def error(self, message):
+        raise Error(message)
+
+
+SPECS = [
+    [(('--enable',), dict(nargs='+')), (('--disable',), dict(nargs='+'))],
+    [(('token',), dict(nargs='?'))],
+    [(('--role',), dict(choices=['owner', 'admin'])), (('--forget',), dict(action='store_true'))],
+    [(('-n', '--num'), dict(type=int, default='5')), (('--x',), dict(nargs='*')),
+     (('--y',), dict(nargs='?', const='c', default='d')), (('--z',), dict(action='store_false'))],
+    [(('a',), dict(type=int)), (('b',), dict(nargs='*'))],
+]
+
+TOKENS = ['a', '1', '--enable', '--disable', '--role', 'admin', 'bad', '--forget',
+          '-n', '--num', '--x', '--y', '--z', '--en', '--role=admin', '-5']
+
+
+def make_parser(spec):
+    parser = Parser(prog='/test', add_help=False)
+    for args, kwargs in spec:
+        parser.add_argument(*args, **kwargs)
+    return parser
+
+
+def parse(parser, args):
+    try:
+        namespace, extras = parser.parse_known_args(list(args))
+        return vars(namespace), extras
+    except Error:
+        return 'error'
+
+
+@pytest.mark.parametrize('spec', SPECS)
+def test_same_result_as_argparse(spec):
+    parser = make_parser(spec)
+    fast = FastPathParser(parser)
+    for length in range(4):
+        for args in itertools.product(TOKENS, repeat=length):
+            assert parse(fast, args) == parse(parser, args), args
+
+
+def test_cached_results_are_copies():
+    fast = FastPathParser(make_parser(SPECS[0]))
+    namespace, extras = fast.parse_known_args(['--enable', 'a', 'b'])
+    namespace.enable.append('c')
+    assert fast.parse_known_args(['--enable', 'a', 'b'])[0].enable == ['a', 'b']
+
+
+def test_picks_up_new_arguments():
+    parser = make_parser([])
+    fast = FastPathParser(parser)
+    assert fast.parse_known_args(['--flag'])[1] == ['--flag']
+    parser.add_argument('--flag', action='store_true')
+    assert fast.parse_known_args(['--flag']) == (argparse.Namespace(flag=True), [])
@@ -0,0 +1,72 @@
+from marvinbot.banlist import BannedUserSet
+from marvinbot.models import User
+from marvinbot import models
+from datetime import timedelta
+import pytest
+
+
+@pytest.fixture(autouse=True)
+def user_cache(monkeypatch):
+    monkeypatch.setattr(models, 'USER_CACHE', models.LRUCache())
+
+
+def test_loads_banned_users_and_applies_local_changes(mongo):
+    User(id=1, banned=True).save()
+    User(id=2).save()
+    banlist = BannedUserSet()
+
+    assert 1 in banlist and 2 not in banlist
+    banlist.ban(2)
+    banlist.unban(1)
+    assert 2 in banlist and 1 not in banlist
+    assert len(banlist) == 1
+
+
+@pytest.mark.parametrize('change', ['set_banned', 'save', 'update'])
+def test_sync_picks_up_changes_from_other_processes(mongo, change):
+    User(id=1).save()
+    User(id=2, banned=True).save()
+    banlist = BannedUserSet()
+    assert 1 not in banlist and 2 in banlist
+    banlist.last_sync -= timedelta(seconds=10)
+
+    if change == 'set_banned':
+        for user_id, banned in [(1, True), (2, False)]:
+            user = User.objects.get(id=user_id)
+            user.set_banned(banned)
+            user.save()
+    elif change == 'save':
+        for user_id, banned in [(1, True), (2, False)]:
+            user = User.objects.get(id=user_id)
+            user.banned = banned
+            user.save()
+    else:
+        User.objects(id=1).update(set__banned=True)
+        User.objects(id=2).update_one(banned=False)
+
+    assert banlist.sync() == 2
+    assert 1 in banlist and 2 not in banlist
+
+
+def test_unrelated_changes_leave_ban_updated_alone(mongo):
+    User(id=1).save()
+    user = User.objects.get(id=1)
+    user.username = 'someone'
+    user.save()
+    User.objects(id=1).update(set__first_name='Some')
+
+    assert User.objects.get(id=1).ban_updated is None
+
+
+def test_full_sync_drops_users_deleted_elsewhere(mongo):
+    User(id=1, banned=True).save()
+    User(id=2, banned=True).save()
+    banlist = BannedUserSet()
+    assert 1 in banlist
+    banlist.last_sync -= timedelta(seconds=10)
+
+    User.objects(id=1).delete()
+    banlist.sync()
+    assert 1 in banlist
+    assert banlist.sync(full=True) == 1
+    assert 1 not in banlist and 2 in banlist
@@ -0,0 +1,76 @@
+from marvinbot.cache_impl import create_cache, configure_cache, cache_stats
+
+
+def make_region(**arguments):
+    settings = {'backend': 'marvinbot.tiered', 'expiration_time': 60}
+    settings.update({'arguments.{}'.format(key): value for key, value in arguments.items()})
+    return configure_cache({'cache': settings}, create_cache())
+
+
+def test_front_tier_is_bounded_and_counts_per_namespace():
+    region = make_region(max_size=2)
+    calls = []
+
+    @region.cache_on_arguments()
+    def square(x):
+        calls.append(x)
+        return x * x
+
+    assert [square(x) for x in (1, 2, 1, 3, 1)] == [1, 4, 1, 9, 1]
+    assert calls == [1, 2, 3]
+    stats = cache_stats(region)
+    assert stats['size'] == 2
+    assert stats['evictions'] == 1
+    namespace = stats['namespaces']['{}:square'.format(__name__)]
+    assert namespace['hits'] == 2
+    assert namespace['sets'] == 3
+
+
+def test_file_tier_is_shared_between_regions(tmp_path):
+    # Stand-ins for two processes
+    first = make_region(second_tier='file', path=str(tmp_path))
+    second = make_region(second_tier='file', path=str(tmp_path))
+
+    first.set('answer', 42)
+    assert second.get('answer') == 42
+    assert cache_stats(second)['second_tier_hits'] == 1
+    second.delete('answer')
+    assert make_region(second_tier='file', path=str(tmp_path)).get('answer') != 42
+
+
+def test_explicit_namespaces_are_counted_separately():
+    region = make_region()
+
+    @region.cache_on_arguments(namespace='users')
+    def lookup(x):
+        return x
+
+    @region.cache_on_arguments()
+    def plain(x):
+        return x
+
+    lookup('a|b')
+    lookup('a|b')
+    plain('users|x')
+    namespaces = cache_stats(region)['namespaces']
+    assert namespaces['{}:lookup|users'.format(__name__)]['hits'] == 1
+    assert namespaces['{}:plain'.format(__name__)]['sets'] == 1
+
+
+class BrokenStore(object):
+    def get(self, key):
+        raise ConnectionError('down')
+
+    def set(self, key, value, ex=None):
+        raise ConnectionError('down')
+
+    def delete(self, key):
+        raise ConnectionError('down')
+
+
+def test_second_tier_errors_are_not_raised():
+    region = make_region(store=BrokenStore())
+    region.set('answer', 42)
+    assert region.get('answer') == 42
+    region.delete('answer')
+    assert region.get('answer') != 42
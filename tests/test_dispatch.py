@@ -0,0 +1,130 @@
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from types import SimpleNamespace
+from marvinbot.handlers import CommandHandler, MessageHandler, CallbackQueryHandler
+from marvinbot.dispatch import DispatchIndex, ChatDispatcher
+
+
+ADAPTER = SimpleNamespace(bot_info=SimpleNamespace(username='marvin'))
+
+
+def noop(update, *args, **kwargs):
+    pass
+
+
+def make_update(text, data=None):
+    message = SimpleNamespace(text=text, date=datetime.now())
+    query = SimpleNamespace(data=data) if data is not None else None
+    return SimpleNamespace(effective_message=message, callback_query=query)
+
+
+def make_handlers():
+    handlers = defaultdict(list)
+    specs = [
+        (2, CommandHandler('start', noop, adapter=ADAPTER)),
+        (0, MessageHandler([lambda m: 'x' in m.text], noop, adapter=ADAPTER)),
+        (1, CommandHandler('start', noop, adapter=ADAPTER)),
+        (1, CallbackQueryHandler('bot:', noop, adapter=ADAPTER)),
+        (2, CallbackQueryHandler('bot:leave', noop, adapter=ADAPTER)),
+        (3, CommandHandler('stop', noop, adapter=ADAPTER)),
+        (2, MessageHandler([lambda m: True], noop, adapter=ADAPTER)),
+    ]
+    for priority, handler in specs:
+        handler.plugin = None
+        handlers[priority].append(handler)
+    return handlers
+
+
+def full_scan(handlers, update):
+    return [h for priority in sorted(handlers) for h in handlers[priority] if h.can_handle(update)]
+
+
+def indexed(index, update):
+    return [h for h in index.candidates(update) if h.can_handle(update)]
+
+
+def test_same_order_as_full_scan():
+    handlers = make_handlers()
+    index = DispatchIndex(handlers)
+    for text in ['/start', '/start@marvin x', '/start@other', '/stop', '/nope', 'x marks']:
+        update = make_update(text)
+        assert indexed(index, update) == full_scan(handlers, update)
+
+
+def test_callback_prefixes():
+    handlers = make_handlers()
+    index = DispatchIndex(handlers)
+    for data in ['bot:leave_chat:1', 'bot:', 'bo', 'other']:
+        update = make_update('x', data)
+        assert indexed(index, update) == full_scan(handlers, update)
+
+
+def test_disabled_plugins_are_skipped():
+    handlers = make_handlers()
+    plugin = SimpleNamespace(enabled=False)
+    handlers[3][0].plugin = plugin
+    index = DispatchIndex(handlers)
+    assert handlers[3][0] not in index.candidates(make_update('/stop'))
+
+
+def test_chat_dispatcher_keeps_order_per_chat():
+    processed = defaultdict(list)
+
+    def process(update):
+        processed[update.effective_chat.id].append(update.update_id)
+        return update.update_id
+
+    dispatcher = ChatDispatcher(ThreadPoolExecutor(max_workers=4), process)
+    updates = [SimpleNamespace(update_id=i, effective_chat=SimpleNamespace(id=i % 3), effective_user=None)
+               for i in range(100)]
+    futures = [dispatcher.submit(update) for update in updates]
+
+    assert [f.result() for f in futures] == list(range(100))
+    for chat_id, ids in processed.items():
+        assert ids == sorted(ids)
+
+
+def test_regexp_handlers_are_prescreened():
+    from marvinbot.filters import RegexpFilter
+
+    handlers = defaultdict(list)
+    strict = MessageHandler([lambda m: True, RegexpFilter(r'hello')], noop, adapter=ADAPTER)
+    loose = MessageHandler([RegexpFilter(r'bye'), RegexpFilter(r'see ya')], noop, strict=False, adapter=ADAPTER)
+    mixed = MessageHandler([lambda m: True, RegexpFilter(r'bye')], noop, strict=False, adapter=ADAPTER)
+    for handler in [strict, loose, mixed]:
+        handler.plugin = None
+        handlers[1].append(handler)
+    index = DispatchIndex(handlers)
+
+    assert index.candidates(make_update('hello there')) == [strict, mixed]
+    assert index.candidates(make_update('see ya')) == [loose, mixed]
+    for text in ['hello', 'bye', 'see ya', 'nothing']:
+        update = make_update(text)
+        assert indexed(index, update) == full_scan(handlers, update)
+
+
+def test_adapters_run_every_matching_handler(monkeypatch):
+    import asyncio
+    import marvinbot.core as core
+
+    monkeypatch.setattr(core, 'is_user_banned', lambda user: False)
+    for adapter_class in (core.TelegramAdapter, core.AsyncTelegramAdapter):
+        adapter = object.__new__(adapter_class)
+        core.Adapter.__init__(adapter, {})
+        adapter._bot_info = ADAPTER.bot_info
+        calls = []
+        adapter.add_handler(CommandHandler('start', lambda *args, **kwargs: calls.append('final'),
+                                           adapter=adapter, is_final=True), priority=1)
+        adapter.add_handler(MessageHandler([lambda m: True], lambda *args, **kwargs: calls.append('catch all'),
+                                           adapter=adapter), priority=2)
+        update = make_update('/start')
+        update.effective_user = None
+
+        if adapter_class is core.AsyncTelegramAdapter:
+            loop = asyncio.new_event_loop()
+            loop.run_until_complete(adapter.process_update_async(update))
+            loop.close()
+        else:
+            adapter.process_update(update)
+        assert calls == ['final', 'catch all'], adapter_class
@@ -40,3 +40,117 @@ def test_multi_match():
     m = filt('testsome')
     assert m is not None
     assert m.group(0) == 'test' and m.group('exp1') == 'test' and m.group('exp2') is None
+
+
+def test_filter_set_matches_like_individual_filters():
+    from types import SimpleNamespace
+    from marvinbot.filters import RegexpFilterSet
+    import re
+
+    filters = [RegexpFilter(r't[e]+st'), RegexpFilter(r'(?P<word>a+)b'), RegexpFilter(r'(a)\1'),
+               RegexpFilter(r'(?i)hello'), RegexpFilter(r'HELLO', flags=re.I), RegexpFilter(r'\d+'),
+               MultiRegexpFilter({'exp1': r't[e]+st', 'exp2': r's[o]+me'})]
+    filter_set = RegexpFilterSet(filters)
+    assert filter_set.combined and filter_set.separate
+
+    for text in ['test', 'teest', 'aab', 'aa', 'hello', 'Hello', '123', 'some', '', None]:
+        message = SimpleNamespace(text=text)
+        expected = {id(f) for f in filters if f(message)}
+        assert filter_set.matching(text) == expected
+
+
+def test_evaluation_context_memoizes_pure_filters():
+    from types import SimpleNamespace
+    from marvinbot.filters import evaluate, evaluation_context, cost_hint
+
+    calls = []
+
+    @cost_hint(2)
+    def pure(message):
+        calls.append('pure')
+        return True
+
+    def impure(message):
+        calls.append('impure')
+        return True
+
+    message = SimpleNamespace(text='test')
+    with evaluation_context(message):
+        for _ in range(3):
+            assert evaluate(pure, message)
+            assert evaluate(impure, message)
+    assert calls.count('pure') == 1 and calls.count('impure') == 3
+
+    # No memo outside of a dispatch
+    evaluate(pure, message)
+    assert calls.count('pure') == 2
+
+
+def test_filter_group_short_circuits_cheapest_first():
+    from types import SimpleNamespace
+    from marvinbot.filters import FilterGroup, cost_hint
+
+    calls = []
+
+    @cost_hint(10)
+    def expensive(message):
+        calls.append('expensive')
+        return True
+
+    @cost_hint(1)
+    def cheap(message):
+        calls.append('cheap')
+        return False
+
+    def barrier(message):
+        calls.append('barrier')
+        return False
+
+    message = SimpleNamespace(text='test')
+    assert not FilterGroup([expensive, cheap], strict=True).filter(message)
+    assert calls == ['cheap']
+
+    # Plain functions keep their position
+    del calls[:]
+    assert not FilterGroup([barrier, expensive, cheap], strict=True).filter(message)
+    assert calls == ['barrier']
+
+    del calls[:]
+    assert FilterGroup([cheap, expensive], strict=False).filter(message)
+    assert calls == ['cheap', 'expensive']
+
+
+def test_base_filters_without_a_cost_keep_their_position():
+    from types import SimpleNamespace
+    from telegram.ext.filters import BaseFilter
+    from marvinbot.filters import FilterGroup, cost_hint
+
+    class IsReply(BaseFilter):
+        def filter(self, message):
+            return message.reply_to_message is not None
+
+    @cost_hint(0.1)
+    def replied_to_bot(message):
+        return message.reply_to_message.from_user.is_bot
+
+    group = FilterGroup([IsReply(), replied_to_bot], strict=True)
+    assert group.ordered == group.filters
+    assert not group.filter(SimpleNamespace(text='test', reply_to_message=None))
+
+
+def test_filter_stats_go_away_with_the_filter():
+    import gc
+    from types import SimpleNamespace
+    from marvinbot.filters import FILTER_STATS, evaluate, stats_for
+
+    def dynamic(message):
+        return True
+
+    evaluate(dynamic, SimpleNamespace(text='test'))
+    assert stats_for(dynamic).calls == 1
+    size = len(FILTER_STATS)
+    del dynamic
+    gc.collect()
+    assert len(FILTER_STATS) == size - 1
+    # Builtins just aren't measured
+    assert stats_for(len).calls == 0
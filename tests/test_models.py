@@ -0,0 +1,81 @@
+from marvinbot.models import User
+from marvinbot import models
+import pytest
+
+
+@pytest.fixture
+def queries(monkeypatch, mongo):
+    """Counts the finds on the users collection."""
+    monkeypatch.setattr(models, 'USER_CACHE', models.LRUCache())
+    collection = User._get_collection()
+    counter = {'find': 0}
+    find = collection.find
+
+    def counting_find(*args, **kwargs):
+        counter['find'] += 1
+        return find(*args, **kwargs)
+
+    monkeypatch.setattr(collection, 'find', counting_find)
+    return counter
+
+
+def test_by_id_is_served_from_the_cache(queries):
+    User(id=1, username='ann').save()
+    models.USER_CACHE.clear()
+
+    assert User.by_id(1).username == 'ann'
+    assert User.by_id(1).username == 'ann'
+    assert User.by_id(2) is None
+    assert User.by_id(2) is None
+    assert queries['find'] == 2
+
+
+def test_cached_users_are_copies(queries):
+    User(id=1, username='ann').save()
+    User.by_id(1).username = 'changed'
+    assert User.by_id(1).username == 'ann'
+
+
+def test_save_and_delete_write_through(queries):
+    user = User(id=1, username='ann')
+    user.save()
+    user.username = 'ann_b'
+    user.save()
+    assert User.by_id(1).username == 'ann_b'
+
+    user.delete()
+    assert User.by_id(1) is None
+    assert queries['find'] == 1
+
+
+def test_by_ids_only_queries_the_misses(queries):
+    for user_id in (1, 2, 3):
+        User(id=user_id, username='user{}'.format(user_id)).save()
+    models.USER_CACHE.clear()
+    User.by_id(1)
+    User.by_id(4)
+    queries['find'] = 0
+
+    users = User.by_ids([1, 2, 3, 4, 5, 2])
+    assert sorted(users) == [1, 2, 3]
+    assert users[2].username == 'user2'
+    assert queries['find'] == 1
+
+    # The misses are cached now, absent users too
+    assert sorted(User.by_ids([1, 2, 3, 4, 5])) == [1, 2, 3]
+    assert queries['find'] == 1
+
+
+def test_outside_changes_show_up_after_ttl_even_if_read_all_the_time(queries, monkeypatch):
+    import time
+
+    monkeypatch.setattr(models, 'USER_CACHE', models.LRUCache(ttl=0.3))
+    User(id=1, username='ann').save()
+    User.objects(id=1).update(set__banned=True)
+
+    # Read more often than the ttl
+    deadline = time.monotonic() + 1
+    while User.by_id(1).banned is False and time.monotonic() < deadline:
+        time.sleep(0.05)
+    assert User.by_id(1).banned
+    assert time.monotonic() < deadline
@@ -0,0 +1,337 @@
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from types import SimpleNamespace
+import requests
+import threading
+import asyncio
+import time
+import os
+import pytest
+from marvinbot import net
+from marvinbot.errors import DownloadException, DownloadTimeout
+from marvinbot.filecache import FileCache
+
+
+PAYLOAD = os.urandom(300 * 1024)
+ETAG = '"v1"'
+REQUESTS = []
+
+
+class FileHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        REQUESTS.append((self.path, self.headers.get('Range')))
+        if self.path in ('/ranged.bin', '/flaky.bin', '/shifted.bin'):
+            return self.send_range()
+        if self.path not in ('/file.bin', '/slow.bin', '/copy.bin'):
+            self.send_error(404)
+            return
+        if self.path == '/slow.bin':
+            time.sleep(0.3)
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(PAYLOAD)))
+        self.end_headers()
+        self.wfile.write(PAYLOAD)
+
+    def send_range(self):
+        start, end = 0, len(PAYLOAD) - 1
+        if self.headers.get('Range') and self.headers.get('If-Range', ETAG) == ETAG:
+            first, last = self.headers['Range'].split('=')[1].split('-')
+            start, end = int(first), int(last) if last else end
+            if self.path == '/shifted.bin':
+                # Answers every range from the start
+                start = 0
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes {}-{}/{}'.format(start, end, len(PAYLOAD)))
+        else:
+            self.send_response(200)
+        body = PAYLOAD[start:end + 1]
+        self.send_header('ETag', ETAG)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if self.path == '/flaky.bin' and start == 0:
+            # Drop the connection halfway through
+            self.wfile.write(body[:len(body) // 2])
+            self.close_connection = True
+            return
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class FakeAdapter(object):
+    def __init__(self, server):
+        self.bot = SimpleNamespace(getFile=lambda file_id: SimpleNamespace(file_id=file_id,
+            download=lambda path: open(path, 'wb').write(requests.get(server + '/slow.bin').content)))
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+@pytest.fixture
+def server():
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), FileHandler)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield 'http://127.0.0.1:{}'.format(httpd.server_port)
+    httpd.shutdown()
+    httpd.server_close()
+
+
+@pytest.fixture
+def downloader(tmp_path, monkeypatch):
+    # Put the module back as it was afterwards
+    for name in ('DOWNLOAD_PATH', 'WORKERS', 'FILE_CACHE', 'SESSION', 'DOWNLOADER_CONFIG'):
+        monkeypatch.setattr(net, name, getattr(net, name))
+    net.configure_downloader({'downloader': {'download_path': str(tmp_path), 'workers': 0, 'retries': 0}})
+    yield tmp_path
+    if net.WORKERS is not None:
+        net.WORKERS.shutdown()
+
+
+def test_download_file_streams_into_place(server, downloader):
+    filename, is_async = net.download_file(server + '/file.bin', file_prefix='test')
+    assert not is_async
+    with open(filename, 'rb') as f:
+        assert f.read() == PAYLOAD
+    assert not os.path.exists(filename + net.PARTIAL_SUFFIX)
+    assert net.pick_chunk_size(len(PAYLOAD)) == net.DOWNLOADER_DEFAULTS['min_chunk_size']
+
+
+def test_reconfiguring_shuts_down_the_previous_workers(downloader):
+    net.configure_downloader({'downloader': {'download_path': str(downloader), 'workers': 2}})
+    workers = net.WORKERS
+    net.configure_downloader({'downloader': {'download_path': str(downloader), 'workers': 2}})
+    assert net.WORKERS is not workers
+    with pytest.raises(RuntimeError):
+        workers.submit(print)
+
+
+def test_failed_download_leaves_nothing_behind(server, downloader):
+    with pytest.raises(DownloadException):
+        net.download_file(server + '/missing.bin', file_prefix='test')
+    assert os.listdir(str(downloader / 'test')) == []
+
+
+def test_concurrent_downloads_share_one_request_and_storage(server, downloader):
+    net.configure_downloader({'downloader': {'download_path': str(downloader), 'workers': 4}})
+    del REQUESTS[:]
+    done = []
+    for target in ('a.bin', 'a.bin', 'b.bin'):
+        net.fetch_from_telegram(FakeAdapter(server), 'FILE_ID', target_filename=target, on_done=done.append)
+    net.WORKERS.shutdown()
+    assert REQUESTS == [('/slow.bin', None)]
+    assert sorted(os.path.basename(filename) for filename in done) == ['a.bin', 'a.bin', 'b.bin']
+    for filename in done:
+        with open(filename, 'rb') as f:
+            assert f.read() == PAYLOAD
+
+    # Same content under another name is stored once
+    net.configure_downloader({'downloader': {'download_path': str(downloader), 'workers': 0}})
+    copy, _ = net.download_file(server + '/copy.bin', file_prefix='telegram')
+    assert os.path.samefile(copy, done[0])
+
+
+def test_same_content_finishing_together_is_stored_once(downloader, monkeypatch):
+    import hashlib
+
+    digest = hashlib.sha256(PAYLOAD).hexdigest()
+    filenames = []
+    for name in ('first.bin', 'second.bin'):
+        filename = str(downloader / name)
+        with open(filename, 'wb') as f:
+            f.write(PAYLOAD)
+        filenames.append(filename)
+    link = os.link
+
+    def racing_link(source, target):
+        if target == net.content_path(digest) and not os.path.exists(target):
+            # The other download stores it first
+            monkeypatch.setattr(os, 'link', link)
+            net.store_content(filenames[0], digest)
+        return link(source, target)
+
+    monkeypatch.setattr(os, 'link', racing_link)
+    net.store_content(filenames[1], digest)
+
+    for filename in filenames:
+        assert os.path.samefile(filename, net.content_path(digest))
+        assert net.get_file_cache().get(filename).digest == digest
+    assert net.get_file_cache().usage == len(PAYLOAD)
+
+
+def test_file_cache_evicts_least_recently_used_unpinned(tmp_path):
+    cache = FileCache(str(tmp_path), quota=250)
+    paths = []
+    for name in ('a', 'b', 'c'):
+        path = str(tmp_path / name)
+        with open(path, 'wb') as f:
+            f.write(b'x' * 100)
+        paths.append(path)
+        with cache.pin(paths[0]):
+            cache.add(path)
+        time.sleep(0.01)
+
+    # a was pinned when c pushed it over the quota
+    assert paths[0] in cache and paths[1] not in cache and paths[2] in cache
+    assert not os.path.exists(paths[1])
+    assert cache.usage == 200
+
+    # The index survives restarts
+    cache.close()
+    assert FileCache(str(tmp_path), quota=250).stats()['files'] == 2
+
+
+def test_downloads_over_the_quota_are_kept_until_delivered(server, downloader):
+    net.configure_downloader({'downloader': {'download_path': str(downloader), 'workers': 0, 'quota': 1000}})
+    delivered = []
+    filename, _ = net.download_file(server + '/file.bin', file_prefix='test',
+                                    on_done=lambda path: delivered.append(os.path.exists(path)))
+    assert delivered == [True]
+    assert os.path.exists(filename)
+
+    # Evicted by the next one
+    other, _ = net.download_file(server + '/copy.bin', file_prefix='test')
+    assert not os.path.exists(filename) and os.path.exists(other)
+
+
+def test_shared_file_cache_sees_other_processes(tmp_path):
+    first = FileCache(str(tmp_path), quota=250, shared=True)
+    second = FileCache(str(tmp_path), quota=250, shared=True)
+    paths = []
+    for name in ('a', 'b', 'c'):
+        path = str(tmp_path / name)
+        with open(path, 'wb') as f:
+            f.write(b'x' * 100)
+        paths.append(path)
+
+    first.add(paths[0])
+    assert second.get(paths[0]).size == 100
+    second.remove(paths[0])
+    assert paths[0] not in first
+
+    # Files the other one added count for the quota
+    first.add(paths[1])
+    time.sleep(0.01)
+    second.add(paths[2])
+    assert second.usage == 200
+    first.close()
+    second.close()
+
+
+def test_interrupted_download_resumes_where_it_stopped(server, downloader):
+    del REQUESTS[:]
+    progress = []
+    filename, _ = net.download_file(server + '/flaky.bin', file_prefix='test',
+                                    on_progress=lambda done, total: progress.append((done, total)))
+    with open(filename, 'rb') as f:
+        assert f.read() == PAYLOAD
+    # Picks up from the last complete chunk
+    (_, first), (_, second) = REQUESTS
+    assert first is None and 0 < int(second[len('bytes='):-1]) <= len(PAYLOAD) // 2
+    assert progress[-1] == (len(PAYLOAD), len(PAYLOAD))
+
+
+def write_partial(filename, content, validator=None):
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    with open(filename + net.PARTIAL_SUFFIX, 'wb') as f:
+        f.write(content)
+    if validator:
+        with open(filename + net.VALIDATOR_SUFFIX, 'w') as f:
+            f.write(validator)
+
+
+def test_stale_partial_files_are_not_spliced(server, downloader):
+    cases = [
+        # Another version of the file
+        ('/ranged.bin', b'x' * 1000, '"v0"'),
+        # Nothing to tell which version it is
+        ('/ranged.bin', b'x' * 1000, None),
+        # The server resumes at the wrong offset
+        ('/shifted.bin', PAYLOAD[-1000:], ETAG),
+    ]
+    for i, (path, content, validator) in enumerate(cases):
+        filename = str(downloader / 'test' / 'stale{}.bin'.format(i))
+        write_partial(filename, content, validator)
+        assert net.download_file(server + path, target_filename=os.path.basename(filename),
+                                 file_prefix='test')[0] == filename
+        with open(filename, 'rb') as f:
+            assert f.read() == PAYLOAD, path
+        assert not os.path.exists(filename + net.PARTIAL_SUFFIX)
+        assert not os.path.exists(filename + net.VALIDATOR_SUFFIX)
+
+    # The same version is resumed
+    filename = str(downloader / 'test' / 'fresh.bin')
+    write_partial(filename, PAYLOAD[:1000], ETAG)
+    del REQUESTS[:]
+    net.download_file(server + '/ranged.bin', target_filename='fresh.bin', file_prefix='test')
+    assert REQUESTS == [('/ranged.bin', 'bytes=1000-')]
+    with open(filename, 'rb') as f:
+        assert f.read() == PAYLOAD
+
+
+def test_partial_files_locked_by_another_process_are_left_alone(server, downloader):
+    filename = str(downloader / 'test' / 'locked.bin')
+    write_partial(filename, b'x' * 1000, ETAG)
+    lock = net.lock_partial(filename)
+    assert net.lock_partial(filename) is None
+
+    net.download_file(server + '/ranged.bin', target_filename='locked.bin', file_prefix='test')
+    with open(filename, 'rb') as f:
+        assert f.read() == PAYLOAD
+    with open(filename + net.PARTIAL_SUFFIX, 'rb') as f:
+        assert f.read() == b'x' * 1000
+    net.unlock_partial(lock)
+    assert not os.path.exists(filename + net.LOCK_SUFFIX)
+
+
+def test_parallel_ranges_are_reassembled(server, downloader):
+    net.configure_downloader({'downloader': {'download_path': str(downloader), 'workers': 3,
+                                             'parallel_min_size': 1}})
+    del REQUESTS[:]
+    done = []
+    finished = threading.Event()
+    net.download_file(server + '/ranged.bin', file_prefix='test', parallel=4,
+                      on_done=lambda filename: done.append(filename) or finished.set())
+    assert finished.wait(10)
+    with open(done[0], 'rb') as f:
+        assert f.read() == PAYLOAD
+    # The probe, then 4 ranges
+    assert len(REQUESTS) == 5
+
+
+def test_download_future_propagates_errors_and_deadlines(server, downloader):
+    net.configure_downloader({'downloader': {'download_path': str(downloader), 'workers': 2, 'retries': 0}})
+    failed = net.download(server + '/missing.bin', file_prefix='test')
+    with pytest.raises(DownloadException):
+        failed.result(timeout=10)
+
+    slow = net.download(server + '/slow.bin', file_prefix='test', deadline=0.05)
+    with pytest.raises(DownloadTimeout):
+        slow.result(timeout=10)
+
+    # Cancelling one of two requesters leaves the download running for the other
+    first = net.download(server + '/slow.bin', file_prefix='test', target_filename='shared.bin')
+    second = net.download(server + '/slow.bin', file_prefix='test', target_filename='shared.bin')
+    assert first.cancel()
+    assert second.result(timeout=10).endswith('shared.bin')
+    assert first.cancelled()
+
+
+def test_async_api(server, downloader):
+    async def fetch():
+        path = await net.download(server + '/file.bin', file_prefix='test', target_filename='async.bin')
+        chunks = [chunk async for chunk in net.iter_download_async(server + '/file.bin')]
+        return path, b''.join(chunks)
+
+    loop = asyncio.new_event_loop()
+    try:
+        path, body = loop.run_until_complete(fetch())
+    finally:
+        loop.close()
+    assert body == PAYLOAD
+    with open(path, 'rb') as f:
+        assert f.read() == PAYLOAD
@@ -0,0 +1,104 @@
+from collections import defaultdict
+from marvinbot.outbound import OutboundQueue
+from marvinbot import ratelimit
+import threading
+import telegram
+import pytest
+import time
+
+
+class FakeBot(object):
+    def rate_limiter_key(self, chat_id):
+        return 'group-{}'.format(chat_id), 'group'
+
+
+@pytest.fixture
+def sent(monkeypatch):
+    sent = defaultdict(list)
+    lock = threading.Lock()
+
+    def send_message(self, chat_id=None, text=None, **kwargs):
+        time.sleep(0.001)
+        with lock:
+            sent[chat_id].append(text)
+            return sum(len(texts) for texts in sent.values())
+
+    monkeypatch.setattr(telegram.Bot, 'send_message', send_message, raising=False)
+    monkeypatch.setattr(ratelimit, 'REGISTRY', ratelimit.RateLimiterRegistry(
+        {'default': {'max_calls': 100, 'period': 1}, 'group': {'max_calls': 100, 'period': 1}}))
+    return sent
+
+
+def test_keeps_order_per_chat(sent):
+    queue = OutboundQueue(FakeBot(), workers=4)
+    futures = [queue.send_message(chat_id, 'm{}'.format(i)) for i in range(20) for chat_id in (1, 2, 3)]
+    for future in futures:
+        future.result(5)
+
+    for chat_id in (1, 2, 3):
+        assert sent[chat_id] == ['m{}'.format(i) for i in range(20)]
+    assert queue.metrics() == {'sent': 60, 'coalesced': 0, 'queued': {}}
+    queue.shutdown()
+
+
+def test_coalesces_waiting_messages(sent, monkeypatch):
+    monkeypatch.setattr(ratelimit, 'REGISTRY', ratelimit.RateLimiterRegistry(
+        {'default': {'max_calls': 1, 'period': 0.2}, 'group': {'max_calls': 1, 'period': 0.2}}))
+    queue = OutboundQueue(FakeBot(), coalesce=True)
+    first = queue.send_message(1, 'a')
+    first.result(5)
+    # Queued while the chat waits on its rate limiter
+    futures = [queue.send_message(1, text) for text in ['b', 'c']]
+    markup = queue.send_message(1, 'd', reply_markup='keyboard')
+    assert [future.result(5) for future in futures] == [2, 2]
+    markup.result(5)
+
+    assert sent[1] == ['a', 'b\nc', 'd']
+    assert queue.metrics()['coalesced'] == 1
+    queue.shutdown()
+
+
+def test_rate_limited_chats_are_rescheduled(sent, monkeypatch):
+    monkeypatch.setattr(ratelimit, 'REGISTRY', ratelimit.RateLimiterRegistry(
+        {'default': {'max_calls': 100, 'period': 1}, 'group': {'max_calls': 2, 'period': 0.2}}))
+    # A single sender: the limited chat must not keep it asleep
+    queue = OutboundQueue(FakeBot(), workers=1)
+    limited = [queue.send_message(1, 'm{}'.format(i)) for i in range(4)]
+    started = time.monotonic()
+    other = queue.send_message(2, 'other')
+    other.result(5)
+    assert time.monotonic() - started < 0.1
+    assert not limited[-1].done()
+
+    for future in limited:
+        future.result(5)
+    assert sent[1] == ['m0', 'm1', 'm2', 'm3']
+    queue.shutdown()
+
+
+def test_shutdown_waits_for_queued_messages(sent, monkeypatch):
+    monkeypatch.setattr(ratelimit, 'REGISTRY', ratelimit.RateLimiterRegistry(
+        {'default': {'max_calls': 100, 'period': 1}, 'group': {'max_calls': 1, 'period': 0.1}}))
+    queue = OutboundQueue(FakeBot())
+    futures = [queue.send_message(1, 'm{}'.format(i)) for i in range(3)]
+    queue.shutdown()
+
+    assert all(future.done() for future in futures)
+    assert sent[1] == ['m0', 'm1', 'm2']
+
+
+def test_replies_wait_behind_queued_messages(sent, monkeypatch):
+    from marvinbot.core import RateLimitedBot
+
+    monkeypatch.setattr(ratelimit, 'REGISTRY', ratelimit.RateLimiterRegistry(
+        {'default': {'max_calls': 100, 'period': 1}, 'group': {'max_calls': 1, 'period': 0.1}}))
+    bot = object.__new__(RateLimitedBot)
+    monkeypatch.setattr(RateLimitedBot, 'rate_limiter_key', FakeBot.rate_limiter_key)
+    bot.outbound = OutboundQueue(bot)
+    bot.send_message_later(1, 'queued 1')
+    bot.send_message_later(1, 'queued 2')
+    # What Message.reply_text does
+    bot.send_message(1, 'reply')
+
+    assert sent[1] == ['queued 1', 'queued 2', 'reply']
+    bot.outbound.shutdown()
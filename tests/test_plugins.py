@@ -0,0 +1,366 @@
+from datetime import datetime
+from types import SimpleNamespace
+import json
+import sys
+import time
+import pytest
+from marvinbot.core import Adapter
+from marvinbot.plugins import load_plugins, find_manifest, has_submodule
+
+
+PLUGIN_SOURCE = '''
+from marvinbot.plugins import Plugin
+from marvinbot.handlers import CommandHandler
+
+CALLS = []
+
+
+class LazyTestPlugin(Plugin):
+    def setup_handlers(self, adapter):
+        self.add_handler(CommandHandler('lazy', self.on_lazy, adapter=adapter), priority=50)
+
+    def on_lazy(self, update, *args, **kwargs):
+        CALLS.append(update.effective_message.text)
+
+
+plugin = LazyTestPlugin('lazy_test_plugin')
+'''
+
+
+class FakeAdapter(Adapter):
+    bot_info = SimpleNamespace(username='marvin')
+
+    def fetch_updates(self, **kwargs):
+        return []
+
+    def process_update(self, update):
+        self.dispatch(update)
+
+    def notify_owners(self, message, **kwargs):
+        pass
+
+    def make_updater(self):
+        pass
+
+
+class FakeUpdate(object):
+    callback_query = None
+
+    def __init__(self, text):
+        self.message = self.effective_message = SimpleNamespace(text=text, date=datetime.now())
+
+
+def make_update(text):
+    return FakeUpdate(text)
+
+
+def test_lazy_plugin_loads_on_first_matching_update(tmp_path, monkeypatch):
+    package = tmp_path / 'lazy_test_plugin'
+    package.mkdir()
+    (package / '__init__.py').write_text(PLUGIN_SOURCE)
+    (package / 'manifest.json').write_text(json.dumps({
+        'name': 'lazy_test_plugin',
+        'handlers': [{'command': 'lazy', 'description': 'Lazy command', 'priority': 50}],
+    }))
+    monkeypatch.syspath_prepend(str(tmp_path))
+
+    assert find_manifest('lazy_test_plugin', {})['name'] == 'lazy_test_plugin'
+
+    adapter = FakeAdapter({})
+    config = {'plugins': ['lazy_test_plugin'],
+              'plugin_configuration': {'lazy_test_plugin': {'lazy': True}}}
+    load_plugins(config, adapter)
+    assert 'lazy_test_plugin' not in sys.modules
+    assert adapter.commands()['lazy'].description == 'Lazy command'
+
+    adapter.process_update(make_update('/other'))
+    assert 'lazy_test_plugin' not in sys.modules
+
+    adapter.process_update(make_update('/lazy first'))
+    adapter.process_update(make_update('/lazy second'))
+    module = sys.modules['lazy_test_plugin']
+    assert module.CALLS == ['/lazy first', '/lazy second']
+    # The stub is gone, only the real handler is left
+    assert len(adapter.handlers[50]) == 1
+    assert adapter.plugin_registry['lazy_test_plugin'] is module.plugin
+    assert not has_submodule('lazy_test_plugin', 'models')
+    sys.modules.pop('lazy_test_plugin')
+
+
+SLOW_PLUGIN_SOURCE = '''
+from marvinbot.plugins import Plugin
+from marvinbot.handlers import CommandHandler
+import threading
+import time
+import pytest
+
+STARTED = {{}}
+
+
+class SlowPlugin(Plugin):
+    depends_on = {depends_on!r}
+
+    def configure(self, config):
+        STARTED[self.name] = threading.current_thread().name
+        time.sleep({delay})
+
+    def setup_handlers(self, adapter):
+        self.add_handler(CommandHandler(self.name, lambda *args, **kwargs: None, adapter=adapter), priority=50)
+
+
+plugin = SlowPlugin('{name}')
+'''
+
+
+def make_slow_plugin(path, name, delay=0.3, depends_on=()):
+    package = path / name
+    package.mkdir()
+    (package / '__init__.py').write_text(SLOW_PLUGIN_SOURCE.format(name=name, delay=delay,
+                                                                   depends_on=tuple(depends_on)))
+
+
+def test_parallel_plugin_loading(tmp_path, monkeypatch):
+    make_slow_plugin(tmp_path, 'slow_a')
+    make_slow_plugin(tmp_path, 'slow_b')
+    make_slow_plugin(tmp_path, 'slow_c', delay=0, depends_on=['slow_a'])
+    make_slow_plugin(tmp_path, 'stuck', delay=2)
+    make_slow_plugin(tmp_path, 'after_stuck', delay=0, depends_on=['stuck'])
+    monkeypatch.syspath_prepend(str(tmp_path))
+    modules = ['slow_a', 'slow_b', 'slow_c', 'stuck', 'after_stuck']
+
+    adapter = FakeAdapter({})
+    started = time.perf_counter()
+    load_plugins({'plugins': modules, 'plugin_loader': {'parallel': True, 'workers': 4, 'timeout': 0.5}}, adapter)
+    elapsed = time.perf_counter() - started
+
+    # slow_a and slow_b ran side by side, slow_c waited for slow_a
+    assert elapsed < 1.0
+    assert sys.modules['slow_a'].STARTED['slow_a'] != sys.modules['slow_b'].STARTED['slow_b']
+    # Handlers are registered in the configured order, stuck plugins are skipped
+    assert [handler.command for handler in adapter.handlers[50]] == ['slow_a', 'slow_b', 'slow_c']
+    for module in modules:
+        sys.modules.pop(module)
+
+
+RELOADABLE_SOURCE = '''
+from marvinbot.plugins import Plugin
+from marvinbot.handlers import CommandHandler
+
+CALLS = []
+VERSION = {version!r}
+
+
+class ReloadablePlugin(Plugin):
+    def setup_handlers(self, adapter):
+        self.add_handler(CommandHandler('version', self.on_version, adapter=adapter), priority=50)
+
+    def on_version(self, update, *args, **kwargs):
+        CALLS.append(VERSION)
+
+
+plugin = ReloadablePlugin('reloadable')
+'''
+
+
+def test_reload_plugin_swaps_handlers(tmp_path, monkeypatch):
+    package = tmp_path / 'reloadable'
+    package.mkdir()
+    (package / '__init__.py').write_text(RELOADABLE_SOURCE.format(version=1))
+    monkeypatch.syspath_prepend(str(tmp_path))
+    # Both versions are the same size, and likely written within the same second
+    monkeypatch.setattr(sys, 'dont_write_bytecode', True)
+
+    adapter = FakeAdapter({})
+    load_plugins({'plugins': ['reloadable']}, adapter)
+    adapter.process_update(make_update('/version'))
+    old_module = sys.modules['reloadable']
+
+    (package / '__init__.py').write_text(RELOADABLE_SOURCE.format(version=2))
+    plugin = adapter.reload_plugin('reloadable')
+    adapter.process_update(make_update('/version'))
+
+    assert old_module.CALLS == [1]
+    assert sys.modules['reloadable'].CALLS == [2]
+    assert adapter.plugin_registry['reloadable'] is plugin
+    assert len(adapter.handlers[50]) == 1
+
+    # A broken version leaves the working one in place
+    (package / '__init__.py').write_text('raise ImportError("broken")')
+    with pytest.raises(ImportError):
+        adapter.reload_plugin('reloadable')
+    adapter.process_update(make_update('/version'))
+    assert sys.modules['reloadable'].CALLS == [2, 2]
+    assert adapter.plugin_registry['reloadable'] is plugin
+    sys.modules.pop('reloadable')
+
+
+IMPORT_TIME_SOURCE = '''
+from marvinbot.core import get_adapter
+from marvinbot.handlers import CommandHandler
+
+CALLS = []
+VERSION = {version!r}
+
+
+def on_version(update, *args, **kwargs):
+    CALLS.append(VERSION)
+
+
+get_adapter().add_handler(CommandHandler('version', on_version), priority=50)
+'''
+
+
+def test_reload_replaces_handlers_added_on_import(tmp_path, monkeypatch):
+    import marvinbot.core
+
+    package = tmp_path / 'import_time'
+    package.mkdir()
+    (package / '__init__.py').write_text(IMPORT_TIME_SOURCE.format(version=1))
+    monkeypatch.syspath_prepend(str(tmp_path))
+    monkeypatch.setattr(sys, 'dont_write_bytecode', True)
+    adapter = FakeAdapter({})
+    monkeypatch.setattr(marvinbot.core, '_ADAPTER', adapter)
+
+    load_plugins({'plugins': ['import_time']}, adapter)
+    old_module = sys.modules['import_time']
+    assert adapter.handlers[50][0].plugin is adapter.plugin_registry['import_time']
+
+    (package / '__init__.py').write_text(IMPORT_TIME_SOURCE.format(version=2))
+    adapter.reload_plugin('import_time')
+    adapter.process_update(make_update('/version'))
+
+    assert old_module.CALLS == []
+    assert sys.modules['import_time'].CALLS == [2]
+    assert len(adapter.handlers[50]) == 1
+    sys.modules.pop('import_time')
+
+
+BROKEN_SETUP_SOURCE = '''
+from marvinbot.plugins import Plugin
+from marvinbot.handlers import CommandHandler
+
+
+class BrokenPlugin(Plugin):
+    def setup(self):
+        self.add_handler(CommandHandler('version', lambda *args, **kwargs: None, adapter=self.adapter),
+                         priority=50)
+        self.add_job(lambda: None, 'interval', minutes=1, id='new')
+        raise RuntimeError('broken')
+
+
+plugin = BrokenPlugin('reloadable')
+'''
+
+
+def test_reload_keeps_the_old_plugin_if_setup_fails(tmp_path, monkeypatch):
+    from apscheduler.schedulers.background import BackgroundScheduler
+
+    package = tmp_path / 'reloadable'
+    package.mkdir()
+    (package / '__init__.py').write_text(RELOADABLE_SOURCE.format(version=1))
+    monkeypatch.syspath_prepend(str(tmp_path))
+    monkeypatch.setattr(sys, 'dont_write_bytecode', True)
+    adapter = FakeAdapter({})
+    adapter.scheduler = BackgroundScheduler()
+    adapter.scheduler.start(paused=True)
+
+    load_plugins({'plugins': ['reloadable']}, adapter)
+    old = adapter.plugin_registry['reloadable']
+    old.add_job(lambda: None, 'interval', minutes=1, id='old')
+
+    (package / '__init__.py').write_text(BROKEN_SETUP_SOURCE)
+    with pytest.raises(RuntimeError):
+        adapter.reload_plugin('reloadable')
+    adapter.process_update(make_update('/version'))
+
+    assert sys.modules['reloadable'].CALLS == [1]
+    assert adapter.plugin_registry['reloadable'] is old
+    assert len(adapter.handlers[50]) == 1
+    assert [job.id for job in adapter.get_jobs()] == ['old']
+    adapter.scheduler.shutdown(wait=False)
+    sys.modules.pop('reloadable')
+
+
+PROCESS_SOURCE = '''
+from marvinbot.plugins import Plugin
+from marvinbot.handlers import CommandHandler
+
+
+class CrunchPlugin(Plugin):
+    def setup_handlers(self, adapter):
+        self.add_handler(CommandHandler('crunch', self.on_crunch, adapter=adapter), priority=50,
+                         executor='process')
+
+    def on_crunch(self, update, *args, **kwargs):
+        return {version!r}
+
+
+plugin = CrunchPlugin('crunch')
+'''
+
+
+def test_reloaded_process_handlers_keep_their_key(tmp_path, monkeypatch):
+    package = tmp_path / 'crunch'
+    package.mkdir()
+    (package / '__init__.py').write_text(PROCESS_SOURCE.format(version=1))
+    monkeypatch.syspath_prepend(str(tmp_path))
+    monkeypatch.setattr(sys, 'dont_write_bytecode', True)
+
+    adapter = FakeAdapter({})
+    load_plugins({'plugins': ['crunch']}, adapter)
+    key = adapter.handlers[50][0].process_key
+
+    (package / '__init__.py').write_text(PROCESS_SOURCE.format(version=2))
+    adapter.reload_plugin('crunch')
+    # What a worker process started now would compute
+    fresh = FakeAdapter({})
+    sys.modules.pop('crunch')
+    load_plugins({'plugins': ['crunch']}, fresh)
+
+    assert key == 'crunch.CrunchPlugin.on_crunch'
+    assert adapter.handlers[50][0].process_key == key == fresh.handlers[50][0].process_key
+    assert adapter._process_keys == {key}
+    sys.modules.pop('crunch')
+
+
+BOTH_SOURCE = '''
+from marvinbot.plugins import Plugin
+from marvinbot.handlers import CommandHandler, MessageHandler
+
+CALLS = []
+
+
+class BothPlugin(Plugin):
+    def setup_handlers(self, adapter):
+        self.add_handler(CommandHandler('both', self.on_command, adapter=adapter, is_final=True), priority=50)
+        self.add_handler(MessageHandler([lambda message: True], self.on_message, adapter=adapter), priority=60)
+
+    def on_command(self, update, *args, **kwargs):
+        CALLS.append('command')
+
+    def on_message(self, update, *args, **kwargs):
+        CALLS.append('message')
+
+
+plugin = BothPlugin('both_plugin')
+'''
+
+
+@pytest.mark.parametrize('lazy', [False, True])
+def test_lazy_plugins_dispatch_like_eager_ones(tmp_path, monkeypatch, lazy):
+    package = tmp_path / 'both_plugin'
+    package.mkdir()
+    (package / '__init__.py').write_text(BOTH_SOURCE)
+    (package / 'manifest.json').write_text(json.dumps({
+        'name': 'both_plugin',
+        'handlers': [{'command': 'both', 'priority': 50}, {'regexps': ['.*'], 'priority': 60}],
+    }))
+    monkeypatch.syspath_prepend(str(tmp_path))
+
+    adapter = FakeAdapter({})
+    load_plugins({'plugins': ['both_plugin'], 'plugin_configuration': {'both_plugin': {'lazy': lazy}}}, adapter)
+    adapter.process_update(make_update('/both'))
+    adapter.process_update(make_update('/both'))
+
+    assert sys.modules['both_plugin'].CALLS == ['command', 'message'] * 2
+    sys.modules.pop('both_plugin')
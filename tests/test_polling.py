@@ -0,0 +1,134 @@
+from types import SimpleNamespace
+import threading
+from marvinbot.polling import TelegramPollingThread
+
+
+class FakeAdapter(object):
+    def __init__(self, batches):
+        self.config = {'fetch_timeout': 0,
+                       'updater': {'pipeline_depth': 2, 'polling_interval': 0.01, 'polling_workers': 2}}
+        self.batches = list(batches)
+        self.offsets = []
+        self.processed = []
+        self.done = threading.Event()
+        self.poller = None
+
+    def fetch_updates(self, last_update_id=None):
+        self.offsets.append(last_update_id)
+        if not self.batches:
+            self.poller.running = False
+            return []
+        return self.batches.pop(0)
+
+    def receive_update(self, update):
+        self.processed.append(update.update_id)
+
+
+def make_update(update_id, chat_id=1):
+    chat = SimpleNamespace(id=chat_id)
+    return SimpleNamespace(update_id=update_id, effective_chat=chat, effective_user=None)
+
+
+def test_pipelined_polling_advances_offset_and_keeps_order():
+    adapter = FakeAdapter([[make_update(1), make_update(2)], [], [make_update(3)]])
+    poller = adapter.poller = TelegramPollingThread(adapter)
+    poller.start()
+    poller.join(5)
+    poller.stop()
+
+    assert not poller.is_alive()
+    assert adapter.offsets == [None, 3, 3, 4]
+    assert adapter.processed == [1, 2, 3]
+
+
+def make_async_adapter(batches, monkeypatch):
+    import marvinbot.core as core
+
+    monkeypatch.setattr(core, 'is_user_banned', lambda user: False)
+    adapter = object.__new__(core.AsyncTelegramAdapter)
+    core.Adapter.__init__(adapter, {'updater': {'polling_interval': 0.01, 'polling_workers': 2}})
+    adapter._bot_info = SimpleNamespace(username='marvin')
+    adapter._updater = None
+    adapter.publish_updates = False
+    batches = list(batches)
+
+    def fetch_updates(last_update_id=None):
+        if not batches:
+            adapter.updater.running = False
+            return []
+        return batches.pop(0)
+
+    adapter.fetch_updates = fetch_updates
+    return adapter
+
+
+def make_message_update(update_id, text, chat_id=1):
+    from datetime import datetime
+
+    message = SimpleNamespace(text=text, date=datetime.now())
+    return SimpleNamespace(update_id=update_id, effective_chat=SimpleNamespace(id=chat_id), effective_user=None,
+                           effective_message=message, callback_query=None)
+
+
+def test_async_polling_runs_coroutine_and_thread_handlers_in_order_per_chat(monkeypatch):
+    import asyncio
+    from collections import defaultdict
+    from marvinbot.handlers import CommandHandler, MessageHandler
+
+    updates = [make_message_update(i, '/go' if i % 2 else 'hi', chat_id=i % 3) for i in range(30)]
+    adapter = make_async_adapter([updates[:10], updates[10:20], [], updates[20:]], monkeypatch)
+    seen = defaultdict(list)
+    loop_threads = set()
+
+    async def on_command(update, *args, **kwargs):
+        loop_threads.add(threading.current_thread().name)
+        # Later updates of the chat must wait for this one
+        await asyncio.sleep(0.01 * (3 - update.update_id % 3))
+        seen[update.effective_chat.id].append(('coroutine', update.update_id))
+
+    def on_message(update):
+        seen[update.effective_chat.id].append(('thread', update.update_id))
+
+    adapter.add_handler(CommandHandler('go', on_command, adapter=adapter), plugin=None)
+    adapter.add_handler(MessageHandler([lambda message: not message.text.startswith('/')], on_message,
+                                       adapter=adapter), plugin=None)
+
+    poller = adapter.updater
+    poller.start()
+    poller.join(5)
+    poller.stop()
+
+    assert not poller.is_alive()
+    assert loop_threads == {'telegram-async-polling-thread'}
+    for chat_id in range(3):
+        expected = [('coroutine' if i % 2 else 'thread', i) for i in range(chat_id, 30, 3)]
+        assert seen[chat_id] == expected
+
+
+def test_async_polling_stop_waits_for_in_flight_updates(monkeypatch):
+    import asyncio
+    from marvinbot.handlers import CommandHandler
+
+    adapter = make_async_adapter([], monkeypatch)
+    started = threading.Event()
+    finished = []
+
+    async def slow(update, *args, **kwargs):
+        started.set()
+        await asyncio.sleep(0.2)
+        finished.append(update.update_id)
+
+    adapter.add_handler(CommandHandler('slow', slow, adapter=adapter), plugin=None)
+    pending = [[make_message_update(1, '/slow')]]
+
+    def fetch_updates(last_update_id=None):
+        return pending.pop(0) if pending else []
+
+    adapter.fetch_updates = fetch_updates
+    poller = adapter.updater
+    poller.start()
+    assert started.wait(5)
+    poller.stop()
+
+    assert not poller.is_alive()
+    assert finished == [1]
@@ -0,0 +1,127 @@
+from concurrent.futures import Future
+from types import SimpleNamespace
+import pytest
+from marvinbot.core import Adapter
+from marvinbot.handlers import CommandHandler
+from marvinbot.procpool import handler_key
+
+
+class FakeAdapter(Adapter):
+    bot_info = SimpleNamespace(username='marvin')
+
+    def fetch_updates(self, **kwargs):
+        return []
+
+    def process_update(self, update):
+        pass
+
+    def notify_owners(self, message, **kwargs):
+        pass
+
+    def make_updater(self):
+        pass
+
+
+class FakePool(object):
+    def __init__(self):
+        self.submitted = []
+
+    def submit(self, handler, update):
+        self.submitted.append((handler.process_key, update))
+        future = Future()
+        future.set_result(None)
+        return future
+
+
+def resize(update, *args, **kwargs):
+    return 'inline'
+
+
+def test_process_handlers_get_stable_unique_keys():
+    keys = []
+    for _ in range(2):
+        adapter = FakeAdapter({})
+        handlers = [CommandHandler(name, resize, adapter=adapter) for name in ('a', 'b')]
+        for handler in handlers:
+            adapter.add_handler(handler, executor='process')
+        keys.append([handler.process_key for handler in handlers])
+
+    assert keys[0] == keys[1]
+    assert keys[0] == ['test_procpool.resize', 'test_procpool.resize#2']
+    assert handler_key(handlers[0], set()) == 'test_procpool.resize'
+
+
+def test_run_handler_routes_process_handlers_to_the_pool():
+    adapter = FakeAdapter({})
+    adapter._process_pool = FakePool()
+    inline = CommandHandler('a', resize, adapter=adapter)
+    heavy = CommandHandler('b', resize, adapter=adapter)
+    adapter.add_handler(inline)
+    adapter.add_handler(heavy, executor='process')
+    update = object()
+
+    assert adapter.run_handler(heavy, update) is None
+    assert adapter._process_pool.submitted == [(heavy.process_key, update)]
+    pytest.raises(ValueError, adapter.add_handler, inline, executor='gpu')
+
+
+PROCESS_PLUGIN_SOURCE = '''
+from marvinbot.plugins import Plugin
+from marvinbot.handlers import CommandHandler
+import os
+
+IMPORTED_BY = os.getpid()
+
+
+class ProcessTestPlugin(Plugin):
+    def setup_handlers(self, adapter):
+        self.add_handler(CommandHandler('crunch', self.on_crunch, adapter=adapter), executor='process')
+
+    def on_crunch(self, update, *args, **kwargs):
+        with open(self.config['output'], 'w') as f:
+            f.write('{} {} {}'.format(os.getpid(), IMPORTED_BY, update.effective_message.text))
+
+
+plugin = ProcessTestPlugin('process_test_plugin')
+'''
+
+
+def test_process_handlers_run_in_spawned_workers(tmp_path, monkeypatch):
+    from datetime import datetime
+    from marvinbot.plugins import load_plugins
+    from marvinbot.procpool import configure_process_pool
+    import telegram
+    import sys
+    import os
+
+    package = tmp_path / 'process_test_plugin'
+    package.mkdir()
+    (package / '__init__.py').write_text(PROCESS_PLUGIN_SOURCE)
+    monkeypatch.syspath_prepend(str(tmp_path))
+    # Workers set up logging under var/log
+    monkeypatch.chdir(tmp_path)
+    output = tmp_path / 'output'
+    config = {
+        'telegram_token': '123456:TEST',
+        'plugins': ['process_test_plugin'],
+        'plugin_configuration': {'process_test_plugin': {'output': str(output)}},
+        'process_pool': {'workers': 1},
+        'logging': {'version': 1},
+    }
+    adapter = FakeAdapter(config)
+    load_plugins(config, adapter)
+    handler = adapter.handlers_for_plugin(adapter.plugin_registry['process_test_plugin'])[0]
+    pool = adapter._process_pool = configure_process_pool(config)
+    try:
+        # The worker loaded the plugin before any update showed up
+        assert [future.result(60) for future in pool.start()] == [1]
+        chat = telegram.Chat(1, 'private')
+        message = telegram.Message(1, telegram.User(1, 'someone', False), datetime.now(), chat, text='/crunch 42')
+        assert adapter.run_handler(handler, telegram.Update(1, message=message)) is None
+    finally:
+        adapter.shutdown_process_pool()
+        sys.modules.pop('process_test_plugin')
+
+    pid, imported_by, text = output.read_text().split(' ', 2)
+    assert pid == imported_by != str(os.getpid())
+    assert text == '/crunch 42'
@@ -0,0 +1,60 @@
+from marvinbot.ratelimit import TokenBucket, RateLimiterRegistry
+import time
+
+
+def test_bucket_allows_burst_then_delays():
+    bucket = TokenBucket(max_calls=3, period=3)
+    assert [bucket.reserve() for _ in range(3)] == [0, 0, 0]
+
+    delay = bucket.reserve()
+    assert 0.9 < delay <= 1
+    assert bucket.queued == 1 and bucket.delayed == 1
+
+
+def test_bucket_refills():
+    bucket = TokenBucket(max_calls=10, period=0.1)
+    for _ in range(10):
+        bucket.reserve()
+    time.sleep(0.1)
+    assert bucket.reserve() == 0
+
+
+def test_schedule_does_not_block():
+    registry = RateLimiterRegistry({'default': {'max_calls': 1, 'period': 0.2}})
+    first = registry.schedule('chat', lambda: 'first')
+    assert first.done() and first.result() == 'first'
+
+    start = time.monotonic()
+    second = registry.schedule('chat', lambda: 'second')
+    assert time.monotonic() - start < 0.1
+    assert not second.done()
+    assert registry.metrics()['chat']['queued'] == 1
+
+    assert second.result(timeout=1) == 'second'
+    assert registry.metrics()['chat']['queued'] == 0
+
+
+def test_registry_is_bounded():
+    registry = RateLimiterRegistry(max_limiters=2)
+    for key in ['a', 'b', 'c']:
+        registry.get(key)
+    assert sorted(registry.metrics()) == ['b', 'c']
+
+
+def test_idle_limiters_expire():
+    registry = RateLimiterRegistry(idle_ttl=0.05)
+    registry.get('a')
+    time.sleep(0.1)
+    assert registry.expire() == 1
+    assert registry.metrics() == {}
+
+
+def test_limited_buckets_are_not_evicted():
+    registry = RateLimiterRegistry({'default': {'max_calls': 1, 'period': 60}}, max_limiters=1, idle_ttl=0.05)
+    registry.get('busy').reserve()
+    registry.get('other')
+    assert 'busy' in registry.metrics()
+
+    time.sleep(0.1)
+    registry.expire()
+    assert registry.get('busy').reserve() > 0
@@ -0,0 +1,96 @@
+from marvinbot.state import StateStore, StateRecord
+import pytest
+
+
+class FakeCollection(object):
+    def __init__(self, documents=None):
+        self.documents = documents or {}
+        self.reads = 0
+        self.batches = []
+        self.on_write = None
+
+    def find_one(self, query, projection=None):
+        self.reads += 1
+        return self.documents.get(query['_id'])
+
+    def bulk_write(self, operations, ordered=True):
+        if self.on_write:
+            self.on_write()
+        self.batches.append(operations)
+
+
+def make_store(monkeypatch, documents=None, **kwargs):
+    collection = FakeCollection(documents)
+    monkeypatch.setattr(StateRecord, '_get_collection', classmethod(lambda cls: collection))
+    return StateStore(**kwargs), collection
+
+
+def test_writes_are_batched_until_flush(monkeypatch):
+    store, collection = make_store(monkeypatch, {'quiz:10:': {'_id': 'quiz:10:', 'data': {'step': 1}}})
+    state = store.scope('quiz')
+
+    assert state.get(chat_id=10) == {'step': 1}
+    state.update(chat_id=10, step=2)
+    state.update(chat_id=10, step=3)
+    state.set({'score': 5}, chat_id=10, user_id=7)
+    state.delete(chat_id=11)
+    assert state.get(chat_id=10) == {'step': 3}
+    assert collection.reads == 1
+    assert collection.batches == []
+
+    assert store.flush() == 3
+    assert len(collection.batches) == 1
+    assert store.flush() == 0
+    assert store.stats()['dirty'] == 0
+
+
+def test_returned_state_is_a_copy(monkeypatch):
+    store, collection = make_store(monkeypatch)
+    data = store.get('quiz', chat_id=1, default={'answers': []})
+    data['answers'].append('a')
+    assert store.get('quiz', chat_id=1) == {}
+    store.set('quiz', data, chat_id=1)
+    data['answers'].append('b')
+    assert store.get('quiz', chat_id=1) == {'answers': ['a']}
+
+
+def test_evicted_dirty_records_are_not_lost(monkeypatch):
+    store, collection = make_store(monkeypatch, max_entries=2)
+    for chat_id in range(5):
+        store.update('counter', chat_id=chat_id, count=chat_id)
+    assert store.get('counter', chat_id=0) == {'count': 0}
+    assert store.flush() == 5
+
+
+def test_records_being_flushed_are_not_evicted(monkeypatch):
+    store, collection = make_store(monkeypatch, max_entries=1)
+    store.update('counter', chat_id=1, a=1)
+
+    def while_writing():
+        # Would push chat 1 out of the cache, and have it read back from MongoDB
+        store.update('counter', chat_id=2, b=1)
+        store.update('counter', chat_id=1, c=1)
+
+    collection.on_write = while_writing
+    store.flush()
+    assert store.get('counter', chat_id=1) == {'a': 1, 'c': 1}
+
+
+def test_writes_are_refused_while_too_many_are_pending(monkeypatch):
+    store, collection = make_store(monkeypatch, max_pending=3)
+
+    def fail():
+        raise ConnectionError('down')
+
+    collection.on_write = fail
+    for chat_id in range(3):
+        store.set('counter', {'count': chat_id}, chat_id=chat_id)
+    with pytest.raises(ConnectionError):
+        store.set('counter', {'count': 3}, chat_id=3)
+    assert store.stats()['dirty'] == 3
+    assert store.stats()['failures'] == 1
+
+    collection.on_write = None
+    store.set('counter', {'count': 3}, chat_id=3)
+    assert store.stats()['dirty'] == 1
+    assert store.flush() == 1
@@ -0,0 +1,103 @@
+from datetime import datetime
+import threading
+import telegram
+from marvinbot.updatequeue import LocalUpdateQueue, UpdateConsumer, worker_partitions
+
+
+def make_update(update_id, chat_id, text):
+    chat = telegram.Chat(chat_id, 'group')
+    user = telegram.User(chat_id, 'someone', False)
+    message = telegram.Message(update_id, user, datetime.now(), chat, text=text)
+    return telegram.Update(update_id, message=message)
+
+
+class FakeAdapter(object):
+    bot = None
+
+    def __init__(self):
+        self.processed = []
+        self.lock = threading.Lock()
+
+    def process_update(self, update):
+        with self.lock:
+            self.processed.append((update.effective_chat.id, update.update_id, update.effective_message.text))
+
+
+def test_worker_partitions_cover_everything_once():
+    owned = [worker_partitions(8, index, 3) for index in range(3)]
+    assert sorted(p for partitions in owned for p in partitions) == list(range(8))
+
+
+def test_local_queue_round_trip_keeps_chat_order():
+    queue = LocalUpdateQueue(partitions=4)
+    for update_id in range(1, 41):
+        queue.publish(make_update(update_id, update_id % 5 + 100, 'text {}'.format(update_id)))
+
+    adapter = FakeAdapter()
+    consumers = [UpdateConsumer(adapter, queue, worker_partitions(4, index, 2), workers=2)
+                 for index in range(2)]
+    for consumer in consumers:
+        consumer.start()
+    while len(queue):
+        threading.Event().wait(0.01)
+    for consumer in consumers:
+        consumer.stop()
+        consumer.join(5)
+
+    assert len(adapter.processed) == 40
+    for chat_id in range(100, 105):
+        ids = [update_id for chat, update_id, text in adapter.processed if chat == chat_id]
+        assert ids == sorted(ids) and len(ids) == 8
+    assert ('text 7' in [text for chat, update_id, text in adapter.processed])
+
+
+def test_workers_shut_down_like_the_bot():
+    from marvinbot.core import Adapter
+    from marvinbot.runner import shutdown_bot
+    from marvinbot.scheduler import configure_scheduler
+    from marvinbot.signals import bot_shutdown
+
+    class WorkerAdapter(Adapter):
+        outbound_stopped = False
+
+        def fetch_updates(self, **kwargs):
+            raise AssertionError('Workers never poll')
+
+        process_update = FakeAdapter.process_update
+
+        def notify_owners(self, message, **kwargs):
+            pass
+
+        def make_updater(self):
+            raise AssertionError('Workers have no updater')
+
+        def shutdown_outbound(self, wait=True):
+            self.outbound_stopped = True
+
+    adapter = WorkerAdapter({})
+    adapter.processed, adapter.lock = [], threading.Lock()
+    adapter.is_worker = True
+    configure_scheduler({'scheduler': {'apscheduler.jobstores.default': {'type': 'memory'}}}, adapter)
+    # What a plugin's setup would do
+    adapter.add_job(lambda: None, 'interval', minutes=1, id='job')
+
+    queue = LocalUpdateQueue(partitions=1)
+    queue.publish(make_update(1, 100, 'text'))
+    adapter.consumers = [UpdateConsumer(adapter, queue, [0], workers=1)]
+    adapter.consumers[0].start()
+    while len(queue):
+        threading.Event().wait(0.01)
+
+    fired = []
+
+    def on_shutdown(sender):
+        fired.append(sender)
+    bot_shutdown.connect(on_shutdown)
+    try:
+        shutdown_bot(adapter)
+    finally:
+        bot_shutdown.disconnect(on_shutdown)
+
+    assert fired == [adapter] and adapter.outbound_stopped
+    assert not adapter.consumers[0].is_alive()
+    assert len(adapter.processed) == 1
@@ -0,0 +1,94 @@
+from types import SimpleNamespace
+import time
+import pytest
+from marvinbot import models
+from marvinbot.models import User
+from marvinbot.userupserts import UserUpsertBuffer
+import marvinbot.userupserts
+
+
+class FakeCollection(object):
+    def __init__(self):
+        self.batches = []
+        self.failing = False
+        self.attempts = 0
+
+    def bulk_write(self, operations, ordered=True):
+        self.attempts += 1
+        if self.failing:
+            raise ConnectionError('MongoDB is down')
+        self.batches.append(operations)
+
+
+def test_buffered_users_are_deduplicated_and_written_in_bulk(monkeypatch):
+    collection = FakeCollection()
+    monkeypatch.setattr(User, '_get_collection', classmethod(lambda cls: collection))
+    buffer = UserUpsertBuffer(window=60)
+    monkeypatch.setattr(marvinbot.userupserts, 'USER_UPSERTS', buffer)
+    monkeypatch.setattr(models, 'USER_CACHE', models.LRUCache())
+    # Not in the database
+    models.USER_CACHE.set(1, None)
+    models.USER_CACHE.set(2, None)
+
+    user, created = User.from_telegram(SimpleNamespace(id=1, first_name='Ann', last_name=None, username='ann'),
+                                       buffered=True)
+    assert created and user.username == 'ann'
+    user, created = User.from_telegram(SimpleNamespace(id=1, first_name='Ann', last_name=None, username='ann'),
+                                       buffered=True)
+    assert not created
+    User.from_telegram(SimpleNamespace(id=1, first_name='Ann', last_name=None, username='ann_b'), buffered=True)
+    User.from_telegram(SimpleNamespace(id=2, first_name='Bob', last_name='B', username=None), buffered=True)
+    assert collection.batches == []
+
+    assert buffer.flush() == 2
+    operations = collection.batches[0]
+    assert [op._filter for op in operations] == [{'_id': 1}, {'_id': 2}]
+    assert operations[0]._doc['$set'] == {'first_name': 'Ann', 'last_name': None, 'username': 'ann_b'}
+    assert '$setOnInsert' in operations[0]._doc
+
+    stats = buffer.stats()
+    assert stats['deduplicated'] == 1
+    assert stats['last_batch_size'] == 2
+    assert stats['flushes'] == 1
+
+
+def test_failed_writes_are_retried_and_bounded(monkeypatch):
+    collection = FakeCollection()
+    monkeypatch.setattr(User, '_get_collection', classmethod(lambda cls: collection))
+    buffer = UserUpsertBuffer(window=60, max_pending=3)
+
+    collection.failing = True
+    buffer.add(1, username='ann')
+    buffer.add(2, username='bob')
+    with pytest.raises(ConnectionError):
+        buffer.flush()
+    buffer.add(2, username='bob_b')
+    buffer.add(3, username='cid')
+    buffer.add(4, username='dan')
+    # The oldest one went
+    assert list(buffer.pending) == [2, 3, 4]
+    assert buffer.stats()['dropped'] == 1 and buffer.stats()['failures'] == 1
+
+    collection.failing = False
+    assert buffer.flush() == 3
+    operations = collection.batches[0]
+    assert [op._filter['_id'] for op in operations] == [2, 3, 4]
+    assert operations[0]._doc['$set'] == {'username': 'bob_b'}
+
+
+def test_failing_flushes_back_off(monkeypatch):
+    collection = FakeCollection()
+    collection.failing = True
+    monkeypatch.setattr(User, '_get_collection', classmethod(lambda cls: collection))
+    buffer = UserUpsertBuffer(window=0.05, max_batch=1, max_backoff=0.4)
+    buffer.start()
+    buffer.add(1, username='ann')
+    deadline = time.monotonic() + 0.7
+    while time.monotonic() < deadline:
+        # A full batch doesn't cut the wait short while backing off
+        buffer.add(2, username='bob')
+        time.sleep(0.01)
+    buffer.stop(flush=False)
+
+    # 0.05, then 0.1, 0.2, 0.4 apart, instead of every 0.05s
+    assert 2 <= collection.attempts <= 5
@@ -0,0 +1,66 @@
+import threading
+import pytest
+from marvinbot.webhook import WebhookUpdater
+from marvinbot.testing import FakeTelegramClient
+
+
+class FakeAdapter(object):
+    def __init__(self):
+        self.config = {'updater': {'polling_workers': 2, 'webhook': {'secret': 's3cret'}}}
+        self.bot = None
+        self.processed = []
+        self.lock = threading.Lock()
+
+    def receive_update(self, update):
+        with self.lock:
+            self.processed.append((update.effective_chat.id, update.effective_message.text))
+
+
+def test_webhook_dispatches_and_acknowledges():
+    adapter = FakeAdapter()
+    updater = WebhookUpdater(adapter)
+    client = FakeTelegramClient(updater.wsgi_app, path=updater.path, secret_token=updater.secret_token)
+
+    statuses, elapsed = client.flood(['msg {}'.format(i) for i in range(20)], chats=2)
+    assert statuses == [200] * 20
+    updater.stop()
+
+    assert len(adapter.processed) == 20
+    for chat_id in (1, 2):
+        texts = [text for chat, text in adapter.processed if chat == chat_id]
+        assert texts == sorted(texts, key=lambda t: int(t.split()[1]))
+
+
+def test_webhook_rejects_bad_requests():
+    updater = WebhookUpdater(FakeAdapter())
+    client = FakeTelegramClient(updater.wsgi_app, path=updater.path)
+    headers = {'X-Telegram-Bot-Api-Secret-Token': 's3cret'}
+    assert client.client.post(updater.path, data='nope', headers=headers).status_code == 400
+    assert client.client.get(updater.path).status_code == 405
+    # Without the secret
+    assert client.client.post('/telegram/webhook', data='{}').status_code == 404
+    updater.stop()
+
+
+def test_webhook_rejects_updates_without_the_secret_token():
+    adapter = FakeAdapter()
+    updater = WebhookUpdater(adapter)
+    for secret_token in (None, 'wrong'):
+        client = FakeTelegramClient(updater.wsgi_app, path=updater.path, secret_token=secret_token)
+        assert client.send_message('/start', user_id=1) == 403
+    updater.stop()
+    assert adapter.processed == []
+
+
+def test_webhook_needs_a_secret_to_listen_publicly():
+    adapter = FakeAdapter()
+    adapter.config['updater']['webhook'] = {'listen': '0.0.0.0'}
+    with pytest.raises(ValueError):
+        WebhookUpdater(adapter)
+
+    # Made up, for a receiver only reachable from this host
+    adapter.config['updater']['webhook'] = {}
+    first, second = WebhookUpdater(adapter), WebhookUpdater(adapter)
+    assert first.secret_token and first.secret_token != second.secret_token
+    first.stop()
+    second.stop()